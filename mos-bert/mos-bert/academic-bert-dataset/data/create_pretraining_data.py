@@ -67,169 +67,180 @@ class OFABERTTrainingInstance(object):
         self.segment_ids = segment_ids
 
 
+def compression_kwargs(compression, compression_level=4):
+    """h5py dataset arguments of a compressor: none, lzf (fast) or gzip (with its level)."""
+    if compression == "none":
+        return {}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": compression_level}
+    raise ValueError("unknown compression {}".format(compression))
+
+
+class HDF5InstanceWriter(object):
+    """Streams `TrainingInstance`s to an HDF5 file.
+
+    Instances are collected into blocks of `block_size`. The tokens of a block are converted to
+    ids at once and the block is appended to chunked, resizable datasets (one chunk per block),
+    so memory is bounded by a block and every block is compressed as it is written.
+    With `masked_lm` the static masks of the instances are written as well (input_mask,
+    segment_ids, masked_lm_positions, ...), else only input_ids, attention_mask and token_type_ids.
+    """
+
+    def __init__(
+        self,
+        output_file,
+        tokenizer,
+        max_seq_length,
+        max_predictions_per_seq,
+        no_nsp,
+        masked_lm=False,
+        block_size=1024,
+        compression="gzip",
+        compression_level=4,
+    ):
+        self.vocab = tokenizer.get_vocab()
+        self.unk_id = self.vocab.get(tokenizer.unk_token)
+        self.max_seq_length = max_seq_length
+        self.max_predictions_per_seq = max_predictions_per_seq
+        self.no_nsp = no_nsp
+        self.masked_lm = masked_lm
+        self.block_size = block_size
+
+        if masked_lm:
+            datasets = [
+                ("input_ids", max_seq_length, "i4"),
+                ("input_mask", max_seq_length, "i1"),
+                ("segment_ids", max_seq_length, "i1"),
+                ("masked_lm_positions", max_predictions_per_seq, "i4"),
+                ("masked_lm_ids", max_predictions_per_seq, "i4"),
+            ]
+            if not no_nsp:
+                datasets.append(("next_sentence_labels", None, "i1"))
+        else:
+            datasets = [
+                ("input_ids", max_seq_length, "i4"),
+                ("attention_mask", max_seq_length, "i1"),
+                ("token_type_ids", max_seq_length, "i1"),
+            ]
+
+        self.f = h5py.File(output_file, "w")
+        for name, width, dtype in datasets:
+            row_shape = () if width is None else (width,)
+            self.f.create_dataset(
+                name,
+                shape=(0,) + row_shape,
+                maxshape=(None,) + row_shape,
+                chunks=(block_size,) + row_shape,
+                dtype=dtype,
+                **compression_kwargs(compression, compression_level)
+            )
+
+        self.pending = []
+        self.num_written = 0
+
+    def tokens_to_ids(self, tokens):
+        return np.array([self.vocab.get(token, self.unk_id) for token in tokens], dtype=np.int32)
+
+    def add(self, instance):
+        self.pending.append(instance)
+        if len(self.pending) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        block, self.pending = self.pending, []
+        num_instances = len(block)
+
+        # the tokens of all the instances are laid out row by row in the True cells of the mask
+        lengths = np.array([len(instance.tokens) for instance in block])
+        assert lengths.max() <= self.max_seq_length
+        token_mask = np.arange(self.max_seq_length) < lengths[:, None]
+
+        input_ids = np.zeros([num_instances, self.max_seq_length], dtype=np.int32)
+        input_ids[token_mask] = self.tokens_to_ids(
+            [token for instance in block for token in instance.tokens]
+        )
+        segment_ids = np.zeros([num_instances, self.max_seq_length], dtype=np.int8)
+        segment_ids[token_mask] = np.array(
+            [segment_id for instance in block for segment_id in instance.segment_ids], dtype=np.int8
+        )
+
+        if self.masked_lm:
+            num_masked = np.array([len(instance.masked_lm_positions) for instance in block])
+            prediction_mask = np.arange(self.max_predictions_per_seq) < num_masked[:, None]
+            masked_lm_positions = np.zeros(
+                [num_instances, self.max_predictions_per_seq], dtype=np.int32
+            )
+            masked_lm_positions[prediction_mask] = np.array(
+                [p for instance in block for p in instance.masked_lm_positions], dtype=np.int32
+            )
+            masked_lm_ids = np.zeros([num_instances, self.max_predictions_per_seq], dtype=np.int32)
+            masked_lm_ids[prediction_mask] = self.tokens_to_ids(
+                [label for instance in block for label in instance.masked_lm_labels]
+            )
+            features = {
+                "input_ids": input_ids,
+                "input_mask": token_mask.astype(np.int8),
+                "segment_ids": segment_ids,
+                "masked_lm_positions": masked_lm_positions,
+                "masked_lm_ids": masked_lm_ids,
+            }
+            if not self.no_nsp:
+                features["next_sentence_labels"] = np.array(
+                    [1 if instance.is_random_next else 0 for instance in block], dtype=np.int8
+                )
+        else:
+            features = {
+                "input_ids": input_ids,
+                "attention_mask": token_mask.astype(np.int8),
+                "token_type_ids": segment_ids,
+            }
+
+        start = self.num_written
+        for name, data in features.items():
+            dataset = self.f[name]
+            dataset.resize(start + num_instances, axis=0)
+            dataset[start:] = data
+        self.num_written += num_instances
+
+    def close(self):
+        self.flush()
+        self.f.flush()
+        self.f.close()
+
+
+def write_instances(instances, writer):
+    for instance in tqdm(instances):
+        writer.add(instance)
+    writer.close()
+    return writer.num_written
+
+
 def write_instance_to_example_file(
     instances, tokenizer, max_seq_length, max_predictions_per_seq, output_file, no_nsp
 ):
     """Create TF example files from `TrainingInstance`s."""
-
-    total_written = 0
-    features = collections.OrderedDict()
-
-    num_instances = len(instances)
-    features["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["input_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["segment_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["masked_lm_positions"] = np.zeros(
-        [num_instances, max_predictions_per_seq], dtype="int32"
-    )
-    features["masked_lm_ids"] = np.zeros([num_instances, max_predictions_per_seq], dtype="int32")
-    if not no_nsp:
-        features["next_sentence_labels"] = np.zeros(num_instances, dtype="int32")
-
-    for inst_index, instance in enumerate(tqdm(instances)):
-        input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-        input_mask = [1] * len(input_ids)
-        segment_ids = list(instance.segment_ids)
-        assert len(input_ids) <= max_seq_length
-
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        masked_lm_positions = list(instance.masked_lm_positions)
-        masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-        masked_lm_weights = [1.0] * len(masked_lm_ids)
-
-        while len(masked_lm_positions) < max_predictions_per_seq:
-            masked_lm_positions.append(0)
-            masked_lm_ids.append(0)
-            masked_lm_weights.append(0.0)
-
-        # next_sentence_label = 1 if instance.is_random_next else 0
-
-        features["input_ids"][inst_index] = input_ids
-        features["input_mask"][inst_index] = input_mask
-        features["segment_ids"][inst_index] = segment_ids
-        features["masked_lm_positions"][inst_index] = masked_lm_positions
-        features["masked_lm_ids"][inst_index] = masked_lm_ids
-
-        if not no_nsp:
-            features["next_sentence_labels"][inst_index] = 1 if instance.is_random_next else 0
-
-        total_written += 1
-
-        # if inst_index < 20:
-        #   tf.logging.info("*** Example ***")
-        #   tf.logging.info("tokens: %s" % " ".join(
-        #       [tokenization.printable_text(x) for x in instance.tokens]))
-
-        #   for feature_name in features.keys():
-        #     feature = features[feature_name]
-        #     values = []
-        #     if feature.int64_list.value:
-        #       values = feature.int64_list.value
-        #     elif feature.float_list.value:
-        #       values = feature.float_list.value
-        #     tf.logging.info(
-        #         "%s: %s" % (feature_name, " ".join([str(x) for x in values])))
-
-    print("saving data")
-    f = h5py.File(output_file, "w")
-    f.create_dataset("input_ids", data=features["input_ids"], dtype="i4", compression="gzip")
-    f.create_dataset("input_mask", data=features["input_mask"], dtype="i1", compression="gzip")
-    f.create_dataset("segment_ids", data=features["segment_ids"], dtype="i1", compression="gzip")
-    f.create_dataset(
-        "masked_lm_positions", data=features["masked_lm_positions"], dtype="i4", compression="gzip"
-    )
-    f.create_dataset(
-        "masked_lm_ids", data=features["masked_lm_ids"], dtype="i4", compression="gzip"
+    writer = HDF5InstanceWriter(
+        output_file, tokenizer, max_seq_length, max_predictions_per_seq, no_nsp, masked_lm=True
     )
-    if not no_nsp:
-        f.create_dataset(
-            "next_sentence_labels",
-            data=features["next_sentence_labels"],
-            dtype="i1",
-            compression="gzip",
-        )
-    f.flush()
-    f.close()
+    write_instances(instances, writer)
+
 
 def write_ofainstance_to_example_file(
     instances, tokenizer, max_seq_length, max_predictions_per_seq, output_file, no_nsp
 ):
     """Create TF example files from `TrainingInstance`s."""
+    writer = HDF5InstanceWriter(
+        output_file, tokenizer, max_seq_length, max_predictions_per_seq, no_nsp, masked_lm=False
+    )
+    write_instances(instances, writer)
 
-    total_written = 0
-    features = collections.OrderedDict()
-
-    num_instances = len(instances)
-    features["input_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["attention_mask"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-    features["token_type_ids"] = np.zeros([num_instances, max_seq_length], dtype="int32")
-
-    for inst_index, instance in enumerate(tqdm(instances)):
-        input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-        input_mask = [1] * len(input_ids)
-        segment_ids = list(instance.segment_ids)
-        assert len(input_ids) <= max_seq_length
-
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        # next_sentence_label = 1 if instance.is_random_next else 0
-
-        features["input_ids"][inst_index] = input_ids
-        features["attention_mask"][inst_index] = input_mask
-        features["token_type_ids"][inst_index] = segment_ids
-
-        total_written += 1
-
-        # if inst_index < 20:
-        #   tf.logging.info("*** Example ***")
-        #   tf.logging.info("tokens: %s" % " ".join(
-        #       [tokenization.printable_text(x) for x in instance.tokens]))
-
-        #   for feature_name in features.keys():
-        #     feature = features[feature_name]
-        #     values = []
-        #     if feature.int64_list.value:
-        #       values = feature.int64_list.value
-        #     elif feature.float_list.value:
-        #       values = feature.float_list.value
-        #     tf.logging.info(
-        #         "%s: %s" % (feature_name, " ".join([str(x) for x in values])))
-
-    print("saving data")
-    f = h5py.File(output_file, "w")
-    f.create_dataset("input_ids", data=features["input_ids"], dtype="i4", compression="gzip")
-    f.create_dataset("attention_mask", data=features["attention_mask"], dtype="i1", compression="gzip")
-    f.create_dataset("token_type_ids", data=features["token_type_ids"], dtype="i1", compression="gzip")
-    f.flush()
-    f.close()
 
-def create_training_instances(
-    input_files,
-    tokenizer,
-    max_seq_length,
-    dupe_factor,
-    short_seq_prob,
-    masked_lm_prob,
-    max_predictions_per_seq,
-    rng,
-    no_nsp,
-):
-    """Create `TrainingInstance`s from raw text."""
+def read_documents(input_files, tokenizer, rng):
+    """Tokenized documents of the input files, in random order."""
     all_documents = [[]]
 
     # Input file format:
@@ -257,28 +268,82 @@ def create_training_instances(
     # Remove empty documents
     all_documents = [x for x in all_documents if x]
     rng.shuffle(all_documents)
+    return all_documents
+
 
+def iter_training_instances(
+    all_documents,
+    tokenizer,
+    max_seq_length,
+    dupe_factor,
+    short_seq_prob,
+    masked_lm_prob,
+    max_predictions_per_seq,
+    rng,
+    no_nsp,
+):
+    """Yield the `TrainingInstance`s of the documents, document by document."""
     vocab_words = list(tokenizer.vocab.keys())
-    instances = []
     for _ in range(dupe_factor):
         for document_index in range(len(all_documents)):
             if no_nsp:
-                # instances.extend(create_instances_from_document_no_nsp(all_documents, document_index, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, vocab_words, rng))
-                instances.extend(create_ofa_instances_from_document_no_nsp(all_documents, document_index, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, vocab_words, rng))
+                # yield from create_instances_from_document_no_nsp(all_documents, document_index, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
+                yield from create_ofa_instances_from_document_no_nsp(all_documents, document_index, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
             else:
-                instances.extend(
-                    create_instances_from_document(
-                        all_documents,
-                        document_index,
-                        max_seq_length,
-                        short_seq_prob,
-                        masked_lm_prob,
-                        max_predictions_per_seq,
-                        vocab_words,
-                        rng,
-                    )
+                yield from create_instances_from_document(
+                    all_documents,
+                    document_index,
+                    max_seq_length,
+                    short_seq_prob,
+                    masked_lm_prob,
+                    max_predictions_per_seq,
+                    vocab_words,
+                    rng,
                 )
 
+
+def shuffle_buffer(instances, buffer_size, rng):
+    """Shuffle a stream with a buffer of `buffer_size` instances, the documents are already shuffled."""
+    buffer = []
+    for instance in instances:
+        if len(buffer) < buffer_size:
+            buffer.append(instance)
+            continue
+        index = rng.randint(0, buffer_size - 1)
+        yield buffer[index]
+        buffer[index] = instance
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def create_training_instances(
+    input_files,
+    tokenizer,
+    max_seq_length,
+    dupe_factor,
+    short_seq_prob,
+    masked_lm_prob,
+    max_predictions_per_seq,
+    rng,
+    no_nsp,
+):
+    """Create `TrainingInstance`s from raw text."""
+    all_documents = read_documents(input_files, tokenizer, rng)
+
+    instances = list(
+        iter_training_instances(
+            all_documents,
+            tokenizer,
+            max_seq_length,
+            dupe_factor,
+            short_seq_prob,
+            masked_lm_prob,
+            max_predictions_per_seq,
+            rng,
+            no_nsp,
+        )
+    )
+
     rng.shuffle(instances)
     return instances
 
@@ -650,6 +715,73 @@ def truncate_single_seq(tokens, max_num_tokens, rng):
             tokens.pop()
 
 
+def create_shard(
+    input_files,
+    output_file,
+    tokenizer,
+    max_seq_length,
+    dupe_factor,
+    short_seq_prob,
+    masked_lm_prob,
+    max_predictions_per_seq,
+    random_seed,
+    no_nsp,
+    shuffle_buffer_size=0,
+    block_size=1024,
+    compression="gzip",
+    compression_level=4,
+):
+    """Create the instances of `input_files` and stream them to `output_file`, returns their number.
+
+    Instances are shuffled over the whole shard (all of them in memory) by default, or through a
+    buffer of `shuffle_buffer_size` instances to bound memory. The buffer only mixes instances of
+    nearby documents (the documents themselves are shuffled first), which changes the shard order.
+    """
+    rng = random.Random(random_seed)
+    writer = HDF5InstanceWriter(
+        output_file,
+        tokenizer,
+        max_seq_length,
+        max_predictions_per_seq,
+        no_nsp,
+        block_size=block_size,
+        compression=compression,
+        compression_level=compression_level,
+    )
+
+    if shuffle_buffer_size == 0:
+        instances = create_training_instances(
+            input_files,
+            tokenizer,
+            max_seq_length,
+            dupe_factor,
+            short_seq_prob,
+            masked_lm_prob,
+            max_predictions_per_seq,
+            rng,
+            no_nsp,
+        )
+    else:
+        all_documents = read_documents(input_files, tokenizer, rng)
+        instances = shuffle_buffer(
+            iter_training_instances(
+                all_documents,
+                tokenizer,
+                max_seq_length,
+                dupe_factor,
+                short_seq_prob,
+                masked_lm_prob,
+                max_predictions_per_seq,
+                rng,
+                no_nsp,
+            ),
+            shuffle_buffer_size,
+            rng,
+        )
+
+    return write_instances(instances, writer)
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -732,6 +864,30 @@ def main():
         action="store_true",
         help="Generate samples without 2nd sentence segments (no NSP task)",
     )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=0,
+        help="Number of instances buffered to shuffle them, 0 (default) to shuffle the whole shard in memory. "
+        "A buffer bounds memory but changes the shuffle quality: instances are only mixed with the ones of "
+        "nearby documents, whereas the whole shard shuffle mixes all the documents of the shard",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=1024,
+        help="Number of instances converted and appended to the hdf5 file at once (and its chunk size)",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="gzip",
+        choices=["none", "lzf", "gzip"],
+        help="Compression of the hdf5 datasets",
+    )
+    parser.add_argument(
+        "--compression_level", type=int, default=4, help="gzip compression level (0-9)"
+    )
 
     args = parser.parse_args()
 
@@ -749,27 +905,21 @@ def main():
     else:
         raise ValueError("{} is not a valid path".format(args.input_file))
 
-    rng = random.Random(args.random_seed)
-    instances = create_training_instances(
+    create_shard(
         input_files,
+        args.output_file,
         tokenizer,
         args.max_seq_length,
         args.dupe_factor,
         args.short_seq_prob,
         args.masked_lm_prob,
         args.max_predictions_per_seq,
-        rng,
-        args.no_nsp,
-    )
-    output_file = args.output_file
-
-    write_ofainstance_to_example_file(
-        instances,
-        tokenizer,
-        args.max_seq_length,
-        args.max_predictions_per_seq,
-        output_file,
+        args.random_seed,
         args.no_nsp,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+        block_size=args.block_size,
+        compression=args.compression,
+        compression_level=args.compression_level,
     )
 
     '''
@@ -636,6 +636,43 @@ def truncate_single_seq(tokens, max_num_tokens, rng):
             tokens.pop()
 
 
+def create_shard(
+    input_files,
+    output_file,
+    tokenizer,
+    max_seq_length,
+    dupe_factor,
+    short_seq_prob,
+    masked_lm_prob,
+    max_predictions_per_seq,
+    random_seed,
+    no_nsp,
+):
+    """Create the instances of `input_files` and write them to `output_file`, returns their number."""
+    rng = random.Random(random_seed)
+    instances = create_training_instances(
+        input_files,
+        tokenizer,
+        max_seq_length,
+        dupe_factor,
+        short_seq_prob,
+        masked_lm_prob,
+        max_predictions_per_seq,
+        rng,
+        no_nsp,
+    )
+
+    write_ofainstance_to_example_file(
+        instances,
+        tokenizer,
+        max_seq_length,
+        max_predictions_per_seq,
+        output_file,
+        no_nsp,
+    )
+    return len(instances)
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -728,27 +765,16 @@ def main():
     else:
         raise ValueError("{} is not a valid path".format(args.input_file))
 
-    rng = random.Random(args.random_seed)
-    instances = create_training_instances(
+    create_shard(
         input_files,
+        args.output_file,
         tokenizer,
         args.max_seq_length,
         args.dupe_factor,
         args.short_seq_prob,
         args.masked_lm_prob,
         args.max_predictions_per_seq,
-        rng,
-        args.no_nsp,
-    )
-
-    output_file = args.output_file
-
-    write_ofainstance_to_example_file(
-        instances,
-        tokenizer,
-        args.max_seq_length,
-        args.max_predictions_per_seq,
-        output_file,
+        args.random_seed,
         args.no_nsp,
     )
 
@@ -14,11 +14,28 @@
 # limitations under the License.
 
 import argparse
+import json
 import logging
+import multiprocessing
 import os
-import subprocess
+import sys
 
-logger = logging.getLogger()
+from tqdm import tqdm
+
+# the sample creation scripts import their helpers as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s: %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+# creation module and tokenizer of a worker process, loaded once by init_worker
+_worker = {}
 
 
 def list_files_in_dir(dir, data_prefix=".txt"):
@@ -30,6 +47,117 @@ def list_files_in_dir(dir, data_prefix=".txt"):
     return dataset_files
 
 
+def generation_params(args):
+    """everything besides the shard and its seed that determines the content of an output shard"""
+    return {
+        "model_name": args.model_name,
+        "vocab_file": args.vocab_file,
+        "do_lower_case": bool(args.do_lower_case),
+        "masked_lm_prob": args.masked_lm_prob,
+        "max_seq_length": args.max_seq_length,
+        "max_predictions_per_seq": args.max_predictions_per_seq,
+        "short_seq_prob": args.short_seq_prob,
+        "seed": args.seed,
+        "shuffle_buffer_size": args.shuffle_buffer_size,
+        "compression": args.compression,
+    }
+
+
+def load_manifest(output_dir, params):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"params": params, "shards": {}}
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    if manifest["params"] != params:
+        raise ValueError(
+            f"{output_dir} holds shards generated with {manifest['params']}, "
+            "use another output directory for different parameters"
+        )
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def shard_jobs(shard_files, output_dir, dup_factor, seed):
+    """
+    one job per (input shard, duplicate). seeds only depend on the position of the input shard
+    among all the shards, so a resumed run generates exactly the shards a full run would.
+    """
+    jobs = []
+    for dup_idx in range(dup_factor):
+        for shard_idx, f_path in enumerate(shard_files):
+            name = os.path.basename(f_path).split(".txt")[0]
+            if dup_factor > 1:
+                name += f"_dup{dup_idx}"
+            jobs.append(
+                {
+                    "input_file": f_path,
+                    "output_file": os.path.join(output_dir, name + ".hdf5"),
+                    "seed": seed + dup_idx * len(shard_files) + shard_idx,
+                }
+            )
+    return jobs
+
+
+def is_done(job, done):
+    """a shard is redone unless the manifest has it with the same input and seed"""
+    entry = done.get(os.path.basename(job["output_file"]))
+    return (
+        entry is not None
+        and entry["input_file"] == job["input_file"]
+        and entry["seed"] == job["seed"]
+        and os.path.exists(job["output_file"])
+    )
+
+
+def init_worker(args):
+    if "roberta" in args.model_name:
+        import create_pretraining_data_roberta as creator
+
+        tokenizer = creator.RobertaTokenizer.from_pretrained(
+            args.model_name, max_len=args.max_seq_length
+        )
+    else:
+        import create_pretraining_data as creator
+
+        tokenizer = creator.BertTokenizer.from_pretrained(
+            args.vocab_file, do_lower_case=bool(args.do_lower_case), max_len=512
+        )
+    _worker["creator"] = creator
+    _worker["tokenizer"] = tokenizer
+    _worker["args"] = args
+
+
+def create_shard(job):
+    args = _worker["args"]
+    kwargs = {}
+    if "roberta" not in args.model_name:
+        kwargs = {"shuffle_buffer_size": args.shuffle_buffer_size, "compression": args.compression}
+    # written under a temporary name, an output file only exists once complete
+    tmp_file = job["output_file"] + ".tmp"
+    num_instances = _worker["creator"].create_shard(
+        [job["input_file"]],
+        tmp_file,
+        _worker["tokenizer"],
+        args.max_seq_length,
+        1,
+        args.short_seq_prob,
+        args.masked_lm_prob,
+        args.max_predictions_per_seq,
+        job["seed"],
+        True,
+        **kwargs,
+    )
+    os.replace(tmp_file, job["output_file"])
+    return job, num_instances
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", type=str, required=True, help="Path to shards dataset")
@@ -46,6 +174,12 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--max_seq_length", type=int, help="Specify the maximum sequence length", default=128)
+    parser.add_argument(
+        "--short_seq_prob",
+        type=float,
+        default=0.1,
+        help="Probability to create a sequence shorter than maximum sequence length",
+    )
     parser.add_argument(
         "--model_name",
         type=str,
@@ -61,70 +195,56 @@ if __name__ == "__main__":
         default=20,
     )
     parser.add_argument("--n_processes", type=int, default=8, help="number of parallel processes")
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=0,
+        help="instances buffered to shuffle them, 0 (default) to shuffle each whole shard in memory. "
+        "a buffer bounds memory, but only mixes instances of nearby documents",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="gzip",
+        choices=["none", "lzf", "gzip"],
+        help="compression of the hdf5 datasets",
+    )
 
     args = parser.parse_args()
+    if "roberta" in args.model_name and (args.shuffle_buffer_size != 0 or args.compression != "gzip"):
+        parser.error("roberta shards are always shuffled whole and gzip compressed")
 
-    # for each shard -> call prepare_data.py  x duplicated factor
+    # for each shard x duplicated factor -> create_shard in a pool of workers
 
-    shard_files = list_files_in_dir(args.dir)
-    # new_shards_output = os.path.join(args.o, "generated_hdf5_samples")
+    shard_files = sorted(list_files_in_dir(args.dir))
     new_shards_output = args.o
     os.makedirs(new_shards_output, exist_ok=True)
 
-    logger.info("Creating new hdf5 files ...")
-
-    def create_shard(f_path, shard_idx, set_group, args):
-        # output_filename = os.path.join(new_shards_output, f"{set_group}_shard_{shard_idx}.hdf5")
-        output_filename = os.path.join(new_shards_output, f_path.split("/")[-1].split(".txt")[0] + ".hdf5")
-        if "roberta" in args.model_name:
-            hdf5_preprocessing_cmd = "python data/create_pretraining_data_roberta.py"
-        else:
-            hdf5_preprocessing_cmd = "python data/create_pretraining_data.py"
-        hdf5_preprocessing_cmd += f" --input_file={f_path}"
-        hdf5_preprocessing_cmd += f" --output_file={output_filename}"
-        if "roberta" not in args.model_name:
-            hdf5_preprocessing_cmd += (
-                f" --vocab_file={args.vocab_file}" if args.vocab_file is not None else ""
-            )
-        hdf5_preprocessing_cmd += (
-            f" --bert_model={args.model_name}" if args.model_name is not None else ""
-        )
-        hdf5_preprocessing_cmd += f" --do_lower_case" if args.do_lower_case else ""
-        hdf5_preprocessing_cmd += f" --max_seq_length={args.max_seq_length}"
-        hdf5_preprocessing_cmd += f" --max_predictions_per_seq={args.max_predictions_per_seq}"
-        hdf5_preprocessing_cmd += f" --masked_lm_prob={args.masked_lm_prob}"
-        hdf5_preprocessing_cmd += f" --random_seed={args.seed + shard_idx}"
-        hdf5_preprocessing_cmd += f" --dupe_factor=1"
-        hdf5_preprocessing_cmd += f" --no_nsp"
-
-        bert_preprocessing_process = subprocess.Popen(hdf5_preprocessing_cmd, shell=True)
-
-        last_process = bert_preprocessing_process
-
-        # This could be better optimized (fine if all take equal time)
-        if shard_idx % args.n_processes == 0 and shard_idx > 0:
-            bert_preprocessing_process.wait()
-        return last_process
-
-    last_process = None
-    # shard_idx = {"train": 0, "test": 0}
-    new_shard_files = []
-    for f in shard_files:
-        if not os.path.exists(os.path.join(new_shards_output, f.split("/")[-1].split(".txt")[0] + ".hdf5")):
-            new_shard_files.append(f)
-        elif "roberta" in args.model_name and ("training94." in f):
-            new_shard_files.append(f)
-
-    shard_files = new_shard_files
-    shard_files.sort()
-    for dup_idx in range(args.dup_factor):
-        for fi, f in enumerate(shard_files):
-            file_name = os.path.basename(f)
-            set_group = "train" if "train" in file_name else "test"
-            # last_process = create_shard(f, shard_idx[set_group], set_group, args)
-            last_process = create_shard(f, fi, set_group, args)
-            # shard_idx[set_group] += 1
-    last_process.wait()
-
-
-
+    manifest = load_manifest(new_shards_output, generation_params(args))
+    jobs = shard_jobs(shard_files, new_shards_output, args.dup_factor, args.seed)
+    done = manifest["shards"]
+    todo = [job for job in jobs if not is_done(job, done)]
+    # longest first, so that the last shards to finish are the short ones
+    todo.sort(key=lambda job: os.path.getsize(job["input_file"]), reverse=True)
+    logger.info(f"Creating {len(todo)} new hdf5 files ({len(jobs) - len(todo)} already done) ...")
+
+    def record(job, num_instances):
+        done[os.path.basename(job["output_file"])] = {
+            "input_file": job["input_file"],
+            "seed": job["seed"],
+            "num_instances": num_instances,
+        }
+        save_manifest(new_shards_output, manifest)
+
+    if args.n_processes > 1 and len(todo) > 1:
+        with multiprocessing.Pool(
+            min(args.n_processes, len(todo)), initializer=init_worker, initargs=(args,)
+        ) as pool:
+            for job, num_instances in tqdm(
+                pool.imap_unordered(create_shard, todo, chunksize=1), total=len(todo)
+            ):
+                record(job, num_instances)
+    else:
+        init_worker(args)
+        for job in tqdm(todo):
+            record(*create_shard(job))
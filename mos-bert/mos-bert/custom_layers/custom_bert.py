@@ -83,6 +83,9 @@ from utils import dropout_layers
 
 logger = logging.get_logger(__name__)
 
+# fused attention kernels (flash / memory-efficient) are only in torch>=2.0
+SDPA_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+
 _CHECKPOINT_FOR_DOC = "bert-base-uncased"
 _CONFIG_FOR_DOC = "BertConfig"
 _TOKENIZER_FOR_DOC = "BertTokenizer"
@@ -223,6 +226,24 @@ def load_tf_weights_in_bert(model, config, tf_checkpoint_path):
     return model
 
 
+def concat_linear_samples(linears):
+    """
+    sampled weights and biases of linear layers sharing their input, stacked along the output dim.
+    the plain nn.Linear of an extracted subnet (get_active_subnet) are used whole.
+    """
+    samples = [
+        linear.sample_parameters(resample=True)
+        if isinstance(linear, CustomLinear)
+        else {"weight": linear.weight, "bias": linear.bias}
+        for linear in linears
+    ]
+    weight = torch.cat([sample["weight"] for sample in samples], dim=0)
+    bias = None
+    if samples[0]["bias"] is not None:
+        bias = torch.cat([sample["bias"] for sample in samples], dim=0)
+    return weight, bias
+
+
 # TODO: use config instead of sample_hidden_size, super_hidden_size
 # ^ rethinking this. For all lowest level set_sample_function, we directly use
 # the required variable instead of config. Looks fine for now.
@@ -381,6 +402,9 @@ class BertSelfAttention(nn.Module):
         self.sample_num_attention_heads = self.attention_head_size ## ?? doesn;t matter as set_sample_config is called
         self.sample_all_head_size = self.all_head_size
 
+        # concatenated query/key/value slices of the sampled subnet, see fused_qkv_parameters()
+        self.fused_qkv_cache = None
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
             self.sample_num_attention_heads,
@@ -412,6 +436,7 @@ class BertSelfAttention(nn.Module):
         self.query.set_sample_config(sample_hidden_size, self.sample_all_head_size)
         self.key.set_sample_config(sample_hidden_size, self.sample_all_head_size)
         self.value.set_sample_config(sample_hidden_size, self.sample_all_head_size)
+        self.fused_qkv_cache = None
         sample_hidden_dropout_prob = calc_dropout(
             config.attention_probs_dropout_prob,
             super_hidden_size=config.num_attention_heads,
@@ -432,6 +457,22 @@ class BertSelfAttention(nn.Module):
 
         return sublayer
 
+    def fused_qkv_parameters(self):
+        """
+        weight and bias of the sampled query, key and value projections concatenated along
+        the output dim, so that self-attention runs a single GEMM instead of three.
+        """
+        linears = [self.query, self.key, self.value]
+        if torch.is_grad_enabled():
+            # the concatenation has to be part of the graph for the slices to get their gradients
+            return concat_linear_samples(linears)
+        # without grad (eval / search) it is kept until the sampled arch or the weights change
+        params = [p for linear in linears for p in (linear.weight, linear.bias) if p is not None]
+        key = tuple((p._version, p.dtype, p.device) for p in params)
+        if self.fused_qkv_cache is None or self.fused_qkv_cache[0] != key:
+            self.fused_qkv_cache = (key, concat_linear_samples(linears))
+        return self.fused_qkv_cache[1]
+
     def forward(
         self,
         hidden_states,
@@ -442,30 +483,36 @@ class BertSelfAttention(nn.Module):
         past_key_value=None,
         output_attentions=False,
     ):
-        mixed_query_layer = self.query(hidden_states)
-
         # If this is instantiated as a cross-attention module, the keys
         # and values come from an encoder; the attention mask needs to be
         # such that the encoder's padding tokens are not attended to.
         is_cross_attention = encoder_hidden_states is not None
 
-        if is_cross_attention and past_key_value is not None:
-            # reuse k,v, cross_attentions
-            key_layer = past_key_value[0]
-            value_layer = past_key_value[1]
-            attention_mask = encoder_attention_mask
-        elif is_cross_attention:
-            key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
-            value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
-            attention_mask = encoder_attention_mask
-        elif past_key_value is not None:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
-            key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
-            value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
+        if not is_cross_attention and past_key_value is None:
+            # plain self-attention: project query, key and value at once
+            weight, bias = self.fused_qkv_parameters()
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = F.linear(
+                hidden_states, weight, bias
+            ).chunk(3, dim=-1)
+            key_layer = self.transpose_for_scores(mixed_key_layer)
+            value_layer = self.transpose_for_scores(mixed_value_layer)
         else:
-            key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.value(hidden_states))
+            mixed_query_layer = self.query(hidden_states)
+
+            if is_cross_attention and past_key_value is not None:
+                # reuse k,v, cross_attentions
+                key_layer = past_key_value[0]
+                value_layer = past_key_value[1]
+                attention_mask = encoder_attention_mask
+            elif is_cross_attention:
+                key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
+                value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
+                attention_mask = encoder_attention_mask
+            else:
+                key_layer = self.transpose_for_scores(self.key(hidden_states))
+                value_layer = self.transpose_for_scores(self.value(hidden_states))
+                key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
+                value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
@@ -479,63 +526,78 @@ class BertSelfAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-
-        if (
+        relative_position = (
             self.position_embedding_type == "relative_key"
             or self.position_embedding_type == "relative_key_query"
-        ):
-            seq_length = hidden_states.size()[1]
-            position_ids_l = torch.arange(
-                seq_length, dtype=torch.long, device=hidden_states.device
-            ).view(-1, 1)
-            position_ids_r = torch.arange(
-                seq_length, dtype=torch.long, device=hidden_states.device
-            ).view(1, -1)
-            distance = position_ids_l - position_ids_r
-            positional_embedding = self.distance_embedding(
-                distance + self.max_position_embeddings - 1
+        )
+        if SDPA_AVAILABLE and not relative_position and not output_attentions and head_mask is None:
+            # same math as below, but without materializing the attention probs
+            attention_probs = None
+            if attention_mask is not None:
+                # the kernels want an additive mask of the same dtype as the query (autocast)
+                attention_mask = attention_mask.to(query_layer.dtype)
+            context_layer = F.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
             )
-            positional_embedding = positional_embedding.to(
-                dtype=query_layer.dtype
-            )  # fp16 compatibility
-
-            if self.position_embedding_type == "relative_key":
-                relative_position_scores = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                attention_scores = attention_scores + relative_position_scores
-            elif self.position_embedding_type == "relative_key_query":
-                relative_position_scores_query = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                relative_position_scores_key = torch.einsum(
-                    "bhrd,lrd->bhlr", key_layer, positional_embedding
-                )
-                attention_scores = (
-                    attention_scores
-                    + relative_position_scores_query
-                    + relative_position_scores_key
+        else:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+
+            if relative_position:
+                seq_length = hidden_states.size()[1]
+                position_ids_l = torch.arange(
+                    seq_length, dtype=torch.long, device=hidden_states.device
+                ).view(-1, 1)
+                position_ids_r = torch.arange(
+                    seq_length, dtype=torch.long, device=hidden_states.device
+                ).view(1, -1)
+                distance = position_ids_l - position_ids_r
+                positional_embedding = self.distance_embedding(
+                    distance + self.max_position_embeddings - 1
                 )
+                positional_embedding = positional_embedding.to(
+                    dtype=query_layer.dtype
+                )  # fp16 compatibility
 
-        attention_scores = attention_scores / math.sqrt(self.sample_attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-            attention_scores = attention_scores + attention_mask
+                if self.position_embedding_type == "relative_key":
+                    relative_position_scores = torch.einsum(
+                        "bhld,lrd->bhlr", query_layer, positional_embedding
+                    )
+                    attention_scores = attention_scores + relative_position_scores
+                elif self.position_embedding_type == "relative_key_query":
+                    relative_position_scores_query = torch.einsum(
+                        "bhld,lrd->bhlr", query_layer, positional_embedding
+                    )
+                    relative_position_scores_key = torch.einsum(
+                        "bhrd,lrd->bhlr", key_layer, positional_embedding
+                    )
+                    attention_scores = (
+                        attention_scores
+                        + relative_position_scores_query
+                        + relative_position_scores_key
+                    )
+
+            attention_scores = attention_scores / math.sqrt(self.sample_attention_head_size)
+            if attention_mask is not None:
+                # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+                attention_scores = attention_scores + attention_mask
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.Softmax(dim=-1)(attention_scores)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            attention_probs = self.dropout(attention_probs)
 
-        # Mask heads if we want to
-        if head_mask is not None:
-            attention_probs = attention_probs * head_mask
+            # Mask heads if we want to
+            if head_mask is not None:
+                attention_probs = attention_probs * head_mask
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+            context_layer = torch.matmul(attention_probs, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (
@@ -1177,6 +1239,8 @@ class BertAttention(nn.Module):
         self.self.key = prune_linear_layer(self.self.key, index)
         self.self.value = prune_linear_layer(self.self.value, index)
         self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
+        # the fused projection of the unpruned layers is stale
+        self.self.fused_qkv_cache = None
 
         # Update hyper params and store pruned heads
         self.self.num_attention_heads = self.self.num_attention_heads - len(heads)
@@ -1189,6 +1253,8 @@ class BertAttention(nn.Module):
         sublayer = BertAttention(config)
         sublayer.self = self.self.get_active_subnet(config)
         sublayer.output = self.output.get_active_subnet(config)
+        # read by forward with rewire, the subnet is never sampled
+        sublayer.invert_importance_order = getattr(self, "invert_importance_order", False)
 
         return sublayer
 
@@ -1502,6 +1568,8 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
         self.is_identity_layer = False
+        # expert run by feed_forward_chunk, also for a layer built by get_active_subnet (never sampled)
+        self.active_expert_id = 0
 
         # add expert layers
         if hasattr(config, "max_experts"):
@@ -1511,8 +1579,13 @@ class BertLayer(nn.Module):
             self.other_intermediate_experts = nn.ModuleList([BertIntermediate(config) for _ in range(self.max_experts-1)] )
             self.other_output_experts = nn.ModuleList([BertOutput(config) for _ in range(self.max_experts-1)] )
 
+        # inference-only cache of the hypernet-mixed FFN weights, see materialize_arch_experts()
+        self.materialize_experts = False
+        self.materialized_expert_weights = None
+
     def set_sample_config(self, config, is_identity_layer=False):
         sample_hidden_size = config.sample_hidden_size
+        self.materialized_expert_weights = None
         if is_identity_layer:
             self.is_identity_layer = True
             return
@@ -1589,7 +1662,85 @@ class BertLayer(nn.Module):
                 self.arch_expert_fc2[-1].set_sample_config(config.hypernet_hidden_size, self.max_experts*config.sample_hidden_size)
                 self.arch_expert_fc1[-1].set_sample_config(config.hypernet_hidden_size, self.max_experts*config.sample_intermediate_size)
 
+        # the hypernet input only changes here, so the mixed experts can be baked once for inference
+        if self.materialize_experts and not self.training and hasattr(self, "arch_expert"):
+            self.get_arch_expert_weights()
+
+    def materialize_arch_experts(self, mode=True):
+        self.materialize_experts = mode
+        self.materialized_expert_weights = None
+
+    def train(self, mode=True):
+        # mixed expert weights go stale as soon as the experts are trained again
+        if mode:
+            self.materialized_expert_weights = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.materialized_expert_weights = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def mix_arch_experts(self):
+        """Blend the sampled FFN slices of all experts with the hypernet routing for `active_arch_embed`.
+
+        Returns (intermediate weight, intermediate bias, output weight, output bias),
+        or None for routing types that pick a single expert instead.
+        """
+        if self.expert_routing_type == "archrouting_jack_1L" or self.expert_routing_type == "archrouting_jack_2L":
+            route_prob = self.arch_expert(self.active_arch_embed)
+            intermediate_weights = route_prob[0] * self.intermediate.dense.samples["weight"]
+            intermediate_bias = route_prob[0] * self.intermediate.dense.samples["bias"]
+            layer_output_weights = route_prob[0] * self.output.dense.samples["weight"]
+            layer_output_bias = route_prob[0] * self.output.dense.samples["bias"]
+            for expert_id in range(self.max_experts-1):
+                intermediate_weights = intermediate_weights + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].dense.samples["weight"])
+                intermediate_bias = intermediate_bias + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].dense.samples["bias"])
+                layer_output_weights = layer_output_weights + (route_prob[expert_id+1] * self.other_output_experts[expert_id].dense.samples["weight"])
+                layer_output_bias = layer_output_bias + (route_prob[expert_id+1] * self.other_output_experts[expert_id].dense.samples["bias"])
+        elif self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_drop_2L"]:
+            fc1_expert_out = self.arch_expert_fc1(self.active_arch_embed)
+            fc1_expert_out = fc1_expert_out.view(-1, self.max_experts)
+            fc1_expert_out = torch.nn.Softmax(dim=-1)(fc1_expert_out)
+            fc2_expert_out = self.arch_expert_fc2(self.active_arch_embed)
+            fc2_expert_out = fc2_expert_out.view(-1, self.max_experts)
+            fc2_expert_out = torch.nn.Softmax(dim=-1)(fc2_expert_out)
+            intermediate_weights = self.intermediate.dense.samples["weight"] * fc1_expert_out[:, 0].view(-1,1)
+            intermediate_bias = self.intermediate.dense.samples["bias"] * fc1_expert_out[:, 0]
+            layer_output_weights = self.output.dense.samples["weight"] * fc2_expert_out[:, 0].view(-1,1)
+            layer_output_bias = self.output.dense.samples["bias"] * fc2_expert_out[:, 0]
+            for expert_id in range(self.max_experts-1):
+                intermediate_weights = intermediate_weights + (self.other_intermediate_experts[expert_id].dense.samples["weight"] * fc1_expert_out[:, expert_id+1].view(-1,1))
+                intermediate_bias = intermediate_bias + (self.other_intermediate_experts[expert_id].dense.samples["bias"] * fc1_expert_out[:, expert_id+1] )
+                layer_output_weights = layer_output_weights + (self.other_output_experts[expert_id].dense.samples["weight"] * fc2_expert_out[:, expert_id+1].view(-1,1))
+                layer_output_bias = layer_output_bias + (self.other_output_experts[expert_id].dense.samples["bias"] * fc2_expert_out[:, expert_id+1] )
+        else:
+            return None
+        return intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias
+
+    def get_arch_expert_weights(self):
+        if not self.materialize_experts or self.training:
+            return self.mix_arch_experts()
+        cached = self.materialized_expert_weights
+        weight = self.intermediate.dense.weight
+        if cached is None or cached[0].device != weight.device or cached[0].dtype != weight.dtype:
+            with torch.no_grad():
+                mixed_weights = self.mix_arch_experts()
+            if mixed_weights is not None:
+                mixed_weights = tuple(t.contiguous() for t in mixed_weights)
+            self.materialized_expert_weights = cached = mixed_weights
+        return cached
+
     def get_active_subnet(self, config):
+        mixed_weights = None
+        if hasattr(self, "arch_expert"):
+            with torch.no_grad():
+                mixed_weights = self.mix_arch_experts()
+        if mixed_weights is not None:
+            # the blended experts become the only FFN of the subnet, so it needs no hypernet or other experts
+            config = deepcopy(config)
+            for attr in ["max_experts", "expert_routing_type"]:
+                if hasattr(config, attr):
+                    delattr(config, attr)
         sublayer = BertLayer(config)
 
         sublayer.attention.self.set_sample_config(
@@ -1602,12 +1753,28 @@ class BertLayer(nn.Module):
 
         sublayer.attention = self.attention.get_active_subnet(config)
 
+        # the FFN of the expert the sampled config runs (the first one unless routed by sample_expert_ids)
+        intermediate, output = self.intermediate, self.output
+        if mixed_weights is None and self.active_expert_id > 0:
+            assert not (
+                getattr(self, "last_expert_averaging_expert", "no") == "yes" and self.active_expert_id == self.max_experts - 1
+            ), "the averaging expert cannot be exported as a single FFN"
+            intermediate = self.other_intermediate_experts[self.active_expert_id - 1]
+            output = self.other_output_experts[self.active_expert_id - 1]
+
         #### Building the intermediate layer
-        sublayer.intermediate.dense = self.intermediate.dense.get_active_subnet()
+        sublayer.intermediate.dense = intermediate.dense.get_active_subnet()
 
         #### Building the output layer
-        sublayer.output.dense = self.output.dense.get_active_subnet()
-        sublayer.output.LayerNorm = self.output.LayerNorm.get_active_subnet()
+        sublayer.output.dense = output.dense.get_active_subnet()
+        sublayer.output.LayerNorm = output.LayerNorm.get_active_subnet()
+
+        if mixed_weights is not None:
+            intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias = mixed_weights
+            sublayer.intermediate.dense.weight.data.copy_(intermediate_weights)
+            sublayer.intermediate.dense.bias.data.copy_(intermediate_bias)
+            sublayer.output.dense.weight.data.copy_(layer_output_weights)
+            sublayer.output.dense.bias.data.copy_(layer_output_bias)
 
         return sublayer
 
@@ -1714,49 +1881,17 @@ class BertLayer(nn.Module):
             layer_output = self.output.dropout(layer_output)
             layer_output = self.output.LayerNorm(layer_output + attention_output)
         elif hasattr(self, "arch_expert"):
-            if self.expert_routing_type == "archrouting_jack_1L" or self.expert_routing_type == "archrouting_jack_2L":
-                route_prob = self.arch_expert(self.active_arch_embed)
-                route_prob_max, routes = torch.max(route_prob, dim=-1)
-                intermediate_weights = route_prob[0] * self.intermediate.dense.samples["weight"]
-                intermediate_bias = route_prob[0] * self.intermediate.dense.samples["bias"]
-                layer_output_weights = route_prob[0] * self.output.dense.samples["weight"]
-                layer_output_bias = route_prob[0] * self.output.dense.samples["bias"]
-                for expert_id in range(self.max_experts-1):
-                    intermediate_weights = intermediate_weights + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].dense.samples["weight"])
-                    intermediate_bias = intermediate_bias + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].dense.samples["bias"])
-                    layer_output_weights = layer_output_weights + (route_prob[expert_id+1] * self.other_output_experts[expert_id].dense.samples["weight"])
-                    layer_output_bias = layer_output_bias + (route_prob[expert_id+1] * self.other_output_experts[expert_id].dense.samples["bias"])
-                intermediate_weights = intermediate_weights 
-                intermediate_bias = intermediate_bias 
-                layer_output_weights = layer_output_weights 
-                layer_output_bias = layer_output_bias 
-                intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
-                intermediate_output = self.intermediate.intermediate_act_fn(intermediate_output)
-                layer_output = F.linear(intermediate_output, layer_output_weights, layer_output_bias)
-                layer_output = self.output.dropout(layer_output)
-                layer_output = self.output.LayerNorm(layer_output + attention_output)
-            elif self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_drop_2L"]:
-                fc1_expert_out = self.arch_expert_fc1(self.active_arch_embed)
-                fc1_expert_out = fc1_expert_out.view(-1, self.max_experts)
-                fc1_expert_out = torch.nn.Softmax(dim=-1)(fc1_expert_out)
-                fc2_expert_out = self.arch_expert_fc2(self.active_arch_embed)
-                fc2_expert_out = fc2_expert_out.view(-1, self.max_experts)
-                fc2_expert_out = torch.nn.Softmax(dim=-1)(fc2_expert_out)
-                intermediate_weights = self.intermediate.dense.samples["weight"] * fc1_expert_out[:, 0].view(-1,1)
-                intermediate_bias = self.intermediate.dense.samples["bias"] * fc1_expert_out[:, 0]
-                layer_output_weights = self.output.dense.samples["weight"] * fc2_expert_out[:, 0].view(-1,1)
-                layer_output_bias = self.output.dense.samples["bias"] * fc2_expert_out[:, 0]
-                for expert_id in range(self.max_experts-1):
-                    intermediate_weights = intermediate_weights + (self.other_intermediate_experts[expert_id].dense.samples["weight"] * fc1_expert_out[:, expert_id+1].view(-1,1))
-                    intermediate_bias = intermediate_bias + (self.other_intermediate_experts[expert_id].dense.samples["bias"] * fc1_expert_out[:, expert_id+1] )
-                    layer_output_weights = layer_output_weights + (self.other_output_experts[expert_id].dense.samples["weight"] * fc2_expert_out[:, expert_id+1].view(-1,1))
-                    layer_output_bias = layer_output_bias + (self.other_output_experts[expert_id].dense.samples["bias"] * fc2_expert_out[:, expert_id+1] )
+            mixed_weights = self.get_arch_expert_weights()
+            if mixed_weights is not None:
+                intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias = mixed_weights
                 intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
                 intermediate_output = self.intermediate.intermediate_act_fn(intermediate_output)
                 layer_output = F.linear(intermediate_output, layer_output_weights, layer_output_bias)
                 layer_output = self.output.dropout(layer_output)
                 layer_output = self.output.LayerNorm(layer_output + attention_output)
             else:
+                route_prob = self.arch_expert(self.active_arch_embed)
+                route_prob_max, routes = torch.max(route_prob, dim=-1)
                 intermediate_output = self.intermediate(attention_output) if routes == 0 else self.other_intermediate_experts[routes - 1](attention_output)
                 layer_output = self.output(intermediate_output, attention_output) if routes == 0 else self.other_output_experts[routes - 1](intermediate_output, attention_output)
                 layer_output = route_prob_max * layer_output
@@ -1999,7 +2134,6 @@ class BertPooler(nn.Module):
 
     def get_active_subnet(self, config):
         sublayer = BertPooler(config)
-        self.dense.set_sample_config(config)  ## Should be unnecessary in principle
         sublayer.dense = self.dense.get_active_subnet()
         return sublayer
 
@@ -2150,6 +2284,20 @@ class BertPreTrainedModel(PreTrainedModel):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
+    def materialize_arch_experts(self, mode=True):
+        """Cache the hypernet-mixed FFN weights of every arch-routed layer per
+        sampled config, so evaluation only pays for the two FFN GEMMs."""
+        for module in self.modules():
+            if isinstance(module, BertLayer):
+                module.materialize_arch_experts(mode)
+
+    def freeze_samples(self, mode=True):
+        """Run every CustomLinear on contiguous copies of its sampled slices
+        when no gradients are needed (see CustomLinear.freeze_samples)."""
+        for module in self.modules():
+            if isinstance(module, CustomLinear):
+                module.freeze_samples(mode)
+
 
 @dataclass
 class BertForPreTrainingOutput(ModelOutput):
@@ -2321,7 +2469,9 @@ class BertModel(BertPreTrainedModel):
         #        ]
 
     def get_active_subnet(self, config):
-        subnet = BertModel(config)
+        # without a pooler in the supernet (e.g. BertForMaskedLM) the subnet has none either, a fresh one
+        # would not be sampled to the subnet dims
+        subnet = BertModel(config, add_pooling_layer=self.pooler is not None)
 
         subnet.embeddings = self.embeddings.get_active_subnet(config)
         subnet.encoder = self.encoder.get_active_subnet(config)
@@ -0,0 +1,129 @@
+'''
+one-time pass of a fixed teacher over pre-tokenized MLM data (see --pretokenized_data_dir of train_mlm.py),
+dumping the per-token top-k probabilities to a teacher cache (utils/teacher_cache.py) keyed by row.
+the teacher sees the rows masked with static masks (seeded by --mask_seed and the row), which
+train_mlm.py --teacher_topk_cache reuses for the student, so that the teacher never sees the masked labels.
+train_mlm.py then distills the logits from the cache instead of running the teacher.
+'''
+
+import argparse
+
+import torch
+from tqdm.auto import tqdm
+from transformers import AutoTokenizer
+
+from custom_layers import custom_bert
+from sampling import get_supertransformer_config
+from utils.pretokenized_data import PretokenizedMLMDataset, find_pretokenized_files
+from utils.teacher_cache import TeacherTopKWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dump the top-k teacher probabilities of pre-tokenized MLM data")
+    parser.add_argument(
+        "--pretokenized_data_dir",
+        type=str,
+        required=True,
+        help="directory with the hdf5 shards or the .bin token memmaps, as for train_mlm.py",
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        default="train",
+        help="train or validation",
+    )
+    parser.add_argument(
+        "--teacher_model_path",
+        type=str,
+        required=True,
+        help="path to the fixed teacher model",
+    )
+    parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default="bert-base-uncased",
+        help="tokenizer of the pre-tokenized data",
+    )
+    parser.add_argument(
+        "--output_prefix",
+        type=str,
+        required=True,
+        help="prefix of the teacher cache files",
+    )
+    parser.add_argument(
+        "--topk",
+        type=int,
+        default=8,
+        help="number of probabilities kept per token",
+    )
+    parser.add_argument(
+        "--mlm_probability",
+        type=float,
+        default=0.15,
+        help="ratio of tokens to mask, the same as for train_mlm.py",
+    )
+    parser.add_argument(
+        "--mask_seed",
+        type=int,
+        default=0,
+        help="seed of the static masks of the rows, stored in the cache for train_mlm.py",
+    )
+    parser.add_argument(
+        "--max_seq_length",
+        type=int,
+        default=128,
+        help="sequence length of a .bin token memmap",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="rows per teacher forward",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+    dataset = PretokenizedMLMDataset(
+        find_pretokenized_files(args.pretokenized_data_dir, args.split),
+        tokenizer,
+        mlm_probability=args.mlm_probability,
+        max_seq_length=args.max_seq_length,
+        static_mask_seed=args.mask_seed,
+    )
+
+    teacher_config = get_supertransformer_config(args.teacher_model_path, mixing="attention")
+    teacher_model = custom_bert.BertForMaskedLM.from_pretrained(args.teacher_model_path, config=teacher_config)
+    teacher_model.set_sample_config(teacher_config, drop_layers=False)
+    teacher_model.to(device)
+    teacher_model.eval()
+
+    # rows are dumped in order, so the (sorted) batches of ShardedBatchSampler are read front to back
+    writer = TeacherTopKWriter(
+        args.output_prefix,
+        args.topk,
+        len(dataset),
+        meta={"mask_seed": args.mask_seed, "mlm_probability": args.mlm_probability},
+    )
+    for start in tqdm(range(0, len(dataset), args.batch_size)):
+        rows = list(range(start, min(start + args.batch_size, len(dataset))))
+        # the inputs of the student: masked with the static masks of the rows
+        input_ids, attention_mask, token_type_ids, _ = dataset.masked_rows(rows)
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=device.type == "cuda"):
+            logits = teacher_model(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                token_type_ids=token_type_ids.to(device),
+            ).logits
+        topk_prob, topk_idx = torch.softmax(logits.float(), dim=-1).topk(args.topk, dim=-1)
+        writer.add(rows, topk_idx.int().cpu().numpy(), topk_prob.half().cpu().numpy())
+    writer.close()
+    print("dumped the top-%d teacher probabilities of %d rows (%d tokens) to %s" % (args.topk, len(dataset), writer.num_tokens, args.output_prefix))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,13 @@ our evolutionary search
 
 import time, sys, os, datasets, random, copy, xlwt, json
 import argparse
+import contextlib
 from sampling import get_supertransformer_config
 import transformers
 from transformers import DataCollatorWithPadding
 from transformers import AutoTokenizer, DataCollatorForLanguageModeling, set_seed, AutoConfig, PretrainedConfig, BertConfig
 from custom_layers import custom_bert
+from custom_layers.custom_linear import CustomLinear
 import torch
 from torch.utils.data.dataloader import DataLoader
 from datasets import load_metric, load_dataset
@@ -20,6 +22,9 @@ from tqdm.auto import tqdm
 from utils.module_proxy_wrapper import ModuleProxyWrapper
 from sampling import Sampler
 from utils import calculate_params_from_config
+from utils.fitness_cache import FitnessCache, checkpoint_digest, subnet_config_dict
+from utils.successive_halving import SuccessiveHalving
+from utils.parallel_fitness import FitnessWorkerPool
 import numpy as np
 from xlrd import open_workbook
 from torchinfo import summary
@@ -30,8 +35,29 @@ def convert_to_dict(string):
     )
     return BertConfig(**_dict)
 
+@contextlib.contextmanager
+def sample_caches(model, enabled):
+    """
+    switches the materialized arch experts and the frozen CustomLinear slices on or off, every module is restored on exit.
+    set_sample_config drops both, and the inverted fitness loops set every subnet again on every batch:
+    with a single forward per (batch, subnet), baking them would only add a copy of the weights
+    """
+    layers = [(m, m.materialize_experts) for m in model.modules() if isinstance(m, custom_bert.BertLayer)]
+    linears = [(m, m.frozen_samples) for m in model.modules() if isinstance(m, CustomLinear)]
+    for m, mode in layers:
+        m.materialize_arch_experts(mode and enabled)
+    for m, mode in linears:
+        m.freeze_samples(mode and enabled)
+    try:
+        yield
+    finally:
+        for m, mode in layers:
+            m.materialize_arch_experts(mode)
+        for m, mode in linears:
+            m.freeze_samples(mode)
+
 class EvoSearch:
-    def __init__(self, args):
+    def __init__(self, args, evaluator_only=False):
         
         # evo-search hyperparams
         self.population_size = args.population_size
@@ -69,6 +95,10 @@ class EvoSearch:
         self.bert_backbone = args.bert_backbone
         self.pad_to_max_length = False
         self.fitness_metric = args.fitness_metric
+        self.successive_halving = args.successive_halving
+        self.sh_min_batches = args.sh_min_batches
+        self.sh_eta = args.sh_eta
+        self.sh_z = args.sh_z
         
         # data
         self.data_dir = args.data_dir
@@ -85,6 +115,20 @@ class EvoSearch:
 
         # prepare fitness function
         self.prepare_fitness_fn_helper()
+        if evaluator_only:
+            # replica of the supernet in a fitness worker, see build_fitness_evaluator
+            return
+
+        # persistent cache of fitness scores across searches
+        self.fitness_cache = None
+        if args.fitness_cache_path:
+            self.fitness_cache = FitnessCache(args.fitness_cache_path, self.fitness_cache_namespace())
+
+        # worker processes holding a replica of the supernet each, the population is then evaluated in parallel
+        self.fitness_pool = None
+        if args.num_fitness_workers > 0:
+            assert self.accelerator.num_processes == 1, "fitness workers replace the distributed evaluation, launch a single process"
+            self.fitness_pool = FitnessWorkerPool(args.num_fitness_workers, build_fitness_evaluator, (args,))
 
         # check fitness score of supernet
         global_metrics = self.fitness_score(self.global_config, track_progress=True)
@@ -147,6 +191,10 @@ class EvoSearch:
         self.global_config = AutoConfig.from_pretrained(self.supernet_ckpt_dir, num_labels=num_labels, finetuning_task=self.finetune)
         self.global_config.num_labels = num_labels
         self.model = custom_bert.BertForSequenceClassification.from_pretrained(self.supernet_ckpt_dir, config=self.global_config)
+        # the supernet is only evaluated during search, so bake the arch-routed experts and the
+        # (contiguous) sampled weight slices once per candidate
+        self.model.materialize_arch_experts()
+        self.model.freeze_samples()
 
         # Some models have set the order of the labels to use, so let's make sure we do use it.
         label_to_id = None
@@ -237,7 +285,7 @@ class EvoSearch:
             print(f"Sample {index} of the training set: {eval_dataset[index]}.")
 
         # load supernet config
-        self.global_config = get_supertransformer_config(self.bert_backbone, mixing=self.mixing, search_space_id=self.search_space_id, max_experts=args.max_experts, expert_routing_type=args.expert_routing_type, hypernet_hidden_size=self.hypernet_hidden_size)
+        self.global_config = get_supertransformer_config(self.bert_backbone, mixing=self.mixing, search_space_id=self.search_space_id, max_experts=self.max_experts, expert_routing_type=self.expert_routing_type, hypernet_hidden_size=self.hypernet_hidden_size)
         # set defaults like max_seq_length
         self.global_config.max_seq_length = self.max_seq_length
         self.global_config.alpha_divergence = 0
@@ -247,6 +295,10 @@ class EvoSearch:
 
         # create model
         self.model = custom_bert.BertForMaskedLM.from_pretrained(self.supernet_ckpt_dir, config=self.global_config)
+        # the supernet is only evaluated during search, so bake the arch-routed experts and the
+        # (contiguous) sampled weight slices once per candidate
+        self.model.materialize_arch_experts()
+        self.model.freeze_samples()
 
         '''
         # trial: set expert 2
@@ -276,11 +328,47 @@ class EvoSearch:
         # cache for evaluations
         self.config_cache = {}
     
+    def fitness_cache_namespace(self):
+        # everything besides the subnet config that the fitness depends on
+        return {
+            "checkpoint": checkpoint_digest(self.supernet_ckpt_dir),
+            "data": self.finetune if self.finetune else os.path.abspath(self.data_dir),
+            "max_seq_length": self.max_seq_length,
+            "per_device_eval_batch_size": self.per_device_eval_batch_size,
+            "num_processes": self.accelerator.num_processes,
+            "num_batches": self.num_batches,
+            "seed": self.seed,
+            "fitness_metric": self.fitness_metric,
+            # the same subnet config is a different model under another supernet layout or expert routing
+            "bert_backbone": self.bert_backbone,
+            "mixing": self.mixing,
+            "search_space_id": self.search_space_id,
+            "use_hypernet_w_low_rank": self.use_hypernet_w_low_rank,
+            "bottleneck_rank": self.bottleneck_rank,
+            "hypernet_hidden_size": self.hypernet_hidden_size,
+            "max_experts": self.max_experts,
+            "expert_routing_type": self.expert_routing_type,
+            "last_expert_averaging_expert": self.last_expert_averaging_expert,
+        }
+
     def fitness_score(self, bert_config, hashcode=None, track_progress=False):
+        if hashcode and hashcode in self.config_cache:
+            return self.config_cache[hashcode]
+        if self.fitness_cache is not None:
+            eval_metric = self.fitness_cache.get(subnet_config_dict(bert_config))
+            if eval_metric is not None:
+                if hashcode:
+                    self.config_cache[hashcode] = eval_metric
+                return eval_metric
+
         if self.finetune:
-            return self.fitness_finetune_score(bert_config, hashcode=hashcode, track_progress=track_progress)
+            eval_metric = self.fitness_finetune_score(bert_config, hashcode=hashcode, track_progress=track_progress)
         else:
-            return self.fitness_pretrain_score(bert_config, hashcode=hashcode, track_progress=track_progress)
+            eval_metric = self.fitness_pretrain_score(bert_config, hashcode=hashcode, track_progress=track_progress)
+
+        if self.fitness_cache is not None and self.accelerator.is_main_process:
+            self.fitness_cache.put(subnet_config_dict(bert_config), eval_metric)
+        return eval_metric
 
     def fitness_finetune_score(self, bert_config, hashcode=None, track_progress=False):
         if hashcode and hashcode in self.config_cache:
@@ -419,8 +507,8 @@ class EvoSearch:
             cur_time = time.time()
 
         try:
-            val_loss = torch.mean(losses)
-            perplexity = math.exp(torch.mean(losses))
+            val_loss = torch.mean(losses).item()
+            perplexity = math.exp(val_loss)
         except OverflowError:
             perplexity = float("inf")
         if timer_set:
@@ -434,6 +522,156 @@ class EvoSearch:
 
         return eval_metric
 
+    def fitness_scores(self, bert_configs, hashcodes, track_progress=False, keep_size=None):
+        # cached subnets are skipped, the rest share every pass over the eval set
+        eval_metrics = [None for _ in bert_configs]
+        for i, (bert_config, hashcode) in enumerate(zip(bert_configs, hashcodes)):
+            if hashcode in self.config_cache:
+                eval_metrics[i] = self.config_cache[hashcode]
+            elif self.fitness_cache is not None:
+                eval_metrics[i] = self.fitness_cache.get(subnet_config_dict(bert_config))
+                if eval_metrics[i] is not None:
+                    self.config_cache[hashcode] = eval_metrics[i]
+        missing = [i for i, eval_metric in enumerate(eval_metrics) if eval_metric is None]
+        if len(missing) > 0 and self.fitness_pool is not None:
+            # one subnet per worker, the metrics are cached as the workers complete them
+            if track_progress:
+                progress_bar = tqdm(range(len(missing)))
+            for j, eval_metric in self.fitness_pool.imap_unordered([bert_configs[i] for i in missing]):
+                i = missing[j]
+                eval_metrics[i] = eval_metric
+                self.config_cache[hashcodes[i]] = eval_metric
+                if self.fitness_cache is not None:
+                    self.fitness_cache.put(subnet_config_dict(bert_configs[i]), eval_metric)
+                if track_progress:
+                    progress_bar.update(1)
+            if track_progress:
+                progress_bar.close()
+        elif len(missing) > 0:
+            missing_configs = [bert_configs[i] for i in missing]
+            if self.finetune:
+                missing_metrics = self.fitness_finetune_scores(missing_configs, track_progress=track_progress)
+            else:
+                missing_metrics = self.fitness_pretrain_scores(missing_configs, track_progress=track_progress, keep_size=keep_size)
+            for i, eval_metric in zip(missing, missing_metrics):
+                eval_metrics[i] = eval_metric
+                # metrics of subnets pruned by successive halving only hold for this population
+                if "pruned_at_batches" not in eval_metric:
+                    self.config_cache[hashcodes[i]] = eval_metric
+                    if self.fitness_cache is not None and self.accelerator.is_main_process:
+                        self.fitness_cache.put(subnet_config_dict(bert_configs[i]), eval_metric)
+        return eval_metrics
+
+    def fitness_finetune_scores(self, bert_configs, track_progress=False):
+        # loops inverted w.r.t. fitness_finetune_score: each batch is loaded once and run through all the subnets
+        self.model.eval()
+        all_predictions = [[] for _ in bert_configs]
+        all_references = []
+        if track_progress:
+            progress_bar = tqdm(range(0, len(self.eval_dataloader)), disable=not self.accelerator.is_local_main_process)
+        sampled = None
+        with sample_caches(self.model, enabled=len(bert_configs) == 1):
+            for step, batch in enumerate(self.eval_dataloader):
+                all_references.append(self.accelerator.gather(batch["labels"]))
+                for ci, bert_config in enumerate(bert_configs):
+                    if ci != sampled:
+                        self.model.set_sample_config(bert_config, drop_layers=False)
+                        sampled = ci
+                    with torch.no_grad():
+                        outputs = self.model(**batch)
+                    predictions = outputs.logits.argmax(dim=-1) if not self.finetune == "stsb" else outputs.logits.squeeze()
+                    all_predictions[ci].append(self.accelerator.gather(predictions))
+                if track_progress:
+                    progress_bar.update(1)
+        if track_progress:
+            progress_bar.close()
+
+        references = torch.cat(all_references)
+        eval_metrics = []
+        for predictions in all_predictions:
+            eval_metric = self.metric.compute(predictions=torch.cat(predictions), references=references)
+            if "accuracy" in eval_metric:
+                eval_metric["accuracy"] = 100.0*eval_metric["accuracy"]
+            eval_metrics.append(eval_metric)
+        return eval_metrics
+
+    def fitness_pretrain_scores(self, bert_configs, track_progress=False, keep_size=None):
+        # loops inverted w.r.t. fitness_pretrain_score: each batch is loaded (and masked) once and run through all the subnets
+        self.model.eval()
+        halving = None
+        if self.successive_halving == "yes" and keep_size:
+            halving = SuccessiveHalving(len(bert_configs), keep_size, min_batches=self.sh_min_batches, eta=self.sh_eta, z=self.sh_z, higher_is_better=self.fitness_metric == "accuracy")
+        active = list(range(len(bert_configs)))
+        losses = [[] for _ in bert_configs]
+        # mlm accuracy is counted on device instead of going through the string-based metric
+        correct = [0 for _ in bert_configs]
+        total = [0 for _ in bert_configs]
+        if track_progress:
+            progress_bar = tqdm(range(0, len(self.eval_dataloader)), disable=not self.accelerator.is_local_main_process)
+        sampled = None
+        with sample_caches(self.model, enabled=len(bert_configs) == 1):
+            for step, batch in enumerate(self.eval_dataloader):
+                if self.fitness_metric == "accuracy":
+                    labels = batch["labels"]
+                    if (not self.pad_to_max_length):  # necessary to pad predictions and labels for being gathered
+                        labels = self.accelerator.pad_across_processes(labels, dim=1, pad_index=-100)
+                    labels_gathered = self.accelerator.gather(labels)
+                    is_masked = labels_gathered != -100
+                    num_masked = is_masked.sum().item()
+                for ci in active:
+                    if ci != sampled:
+                        self.model.set_sample_config(bert_configs[ci], drop_layers=False)
+                        sampled = ci
+                    with torch.no_grad():
+                        outputs = self.model(**batch)
+                    losses[ci].append(self.accelerator.gather(outputs.loss.repeat(self.per_device_eval_batch_size)))
+                    if self.fitness_metric == "accuracy":
+                        predictions = outputs.logits.argmax(dim=-1)
+                        if (not self.pad_to_max_length):
+                            predictions = self.accelerator.pad_across_processes(predictions, dim=1, pad_index=-100)
+                        predictions_gathered = self.accelerator.gather(predictions)
+                        batch_correct = ((predictions_gathered == labels_gathered) & is_masked).sum().item()
+                        correct[ci] += batch_correct
+                        total[ci] += num_masked
+                        if halving is not None and num_masked > 0:
+                            halving.add(ci, batch_correct / num_masked, weight=num_masked)
+                    elif halving is not None:
+                        # ppl is monotonic in the loss
+                        halving.add(ci, losses[ci][-1].mean().item(), weight=losses[ci][-1].numel())
+                if halving is not None:
+                    active = halving.step(step + 1)
+                if track_progress:
+                    progress_bar.update(1)
+                if self.num_batches != -1 and step >= self.num_batches:
+                    break
+        if track_progress:
+            progress_bar.close()
+
+        eval_metrics = []
+        for ci in range(len(bert_configs)):
+            eval_metric = {}
+            if self.fitness_metric == "accuracy":
+                # no masked token in the eval batches run: no evidence, lowest accuracy
+                eval_metric["accuracy"] = correct[ci] / total[ci] if total[ci] > 0 else 0.0
+            config_losses = torch.cat(losses[ci])[:self.dataset_len]
+            # float like fitness_pretrain_score, whichever path (single, pooled or worker) scored the subnet
+            val_loss = torch.mean(config_losses).item()
+            try:
+                perplexity = math.exp(val_loss)
+            except OverflowError:
+                perplexity = float("inf")
+            eval_metric["val_loss"] = val_loss
+            eval_metric["perplexity"] = perplexity
+            if halving is not None and halving.is_pruned(ci):
+                # pruned subnets can never be selected over the ones run on all batches
+                eval_metric["partial_" + self.fitness_metric] = eval_metric[self.fitness_metric]
+                eval_metric[self.fitness_metric] = halving.selection_score(ci)
+                eval_metric["pruned_at_batches"] = halving.pruned_at[ci]
+            eval_metrics.append(eval_metric)
+        if halving is not None and self.accelerator.is_main_process:
+            print("successive halving: %d/%d subnets evaluated on all batches, %d/%d subnet-batches run"%(len(active), len(bert_configs), sum(halving.num_batches), len(bert_configs)*max(halving.num_batches)))
+        return eval_metrics
+
     # def convert_feature_to_hash(self, feature_config):
     #     return ("-".join([str(feat) for feat in feature_config]))
 
@@ -616,17 +854,14 @@ class EvoSearch:
 
     def get_scores(self, genes):
         scores = []
-        progress_bar = tqdm(range(0, len(genes)), disable=not self.accelerator.is_local_main_process)
-        for gene in genes:
-            metrics = self.fitness_score(gene["arch_config"], hashcode=str(gene["feat_config"]), track_progress=False)
+        all_metrics = self.fitness_scores([gene["arch_config"] for gene in genes], [str(gene["feat_config"]) for gene in genes], track_progress=True, keep_size=self.parent_size)
+        for gene, metrics in zip(genes, all_metrics):
             gene['metrics'] = metrics
             scores.append(gene)
             assert(len(gene)==3)
             assert(isinstance(gene["metrics"], dict))
             assert(isinstance(gene["arch_config"],  transformers.models.bert.configuration_bert.BertConfig))
             assert(isinstance(gene["feat_config"], list))
-            progress_bar.update(1)
-        progress_bar.close()
         return scores
     
     def random_sample(self):
@@ -661,7 +896,7 @@ class EvoSearch:
         return self.random_expert_croppings()
     
     def random_expert_croppings(self):
-        rb = open_workbook(args.fixed_arch, formatting_info=True)
+        rb = open_workbook(self.fixed_arch, formatting_info=True)
         best_config_sheet = rb.sheet_by_name("best_config")
         print("Fixed Subnet info: Model-Size=%s, Val-PPL=%s"%(best_config_sheet.cell(2, 1).value, best_config_sheet.cell(3, 1).value))
         print("Fixed Subnet info: Gene=%s"%(best_config_sheet.cell(1, 1).value))
@@ -977,6 +1212,48 @@ def parse_args():
         help="Directory to write pareto front and best config",
     )
 
+    # persistent fitness cache
+    parser.add_argument(
+        "--fitness_cache_path",
+        type=str,
+        default=None,
+        help="sqlite file to persist the fitness of evaluated subnets across searches (keyed by subnet config, checkpoint and eval set)",
+    )
+
+    # parallel fitness evaluation
+    parser.add_argument(
+        "--num_fitness_workers",
+        type=int,
+        default=0,
+        help="evaluate the population in this many worker processes, each with its own supernet replica (one gpu each when available, else cpu); 0 evaluates in the search process",
+    )
+
+    # successive halving
+    parser.add_argument(
+        "--successive_halving",
+        type=str,
+        default="no",
+        help="evaluate the population with successive halving over the eval batches (pretraining fitness only)",
+    )
+    parser.add_argument(
+        "--sh_min_batches",
+        type=int,
+        default=8,
+        help="number of eval batches every subnet is run on before the first pruning",
+    )
+    parser.add_argument(
+        "--sh_eta",
+        type=float,
+        default=2,
+        help="successive halving keeps the best 1/eta subnets at each rung",
+    )
+    parser.add_argument(
+        "--sh_z",
+        type=float,
+        default=1.96,
+        help="z-value of the confidence interval used to prune subnets against the parent cutoff",
+    )
+
     # finetune vs. pretraining accuracy
     parser.add_argument(
         "--finetune",
@@ -990,9 +1267,25 @@ def parse_args():
 
     return args
 
+def build_fitness_evaluator(args):
+    # runs in every fitness worker: load the supernet once, then score one subnet per call
+    evaluator = EvoSearch(args, evaluator_only=True)
+
+    def evaluate(bert_config):
+        if evaluator.finetune:
+            eval_metric = evaluator.fitness_finetune_score(bert_config)
+        else:
+            eval_metric = evaluator.fitness_pretrain_score(bert_config)
+        # tensors (e.g. val_loss) are sent back to the search process as floats
+        return {k: float(v) if torch.is_tensor(v) else v for k, v in eval_metric.items()}
+
+    return evaluate
+
 def search(args):
     evolution = EvoSearch(args)
     evolution.run_evo_search()
+    if evolution.fitness_pool is not None:
+        evolution.fitness_pool.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+"""
+Export a searched subnet of a trained MoS supernet as a standalone dense model:
+the hypernet-mixed experts are folded into a single FFN per layer and all
+CustomLinear/CustomEmbedding layers are replaced by plain modules of the
+sampled dims (see get_active_subnet).
+"""
+import argparse
+import json
+import os
+from copy import deepcopy
+
+import torch
+from transformers import AutoConfig, BertConfig
+from xlrd import open_workbook
+
+from custom_layers import custom_bert
+
+
+# config attributes that only describe the arch experts of the supernet
+MOS_CONFIG_ATTRS = ["max_experts", "expert_routing_type", "last_expert_averaging_expert", "sample_expert_ids", "fixed_hypernet_input", "hypernet_hidden_size", "hypernet_input_format"]
+
+
+def convert_to_dict(string):
+    _dict = json.loads(
+        string.replace("BertConfig ", "").replace("\n", "").replace('""', '"')
+    )
+    return BertConfig(**_dict)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a subnet of a MoS supernet as a standalone dense model")
+    parser.add_argument(
+        "--model_name_or_path",
+        type=str,
+        required=True,
+        help="Path to the supernet checkpoint.",
+    )
+    parser.add_argument(
+        "--subtransformer_config_path",
+        type=str,
+        required=True,
+        help="Path to the best config (xls) written by the evolutionary search.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Where to store the exported subnet.",
+    )
+    parser.add_argument(
+        "--max_seq_length",
+        type=int,
+        default=128,
+        help="Sequence length used to check the exported subnet against the supernet.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def export_subnet(model, subnet_config):
+    """Returns the dense subnet of `model` for `subnet_config`, with the arch experts blended into its FFNs."""
+    model.eval()
+    model.set_sample_config(subnet_config, drop_layers=False)
+
+    dense_config = deepcopy(subnet_config)
+    for attr in MOS_CONFIG_ATTRS:
+        if hasattr(dense_config, attr):
+            delattr(dense_config, attr)
+    dense_config.num_hidden_layers = dense_config.sample_num_hidden_layers
+
+    subnet = model.get_active_subnet(dense_config)
+    subnet.eval()
+    return subnet, dense_config
+
+
+def main():
+    args = parse_args()
+
+    rb = open_workbook(args.subtransformer_config_path, formatting_info=True)
+    best_config_sheet = rb.sheet_by_name("best_config")
+    print("Subnet info: Model-Size=%s, Val-PPL=%s"%(best_config_sheet.cell(2, 1).value, best_config_sheet.cell(3, 1).value))
+    print("Subnet info: Gene=%s"%(best_config_sheet.cell(1, 1).value))
+    subnet_config = convert_to_dict(best_config_sheet.cell(4, 1).value)
+
+    # the supernet has to be built with the expert layers it was trained with
+    config = AutoConfig.from_pretrained(args.model_name_or_path)
+    for attr in MOS_CONFIG_ATTRS:
+        if hasattr(config, attr):
+            setattr(subnet_config, attr, getattr(config, attr))
+    subnet_config.layer_drop_prob = 0.0
+
+    model = custom_bert.BertForMaskedLM.from_pretrained(args.model_name_or_path, config=subnet_config)
+    subnet, dense_config = export_subnet(model, subnet_config)
+
+    super_params = sum(p.numel() for p in model.parameters())
+    subnet_params = sum(p.numel() for p in subnet.parameters())
+    print("supernet params: %d, subnet params: %d (%.2fx smaller)"%(super_params, subnet_params, super_params / subnet_params))
+
+    # the exported subnet has to reproduce the sampled supernet
+    input_ids = torch.randint(0, subnet_config.vocab_size, (2, args.max_seq_length))
+    with torch.no_grad():
+        super_logits = model(input_ids=input_ids).logits
+        subnet_logits = subnet(input_ids=input_ids).logits
+    print("max abs diff of the mlm logits: %.3e"%((super_logits - subnet_logits).abs().max().item()))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    # the subnet modules no longer match the super dims in the config, so the whole module is saved
+    torch.save(subnet, os.path.join(args.output_dir, "subnet.pt"))
+    dense_config.to_json_file(os.path.join(args.output_dir, "config.json"))
+    print("exported subnet to %s"%(args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
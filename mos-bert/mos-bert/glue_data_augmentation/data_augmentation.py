@@ -24,6 +24,8 @@ import re
 import logging
 import csv
 import argparse
+import shutil
+import multiprocessing as mp
 
 
 import torch
@@ -290,9 +292,79 @@ def prepare_embedding_retrieval(glove_file, vocab_size=100000):
     return emb_norm, vocab, ids_to_tokens
 
 
+def _top_m(sims, M):
+    # argpartition is linear in the vocab size, only the M selected ids are sorted
+    M = min(M, sims.shape[-1] - 1)
+    top = np.argpartition(-sims, M - 1, axis=-1)[..., :M]
+    order = np.argsort(-np.take_along_axis(sims, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+def build_neighbor_table(emb_norm, M, chunk_size=2048):
+    """ids of the M nearest (cosine) words of every word, computed chunk by chunk in float32"""
+    emb = np.nan_to_num(emb_norm).astype(np.float32)
+    # words without a vector (<unk>) are never candidates, as their similarities are nan
+    invalid = ~np.isfinite(emb_norm).all(axis=1)
+    table = np.empty((emb.shape[0], min(M, emb.shape[0] - 1)), dtype=np.int32)
+    for start in tqdm(range(0, emb.shape[0], chunk_size), desc="glove neighbors"):
+        sims = emb[start : start + chunk_size] @ emb.T
+        rows = np.arange(sims.shape[0])
+        sims[rows, start + rows] = -np.inf
+        sims[:, invalid] = -np.inf
+        table[start : start + chunk_size] = _top_m(sims, M)
+    return table
+
+
+def load_or_build_neighbor_table(emb_norm, M, cache_file=None):
+    """the table only depends on the glove file and M, so it is cached across tasks and runs"""
+    if cache_file is not None and os.path.exists(cache_file):
+        table = np.load(cache_file)
+        if table.shape[0] == emb_norm.shape[0] and table.shape[1] >= M:
+            return table[:, :M]
+    table = build_neighbor_table(emb_norm, M)
+    if cache_file is not None:
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            np.save(f, table)
+        os.replace(tmp_file, cache_file)
+    return table
+
+
+def _word_piece_ids(word_pieces, mask_token_idx):
+    """positions of the word pieces of the mask_token_idx-th word, word_pieces starts with [CLS]"""
+    word_piece_ids = []
+    token_idx = -1
+    for i in range(1, len(word_pieces)):
+        if "##" not in word_pieces[i]:
+            token_idx = token_idx + 1
+            if token_idx < mask_token_idx:
+                word_piece_ids = []
+            elif token_idx == mask_token_idx:
+                word_piece_ids = [i]
+            else:
+                break
+        else:
+            word_piece_ids.append(i)
+    return word_piece_ids
+
+
 class DataAugmentor(object):
-    def __init__(self, model, tokenizer, emb_norm, vocab, ids_to_tokens, M, N, p):
-        self.model = model
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        emb_norm,
+        vocab,
+        ids_to_tokens,
+        M,
+        N,
+        p,
+        neighbors=None,
+        batch_size=32,
+        device=device,
+    ):
+        self.device = device
+        self.model = model.to(device)
         self.tokenizer = tokenizer
         self.emb_norm = emb_norm
         self.vocab = vocab
@@ -300,31 +372,35 @@ class DataAugmentor(object):
         self.M = M
         self.N = N
         self.p = p
+        # precomputed top-M glove neighbors (build_neighbor_table), else searched word by word
+        self.neighbors = neighbors
+        # masked sentences per BERT forward, bounded by the batch x length x vocab logits
+        self.batch_size = batch_size
 
     def _word_distance(self, word):
         if word not in self.vocab.keys():
             return []
         word_idx = self.vocab[word]
-        word_emb = self.emb_norm[word_idx]
 
-        dist = np.dot(self.emb_norm, word_emb.T)
-        dist[word_idx] = -np.Inf
-
-        candidate_ids = np.argsort(-dist)[: self.M]
+        if self.neighbors is not None:
+            candidate_ids = self.neighbors[word_idx][: self.M]
+        else:
+            dist = np.dot(self.emb_norm, self.emb_norm[word_idx])
+            dist[word_idx] = -np.inf
+            candidate_ids = _top_m(dist, self.M)
         candidate_words = [self.ids_to_tokens[idx] for idx in candidate_ids][: self.M]
         if word.istitle():
             # capitialize the first letter of each word to preserve case
             candidate_words = [w.title() for w in candidate_words]
         return candidate_words
 
-    def _masked_language_model(self, sent, word_pieces, mask_id):
-        if mask_id >= 512:
-            return []
-        tokenized_text = self.tokenizer.tokenize(sent)
-        tokenized_text = ["[CLS]"] + tokenized_text
-        tokenized_len = len(tokenized_text)
+    def _mlm_inputs(self, word_pieces, mask_id):
+        """token and segment ids of the sentence with its mask_id-th piece masked, followed by the sentence"""
+        tokenized_len = len(word_pieces)
+        masked_pieces = list(word_pieces)
+        masked_pieces[mask_id] = "[MASK]"
 
-        tokenized_text = word_pieces + ["[SEP]"] + tokenized_text[1:] + ["[SEP]"]
+        tokenized_text = masked_pieces + ["[SEP]"] + word_pieces[1:] + ["[SEP]"]
 
         if len(tokenized_text) > 512:
             tokenized_text = tokenized_text[:512]
@@ -335,62 +411,47 @@ class DataAugmentor(object):
         segments_ids = [0] * (tokenized_len + 1) + [1] * (
             len(tokenized_text) - tokenized_len - 1
         )
-        tokens_tensor = torch.tensor([token_ids]).to(device)
-        segments_tensor = torch.tensor([segments_ids]).to(device)
-
-        self.model.to(device)
-
-        predictions = self.model(tokens_tensor, segments_tensor)
-
-        word_candidates = torch.argsort(predictions[0, mask_id], descending=True)[
-            : self.M
-        ].tolist()
-        word_candidates = self.tokenizer.convert_ids_to_tokens(word_candidates)
-
-        return list(filter(lambda x: x.find("##"), word_candidates))
-
-    def _word_augment(self, sentence, mask_token_idx, mask_token):
-        word_pieces = self.tokenizer.tokenize(sentence)
-        word_pieces = ["[CLS]"] + word_pieces
-        tokenized_len = len(word_pieces)
-
-        token_idx = -1
-        for i in range(1, tokenized_len):
-            if "##" not in word_pieces[i]:
-                token_idx = token_idx + 1
-                if token_idx < mask_token_idx:
-                    word_piece_ids = []
-                elif token_idx == mask_token_idx:
-                    word_piece_ids = [i]
-                else:
-                    break
-            else:
-                word_piece_ids.append(i)
-
-        if len(word_piece_ids) == 1:
-            word_pieces[word_piece_ids[0]] = "[MASK]"
-            candidate_words = self._masked_language_model(
-                sentence, word_pieces, word_piece_ids[0]
+        return token_ids, segments_ids
+
+    @torch.no_grad()
+    def _masked_language_model(self, requests):
+        """
+        candidate words of a list of (token_ids, segments_ids, mask_id), which may come from
+        different sentences. requests are sorted by length and padded into batches.
+        """
+        candidates = [None] * len(requests)
+        order = sorted(range(len(requests)), key=lambda i: len(requests[i][0]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            max_len = max(len(requests[i][0]) for i in batch)
+
+            tokens_tensor = torch.zeros((len(batch), max_len), dtype=torch.long)
+            segments_tensor = torch.zeros_like(tokens_tensor)
+            attention_mask = torch.zeros_like(tokens_tensor)
+            for row, i in enumerate(batch):
+                token_ids, segments_ids, _ = requests[i]
+                tokens_tensor[row, : len(token_ids)] = torch.tensor(token_ids)
+                segments_tensor[row, : len(segments_ids)] = torch.tensor(segments_ids)
+                attention_mask[row, : len(token_ids)] = 1
+            mask_ids = torch.tensor([requests[i][2] for i in batch], device=self.device)
+
+            predictions = self.model(
+                tokens_tensor.to(self.device),
+                segments_tensor.to(self.device),
+                attention_mask=attention_mask.to(self.device),
             )
-        elif len(word_piece_ids) > 1:
-            candidate_words = self._word_distance(mask_token)
-        else:
-            logger.info("invalid input sentence!")
+            predictions = predictions[torch.arange(len(batch), device=self.device), mask_ids]
 
-        if len(candidate_words) == 0:
-            candidate_words.append(mask_token)
+            word_candidates = predictions.topk(self.M, dim=-1).indices.tolist()
+            for i, ids in zip(batch, word_candidates):
+                words = self.tokenizer.convert_ids_to_tokens(ids)
+                candidates[i] = list(filter(lambda x: x.find("##"), words))
 
-        return candidate_words
+        return candidates
 
-    def augment(self, sent):
+    def _sample_sentences(self, sent, tokens, candidate_words):
         candidate_sents = [sent]
 
-        tokens = self.tokenizer.basic_tokenizer.tokenize(sent)
-        candidate_words = {}
-        for (idx, word) in enumerate(tokens):
-            if _is_valid(word) and word.lower() not in StopWordsList:
-                candidate_words[idx] = self._word_augment(sent, idx, word)
-        logger.info(candidate_words)
         cnt = 0
         while cnt < self.N:
             new_sent = list(tokens)
@@ -407,12 +468,87 @@ class DataAugmentor(object):
 
         return candidate_sents
 
+    def augment_batch(self, sents):
+        """
+        augment a list of sentences. the masked variants of all the sentences are predicted
+        together, in batches of self.batch_size.
+        """
+        all_tokens, all_candidate_words = [], []
+        requests, request_words = [], []
+        for (sent_idx, sent) in enumerate(sents):
+            tokens = self.tokenizer.basic_tokenizer.tokenize(sent)
+            word_pieces = ["[CLS]"] + self.tokenizer.tokenize(sent)
+
+            candidate_words = {}
+            for (idx, word) in enumerate(tokens):
+                if not _is_valid(word) or word.lower() in StopWordsList:
+                    continue
+                word_piece_ids = _word_piece_ids(word_pieces, idx)
+                candidate_words[idx] = []
+                if len(word_piece_ids) == 1:
+                    if word_piece_ids[0] < 512:
+                        requests.append(
+                            self._mlm_inputs(word_pieces, word_piece_ids[0])
+                            + (word_piece_ids[0],)
+                        )
+                        request_words.append((sent_idx, idx))
+                elif len(word_piece_ids) > 1:
+                    candidate_words[idx] = self._word_distance(word)
+                else:
+                    logger.info("invalid input sentence!")
+
+            all_tokens.append(tokens)
+            all_candidate_words.append(candidate_words)
+
+        for (sent_idx, idx), words in zip(
+            request_words, self._masked_language_model(requests)
+        ):
+            all_candidate_words[sent_idx][idx] = words
+
+        augmented = []
+        for sent, tokens, candidate_words in zip(sents, all_tokens, all_candidate_words):
+            for idx, words in candidate_words.items():
+                if len(words) == 0:
+                    words.append(tokens[idx])
+            logger.info(candidate_words)
+            augmented.append(self._sample_sentences(sent, tokens, candidate_words))
+
+        return augmented
+
+    def augment(self, sent):
+        return self.augment_batch([sent])[0]
+
+
+def build_augmentor(
+    pretrained_bert_model, neighbors, vocab, ids_to_tokens, M, N, p, batch_size, device
+):
+    tokenizer = BertTokenizer.from_pretrained(pretrained_bert_model)
+    model = BertForMaskedLM.from_pretrained(pretrained_bert_model)
+    model.eval()
+
+    return DataAugmentor(
+        model,
+        tokenizer,
+        None,
+        vocab,
+        ids_to_tokens,
+        M,
+        N,
+        p,
+        neighbors=neighbors,
+        batch_size=batch_size,
+        device=device,
+    )
+
 
 class AugmentProcessor(object):
-    def __init__(self, augmentor, glue_dir, task_name):
+    def __init__(self, augmentor, glue_dir, task_name, sentences_per_batch=256, seed=42):
         self.augmentor = augmentor
         self.glue_dir = glue_dir
         self.task_name = task_name
+        # sentences whose masked variants share BERT batches
+        self.sentences_per_batch = sentences_per_batch
+        self.seed = seed
         self.augment_ids = {
             "MRPC": [3, 4],
             "MNLI": [8, 9],
@@ -437,30 +573,118 @@ class AugmentProcessor(object):
 
         assert self.task_name in self.augment_ids
 
-    def read_augment_write(self):
+    def augment_lines(self, lines):
+        augment_ids_ = self.augment_ids[self.task_name]
+        for start in range(0, len(lines), self.sentences_per_batch):
+            batch_lines = lines[start : start + self.sentences_per_batch]
+            augmented = self.augmentor.augment_batch(
+                [line[augment_id] for line in batch_lines for augment_id in augment_ids_]
+            )
+
+            k = 0
+            for line in batch_lines:
+                for augment_id in augment_ids_:
+                    for augment_sent in augmented[k]:
+                        line[augment_id] = augment_sent
+                        yield line
+                    k += 1
+
+    def shard_path(self, shard_dir, shard_id, num_shards):
+        return os.path.join(shard_dir, "shard-%05d-of-%05d.tsv" % (shard_id, num_shards))
+
+    def write_shard(self, lines, shard_path, shard_id):
+        # seeded by shard, so the output does not depend on the workers nor on resuming
+        random.seed(self.seed + shard_id)
+
+        tmp_path = shard_path + ".tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter="\t")
+            for line in self.augment_lines(lines):
+                writer.writerow(line)
+        # a shard only exists once complete, an interrupted one is redone on resume
+        os.replace(tmp_path, shard_path)
+        return shard_id
+
+    def read_augment_write(self, shard_size=10000, num_workers=1, augmentor_kwargs=None):
+        """
+        augment train.tsv shard by shard into train_aug_shards/, then merge the shards into
+        train_aug.tsv. shards already written by an interrupted run are skipped. with
+        num_workers > 1 the shards are augmented by worker processes, each building its
+        own augmentor from augmentor_kwargs (round robin over the gpus).
+        """
         task_dir = os.path.join(self.glue_dir, self.task_name)
         train_samples = _read_tsv(os.path.join(task_dir, "train.tsv"))
         output_filename = os.path.join(task_dir, "train_aug.tsv")
-
-        augment_ids_ = self.augment_ids[self.task_name]
-        filter_flag = self.filter_flags[self.task_name]
+        shard_dir = os.path.join(task_dir, "train_aug_shards")
+        os.makedirs(shard_dir, exist_ok=True)
+
+        header = None
+        if self.filter_flags[self.task_name]:
+            header, train_samples = train_samples[0], train_samples[1:]
+
+        num_shards = max(1, (len(train_samples) + shard_size - 1) // shard_size)
+        shard_paths = [self.shard_path(shard_dir, i, num_shards) for i in range(num_shards)]
+        jobs = [
+            (train_samples[i * shard_size : (i + 1) * shard_size], shard_paths[i], i)
+            for i in range(num_shards)
+            if not os.path.exists(shard_paths[i])
+        ]
+
+        with tqdm(total=num_shards, initial=num_shards - len(jobs), desc="shards") as pbar:
+            if num_workers > 1 and len(jobs) > 0:
+                ctx = mp.get_context("spawn")
+                device_queue = ctx.Queue()
+                for worker_id in range(num_workers):
+                    if torch.cuda.is_available():
+                        device_queue.put("cuda:%d" % (worker_id % torch.cuda.device_count()))
+                    else:
+                        device_queue.put("cpu")
+                num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+                processor_kwargs = {
+                    "glue_dir": self.glue_dir,
+                    "task_name": self.task_name,
+                    "sentences_per_batch": self.sentences_per_batch,
+                    "seed": self.seed,
+                }
+                with ctx.Pool(
+                    min(num_workers, len(jobs)),
+                    initializer=_init_worker,
+                    initargs=(augmentor_kwargs, processor_kwargs, device_queue, num_threads),
+                ) as pool:
+                    for _ in pool.imap_unordered(_write_shard, jobs):
+                        pbar.update()
+            else:
+                for job in jobs:
+                    self.write_shard(*job)
+                    pbar.update()
 
         with open(output_filename, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f, delimiter="\t")
-            for (i, line) in enumerate(tqdm(train_samples)):
-                if i == 0 and filter_flag:
-                    writer.writerow(line)
-                    continue
+            if header is not None:
+                csv.writer(f, delimiter="\t").writerow(header)
+            for shard_path in shard_paths:
+                with open(shard_path, "r", newline="", encoding="utf-8") as shard:
+                    shutil.copyfileobj(shard, f)
+        shutil.rmtree(shard_dir)
+
+
+# augment processor of a worker process, see AugmentProcessor.read_augment_write
+_worker_processor = None
 
-                for augment_id in augment_ids_:
-                    sent = line[augment_id]
-                    augmented_sents = self.augmentor.augment(sent)
-                    for augment_sent in augmented_sents:
-                        line[augment_id] = augment_sent
-                        writer.writerow(line)
 
-                if (i + 1) % 1000 == 0:
-                    logger.info("Having been processing {} examples".format(str(i + 1)))
+def _init_worker(augmentor_kwargs, processor_kwargs, device_queue, num_threads):
+    global _worker_processor
+    worker_device = torch.device(device_queue.get())
+    if worker_device.type == "cuda":
+        torch.cuda.set_device(worker_device)
+    else:
+        torch.set_num_threads(num_threads)
+
+    augmentor = build_augmentor(device=worker_device, **augmentor_kwargs)
+    _worker_processor = AugmentProcessor(augmentor, **processor_kwargs)
+
+
+def _write_shard(job):
+    return _worker_processor.write_shard(*job)
 
 
 def main():
@@ -480,6 +704,12 @@ def main():
         required=True,
         help="Glove word embeddings file",
     )
+    parser.add_argument(
+        "--glove_neighbors_cache",
+        default=None,
+        type=str,
+        help="File (.npy) caching the top-M glove neighbors of every word, reused when it exists",
+    )
     parser.add_argument(
         "--glue_dir", default=None, type=str, required=True, help="GLUE data dir"
     )
@@ -505,6 +735,31 @@ def main():
         type=float,
         help="Threshold probability p to replace current word",
     )
+    parser.add_argument(
+        "--batch_size",
+        default=32,
+        type=int,
+        help="Number of masked sentences per BERT forward",
+    )
+    parser.add_argument(
+        "--sentences_per_batch",
+        default=256,
+        type=int,
+        help="Number of sentences whose masked variants are batched together",
+    )
+    parser.add_argument(
+        "--shard_size",
+        default=10000,
+        type=int,
+        help="Number of train examples per output shard, finished shards are kept when resuming",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=1,
+        type=int,
+        help="Number of worker processes augmenting shards (round robin over the gpus)",
+    )
+    parser.add_argument("--seed", default=42, type=int, help="random seed")
 
     args = parser.parse_args()
     # logger.info(args)
@@ -524,19 +779,41 @@ def main():
         args.N = default_params[args.task_name]["N"]
 
     # Prepare data augmentor
-    tokenizer = BertTokenizer.from_pretrained(args.pretrained_bert_model)
-    model = BertForMaskedLM.from_pretrained(args.pretrained_bert_model)
-    model.eval()
-
     emb_norm, vocab, ids_to_tokens = prepare_embedding_retrieval(args.glove_embs)
     # print(list(vocab.keys())[:50])
-    data_augmentor = DataAugmentor(
-        model, tokenizer, emb_norm, vocab, ids_to_tokens, args.M, args.N, args.p
+    neighbors = load_or_build_neighbor_table(
+        emb_norm, args.M, cache_file=args.glove_neighbors_cache
     )
+    del emb_norm
+
+    augmentor_kwargs = {
+        "pretrained_bert_model": args.pretrained_bert_model,
+        "neighbors": neighbors,
+        "vocab": vocab,
+        "ids_to_tokens": ids_to_tokens,
+        "M": args.M,
+        "N": args.N,
+        "p": args.p,
+        "batch_size": args.batch_size,
+    }
+    # workers build their own augmentor
+    data_augmentor = None
+    if args.num_workers <= 1:
+        data_augmentor = build_augmentor(device=device, **augmentor_kwargs)
 
     # Do data augmentation
-    processor = AugmentProcessor(data_augmentor, args.glue_dir, args.task_name)
-    processor.read_augment_write()
+    processor = AugmentProcessor(
+        data_augmentor,
+        args.glue_dir,
+        args.task_name,
+        sentences_per_batch=args.sentences_per_batch,
+        seed=args.seed,
+    )
+    processor.read_augment_write(
+        shard_size=args.shard_size,
+        num_workers=args.num_workers,
+        augmentor_kwargs=augmentor_kwargs,
+    )
 
 
 if __name__ == "__main__":
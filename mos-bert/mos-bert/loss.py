@@ -59,6 +59,102 @@ def compute_layerwise_distillation(
     return student_akt, student_fkt, layer_wise_akt, layer_wise_fkt
 
 
+def _chunked_logsumexp(logits, temperature, chunk_size):
+    # logsumexp of logits / temperature over the vocabulary, in float32 and without a (N, V) temporary
+    row_max = logits.max(dim=1)[0].float() / temperature
+    sum_exp = torch.zeros_like(row_max)
+    for start in range(0, logits.size(1), chunk_size):
+        sum_exp += torch.exp(logits[:, start : start + chunk_size].float() / temperature - row_max[:, None]).sum(dim=1)
+    return row_max + sum_exp.log()
+
+
+class SoftCrossEntropyFunction(torch.autograd.Function):
+    """
+    per-row soft cross-entropy -sum_v p_teacher(v) log p_student(v) of logits at a temperature, computed in
+    vocabulary chunks. the teacher is dense (N, V) logits or the (values, indices) of its top-k logits (its
+    distribution is then renormalized over the top-k). nothing of size (N, V) besides the student gradient
+    is allocated, the softmaxes are recomputed chunk by chunk in the backward.
+    """
+
+    @staticmethod
+    def forward(ctx, student_logits, teacher_logits, teacher_indices, temperature, chunk_size):
+        student_lse = _chunked_logsumexp(student_logits, temperature, chunk_size)
+        if teacher_indices is None:
+            teacher_lse = _chunked_logsumexp(teacher_logits, temperature, chunk_size)
+            dot = torch.zeros_like(student_lse)
+            for start in range(0, student_logits.size(1), chunk_size):
+                teacher_prob = torch.exp(teacher_logits[:, start : start + chunk_size].float() / temperature - teacher_lse[:, None])
+                dot += (teacher_prob * student_logits[:, start : start + chunk_size].float()).sum(dim=1)
+        else:
+            teacher_lse = None
+            teacher_prob = F.softmax(teacher_logits.float() / temperature, dim=1)
+            dot = (teacher_prob * student_logits.gather(1, teacher_indices).float()).sum(dim=1)
+        ctx.save_for_backward(student_logits, teacher_logits, teacher_indices, student_lse, teacher_lse)
+        ctx.temperature = temperature
+        ctx.chunk_size = chunk_size
+        return student_lse - dot / temperature
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        student_logits, teacher_logits, teacher_indices, student_lse, teacher_lse = ctx.saved_tensors
+        temperature, chunk_size = ctx.temperature, ctx.chunk_size
+        scale = grad_output.float()[:, None] / temperature
+        grad = torch.empty_like(student_logits)
+        for start in range(0, student_logits.size(1), chunk_size):
+            chunk_grad = torch.exp(student_logits[:, start : start + chunk_size].float() / temperature - student_lse[:, None])
+            if teacher_indices is None:
+                chunk_grad -= torch.exp(teacher_logits[:, start : start + chunk_size].float() / temperature - teacher_lse[:, None])
+            grad[:, start : start + chunk_size] = chunk_grad * scale
+        if teacher_indices is not None:
+            teacher_prob = F.softmax(teacher_logits.float() / temperature, dim=1)
+            grad.scatter_add_(1, teacher_indices, (-teacher_prob * scale).to(grad.dtype))
+        return grad, None, None, None, None
+
+
+def teacher_logits_info(logits, labels, topk=0):
+    """
+    teacher_info entries for logits kd, kept only for the masked (labels != -100) positions: the dense
+    (N, V) logits, or their top-k (values, indices) when topk > 0.
+    """
+    mask = labels != -100
+    logits = logits.detach()[mask]
+    if topk > 0:
+        values, indices = logits.topk(topk, dim=1)
+        return {"teacher_mask": mask, "teacher_logits": values, "teacher_indices": indices}
+    return {"teacher_mask": mask, "teacher_logits": logits}
+
+
+def cached_teacher_info(topk_indices, topk_probs, labels, topk=0):
+    """
+    teacher_info entries for logits kd from the per-token top-k probabilities of a teacher cache
+    (utils.teacher_cache), kept for the masked positions like teacher_logits_info. the log-probabilities
+    are the top-k logits: their softmax is the teacher distribution renormalized over the top-k.
+    """
+    mask = labels != -100
+    topk_indices, topk_probs = topk_indices[mask], topk_probs[mask]
+    if 0 < topk < topk_indices.size(1):
+        # the cache keeps the top-k sorted by probability
+        topk_indices, topk_probs = topk_indices[:, :topk], topk_probs[:, :topk]
+    return {"teacher_mask": mask, "teacher_logits": topk_probs.float().log(), "teacher_indices": topk_indices}
+
+
+def logits_distillation_loss(student_logits, teacher_info, temperature=1.0, chunk_size=8192):
+    """mean soft cross-entropy of the student logits w.r.t. the teacher logits of teacher_info, scaled by temperature^2"""
+    teacher_logits = teacher_info["teacher_logits"]
+    if "teacher_mask" in teacher_info:
+        student_logits = student_logits[teacher_info["teacher_mask"]]
+    else:
+        # all positions, e.g. the (batch, num_labels) logits of finetuning
+        student_logits = student_logits.reshape(-1, student_logits.size(-1))
+        teacher_logits = teacher_logits.reshape(-1, teacher_logits.size(-1))
+    if student_logits.size(0) == 0:
+        return student_logits.sum()
+    cross_entropy = SoftCrossEntropyFunction.apply(
+        student_logits, teacher_logits.detach(), teacher_info.get("teacher_indices"), temperature, chunk_size
+    )
+    return cross_entropy.mean() * temperature ** 2
+
+
 def compute_student_loss(
     outputs,
     teacher_info,
@@ -80,20 +176,14 @@ def compute_student_loss(
     losses["student_mlm_loss"] = student_mlm_loss.item()
     
     if (args.distillation_type is not None and "logits" in args.distillation_type) or logits_kd:
-        # compute KL-div of student logits and teacher logits
+        # compute KL-div of student logits and teacher logits (soft cross-entropy, the teacher entropy is a constant)
         # https://raw.githubusercontent.com/liuzechun/ReActNet/master/utils/KD_loss.py
-        student_logits = outputs.logits
-        if student_logits.dim() == 3:
-            student_logits = student_logits.reshape(-1, student_logits.size(2))
-        model_output_log_prob = F.log_softmax(student_logits, dim=1)
-        model_output_log_prob = model_output_log_prob.unsqueeze(2)
-
-        teacher_logits = teacher_info["teacher_logits"]
-        real_output_soft = F.softmax(teacher_logits.reshape(-1, teacher_logits.size(2)) if teacher_logits.dim() == 3 else teacher_logits, dim=1)
-        real_output_soft = real_output_soft.unsqueeze(1)
-
-        cross_entropy_loss = -torch.bmm(real_output_soft, model_output_log_prob)
-        cross_entropy_loss = cross_entropy_loss.mean()
+        cross_entropy_loss = logits_distillation_loss(
+            outputs.logits,
+            teacher_info,
+            temperature=getattr(args, "kd_temperature", 1.0),
+            chunk_size=getattr(args, "kd_vocab_chunk_size", 8192),
+        )
         # overall_loss = cross_entropy_loss * args.inplace_kd_distill_loss_weights
         student_distill_loss = 0.0
         if (args.distillation_type is not None and "hard" in args.distillation_type) and not logits_kd:
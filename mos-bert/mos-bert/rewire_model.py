@@ -61,73 +61,11 @@ from transformers.models.bert.modeling_bert import BertForMaskedLM
 
 from torchinfo import summary
 from utils import rsetattr
+from utils.importance import GradImportance, inverse_permutation
 
 logger = logging.getLogger(__name__)
 
 
-def inverse_permutation(permutation_order):
-    inv = torch.empty_like(permutation_order)
-    inv[permutation_order] = torch.arange(
-        permutation_order.size(0), device=permutation_order.device
-    )
-
-    return inv
-
-
-class BackHook:
-    def __init__(self, max_steps=1000):
-        self.grad_input = {}
-        self.grad_output = {}
-        self.layer_num = 0
-        self.max_steps = max_steps
-        self.steps = 0
-
-    def __call__(self, module, grad_in, grad_out):
-        self.steps += 1
-
-        # mean along the seq_len dimension
-        # different batches have diff seq_lens and hence it ll be easy to deal with them
-        # like stack etc once they are uniform
-        # for idx, out in enumerate(grad_out):
-        #     # print(f"grad_outputs{idx}: {out.shape}")
-
-        # for idx, out in enumerate(grad_in):
-        #     print(f"grad_inputs{idx}: {out.shape}")
-
-        grad_out = torch.mean(torch.abs(grad_out[0]), dim=1)
-        if not hasattr(module, "name"):
-            setattr(module, "name", self.layer_num)
-            # setattr(module, "steps", 0)
-            self.grad_output[self.layer_num] = grad_out
-            self.layer_num += 1
-        else:
-            layer_num = getattr(module, "name")
-            # steps = getattr(module, "steps")
-            # print(f"computing mean for layer {layer_num}")
-            self.grad_output[layer_num] = torch.mean(
-                torch.stack([self.grad_output[layer_num], grad_out]), dim=0
-            )
-            # setattr(module, "steps", steps + 1)
-        if self.steps >= self.max_steps:
-            # logger.info("Max steps achieved")
-            layer_num = getattr(module, "name")
-            grad_output = self.grad_output[layer_num]
-            # logger.info(grad_output.shape)
-            grad_output = grad_output.view(-1, grad_output.shape[-1])
-            grad_output = torch.mean(grad_output, dim=0)
-            importance_order = torch.argsort(grad_output, descending=True)
-            # print(f"steps: {self.steps}, max_steps: {self.max_steps}")
-            # print(
-            #     f"module {module} layer num {layer_num}, imp order {importance_order[:10]}"
-            # )
-            module.register_buffer("importance_order", importance_order)
-            module.register_buffer(
-                "inv_importance_order", inverse_permutation(importance_order)
-            )
-            # logger.info(importance_order)
-            # logger.info()
-
-
 def permute_linear(W, permutation, dim="col", permute_weight=True, permute_bias=False):
     """
     Permute linear layer
@@ -417,6 +355,24 @@ def parse_args():
         default=10000,
         help=f"Number of sentences to use for calculating importance values before rewiring",
     )
+    parser.add_argument(
+        "--importance_token_fraction",
+        type=float,
+        default=1.0,
+        help=f"Fraction of the tokens of every batch (randomly sampled) used for the output importance",
+    )
+    parser.add_argument(
+        "--importance_checkpoint",
+        type=str,
+        default=None,
+        help=f"Path to checkpoint the output importance accumulators to (and resume from)",
+    )
+    parser.add_argument(
+        "--importance_checkpoint_steps",
+        type=int,
+        default=1000,
+        help=f"Checkpoint the output importance accumulators every this many batches",
+    )
     parser.add_argument(
         "--rewire_outputs",
         type=int,
@@ -775,27 +731,51 @@ if __name__ == "__main__":
 
     model.train()
 
+    importance = None
     if args.rewire_outputs:
-        # backhook runs for 2 modules every step. Thats why we run it for global_config.num_hidden_layers * 2
-        # len(train_dataloader) - 1 is the last training step
-        max_steps = (len(train_dataloader) - 1) * global_config.num_hidden_layers * 2
-        # print(f"max_steps: {max_steps}")
-        bhookfn = BackHook(max_steps=max_steps)
-        model.bert.embeddings.word_embeddings.register_backward_hook(bhookfn)
-
+        importance = GradImportance(token_fraction=args.importance_token_fraction)
+        importance_modules = {
+            "bert.embeddings.word_embeddings": model.bert.embeddings.word_embeddings
+        }
         for name, module in model.named_modules():
             if isinstance(module, nn.Linear):
                 # The following keys need to be backhooked:
                 # "bert.encoder.layer.*.attention.output.dense",
                 # "bert.encoder.layer.*.output.dense",
                 if "output.dense" in name:
-                    module.register_backward_hook(bhookfn)
+                    importance_modules[name] = module
+        importance.register(importance_modules)
+
+        importance_checkpoint = args.importance_checkpoint
+        if importance_checkpoint is not None and accelerator.num_processes > 1:
+            importance_checkpoint = f"{importance_checkpoint}.rank{accelerator.process_index}"
+        if importance_checkpoint is not None and os.path.exists(importance_checkpoint):
+            importance.load(importance_checkpoint, device=accelerator.device)
+            logger.info(f"Resuming importance estimation after {importance.steps} batches")
 
     logger.info(f"Calculating gradients with hooks: ")
     for step, batch in enumerate(tqdm(train_dataloader)):
+        if importance is not None and step < importance.steps:
+            # already accumulated, the batch is still drawn to keep the shuffling in sync (with the same --seed)
+            if step == importance.steps - 1:
+                # the rng is now where it was when the checkpoint was saved: the next batches get the masking,
+                # dropout and token sampling of an uninterrupted run
+                importance.restore_rng_state()
+            continue
         outputs = model(**batch)
         loss = outputs.loss
         loss.backward()
+        if importance is not None:
+            importance.steps += 1
+            if importance_checkpoint is not None and importance.steps % args.importance_checkpoint_steps == 0:
+                importance.save(importance_checkpoint)
+
+    if importance is not None:
+        if importance_checkpoint is not None:
+            importance.save(importance_checkpoint)
+        importance.remove()
+        importance.all_reduce()
+        importance.export(importance_modules)
 
     if args.layerwise_importance and args.rewire_outputs:
         emb_importance_order = model.bert.embeddings.word_embeddings.importance_order
@@ -55,6 +55,7 @@ from transformers import (
 from operator import attrgetter
 
 from utils.module_proxy_wrapper import ModuleProxyWrapper
+from utils.pretokenized_data import build_pretokenized_dataloader
 from accelerate import Accelerator, DistributedDataParallelKwargs, DistributedType
 
 from sampling import (
@@ -426,6 +427,14 @@ def parse_args():
         help=f"The directory path for tokenized C4",
     )
 
+    parser.add_argument(
+        "--pretokenized_data_dir",
+        type=str,
+        default=None,
+        help=f"The directory with the hdf5 shards of academic-bert-dataset (training*/test*) or train.bin/validation.bin "
+        "uint16 token memmaps, read without tokenization and masked in the dataloader workers",
+    )
+
     parser.add_argument(
         "--sampling_type",
         type=str,
@@ -714,6 +723,27 @@ def parse_args():
         help=f"only useful if inplace_distillation is set",
     )
 
+    parser.add_argument(
+        "--kd_topk",
+        type=int,
+        default=0,
+        help=f"keep only the top-k teacher logits of the masked positions for logits distillation (0: all the vocabulary)",
+    )
+
+    parser.add_argument(
+        "--kd_temperature",
+        type=float,
+        default=1.0,
+        help=f"temperature of the logits distillation loss, which is scaled by temperature^2",
+    )
+
+    parser.add_argument(
+        "--kd_vocab_chunk_size",
+        type=int,
+        default=8192,
+        help=f"the logits distillation loss is computed over chunks of this many vocabulary entries",
+    )
+
     parser.add_argument(
         "--inplace_kd_layers",
         type=str,
@@ -742,6 +772,13 @@ def parse_args():
         help=f"path to the fixed teacher model",
     )
 
+    parser.add_argument(
+        "--teacher_topk_cache",
+        type=str,
+        default=None,
+        help=f"prefix of the top-k teacher probabilities dumped by dump_teacher_topk.py, used for logits distillation instead of running the teacher (needs --pretokenized_data_dir). the train rows are then masked with the static masks the teacher was dumped on",
+    )
+
     parser.add_argument(
         "--trial_run",
         type=str,
@@ -850,6 +887,10 @@ def parse_args():
     if args.alpha_divergence:
         assert args.inplace_distillation
 
+    if args.teacher_topk_cache is not None:
+        assert args.pretokenized_data_dir is not None, "the teacher cache is keyed by the rows of the pre-tokenized data"
+        assert args.distillation_type is not None and set(args.distillation_type) <= {"logits", "hard"}, "the teacher cache only holds logits"
+
     # commented to do inplace kd during subnet pretraining
     #if args.inplace_distillation == 1:
     #    assert (
@@ -862,6 +903,7 @@ def parse_args():
         and args.validation_file is None
         and args.c4_dir is None
         and args.tokenized_c4_dir is None
+        and args.pretokenized_data_dir is None
     ):
         raise ValueError("Need either a dataset name or a training/validation file.")
     else:
@@ -902,6 +944,10 @@ def parse_args():
         check_path(args.tokenized_c4_dir)
         args.dataset_name = "c4_realnews"
 
+    if args.pretokenized_data_dir is not None:
+        check_path(args.pretokenized_data_dir)
+        args.dataset_name = "academic_bert"
+
     if args.resume_from_checkpoint_dir is not None:
 
         args.optim_scheduler_states_path = os.path.join(
@@ -1044,7 +1090,9 @@ def main():
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if args.tokenized_c4_dir is not None:
+    if args.pretokenized_data_dir is not None:
+        logger.info(f"Reading pre-tokenized data from {args.pretokenized_data_dir}")
+    elif args.tokenized_c4_dir is not None:
         # logger.info("Loading Tokenized C4 Dataset...")
         tokenized_datasets = datasets.load_from_disk(args.tokenized_c4_dir)
         if "graphcore" in args.tokenized_c4_dir:
@@ -1542,7 +1590,7 @@ def main():
 
     # Preprocessing the datasets.
     # First we tokenize all the texts.
-    if args.tokenized_c4_dir is None:
+    if args.tokenized_c4_dir is None and args.pretokenized_data_dir is None:
         column_names = raw_datasets["train"].column_names
         text_column_name = "text" if "text" in column_names else column_names[0]
 
@@ -1562,7 +1610,9 @@ def main():
             )
         max_seq_length = min(args.max_seq_length, tokenizer.model_max_length)
 
-    if args.tokenized_c4_dir is None:
+    if args.pretokenized_data_dir is not None:
+        pass
+    elif args.tokenized_c4_dir is None:
         if args.line_by_line:
             # When using line_by_line, we just tokenize each nonempty line.
             padding = "max_length" if args.pad_to_max_length else False
@@ -1659,37 +1709,65 @@ def main():
             f"Skipping tokenization! as we have the tokenized dataset is already loaded from {args.tokenized_c4_dir}"
         )
 
-    train_dataset = tokenized_datasets["train"] if args.trial_run == "no" else tokenized_datasets["validation"]
-    eval_dataset = tokenized_datasets["validation"] if args.check_test_loss_only == "no" else tokenized_datasets["test"]
-
-    # Log a few random samples from the training set:
-    for index in random.sample(range(len(train_dataset)), 3):
-        logger.info(f"Sample {index} of the training set: {train_dataset[index]}.")
+    if args.pretokenized_data_dir is not None:
+        # batches are read, masked and sharded across processes in the dataloader workers,
+        # so these dataloaders are not prepared by the accelerator
+        train_dataset, train_dataloader = build_pretokenized_dataloader(
+            args.pretokenized_data_dir,
+            "train" if args.trial_run == "no" else "validation",
+            tokenizer,
+            args.per_device_train_batch_size,
+            accelerator,
+            mlm_probability=args.mlm_probability,
+            max_seq_length=max_seq_length,
+            shuffle=True,
+            seed=args.seed,
+            num_workers=args.preprocessing_num_workers,
+            teacher_cache_prefix=args.teacher_topk_cache,
+        )
+        eval_dataset, eval_dataloader = build_pretokenized_dataloader(
+            args.pretokenized_data_dir,
+            "validation",
+            tokenizer,
+            args.per_device_eval_batch_size,
+            accelerator,
+            mlm_probability=args.mlm_probability,
+            max_seq_length=max_seq_length,
+            shuffle=False,
+            num_workers=args.preprocessing_num_workers,
+        )
+    else:
+        train_dataset = tokenized_datasets["train"] if args.trial_run == "no" else tokenized_datasets["validation"]
+        eval_dataset = tokenized_datasets["validation"] if args.check_test_loss_only == "no" else tokenized_datasets["test"]
 
-    # Data collator
-    # This one will take care of randomly masking the tokens.
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer, mlm_probability=args.mlm_probability
-    )
-    #if "graphcore" in args.tokenized_c4_dir:
-    #    data_collator = None
+        # Log a few random samples from the training set:
+        for index in random.sample(range(len(train_dataset)), 3):
+            logger.info(f"Sample {index} of the training set: {train_dataset[index]}.")
 
-    # DataLoaders creation:
-    train_dataloader = DataLoader(
-        train_dataset,
-        shuffle=True,
-        collate_fn=data_collator,
-        batch_size=args.per_device_train_batch_size,
-        num_workers=args.preprocessing_num_workers,
-        pin_memory=True,
-    )
-    eval_dataloader = DataLoader(
-        eval_dataset,
-        collate_fn=data_collator,
-        batch_size=args.per_device_eval_batch_size,
-        num_workers=args.preprocessing_num_workers,
-        pin_memory=True,
-    )
+        # Data collator
+        # This one will take care of randomly masking the tokens.
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer, mlm_probability=args.mlm_probability
+        )
+        #if "graphcore" in args.tokenized_c4_dir:
+        #    data_collator = None
+
+        # DataLoaders creation:
+        train_dataloader = DataLoader(
+            train_dataset,
+            shuffle=True,
+            collate_fn=data_collator,
+            batch_size=args.per_device_train_batch_size,
+            num_workers=args.preprocessing_num_workers,
+            pin_memory=True,
+        )
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            collate_fn=data_collator,
+            batch_size=args.per_device_eval_batch_size,
+            num_workers=args.preprocessing_num_workers,
+            pin_memory=True,
+        )
 
     # Optimizer
     # Split weights in two groups, one with weight decay and the other not.
@@ -1725,9 +1803,12 @@ def main():
         optimizer.load_state_dict(optim_scheduler_states["optimizer"])
 
     # Prepare everything with our `accelerator`.
-    model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
-        model, optimizer, train_dataloader, eval_dataloader
-    )
+    if args.pretokenized_data_dir is not None:
+        model, optimizer = accelerator.prepare(model, optimizer)
+    else:
+        model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
+            model, optimizer, train_dataloader, eval_dataloader
+        )
     if args.teacher_model_path is not None:
         teacher_model = accelerator.prepare(teacher_model) # not needed when teacher doesn't have any parameter that requires a gradient
         
@@ -1983,9 +2064,14 @@ def main():
 
         model.train()
         # k_count = args.k_sampling - 1
+        if args.pretokenized_data_dir is not None:
+            train_dataloader.set_epoch(epoch)
 
         for step, batch in enumerate(train_dataloader):
             seed += 1
+            if args.teacher_topk_cache is not None:
+                # the cached teacher output replaces the teacher forward, it is not a model input
+                teacher_topk = (batch.pop("teacher_topk_indices"), batch.pop("teacher_topk_probs"))
 
             cur_sampling_one_arch_choice = "none"
             if args.sample_one_arch != "none":
@@ -2022,8 +2108,9 @@ def main():
 
                 if args.sampling_rule == "sandwich" or cur_sampling_one_arch_choice == "biggest":
                     ## Sample Supertransformer
-                    if args.teacher_model_path is not None:
-                        outputs = teacher_model(**batch)
+                    if args.teacher_model_path is not None or args.teacher_topk_cache is not None:
+                        if args.teacher_topk_cache is None:
+                            outputs = teacher_model(**batch)
                         if args.inplace_distillation:
                             model.set_sample_config(global_config, drop_layers=True)
                             nonteacher_outputs = model(**batch)
@@ -2039,7 +2126,7 @@ def main():
                         teacher_mlm_loss = teacher_mlm_loss / args.gradient_accumulation_steps
                         accelerator.backward(teacher_mlm_loss)
                         if args.consistency_loss_max == "yes":
-                            teacher_info = {"teacher_logits": outputs.logits.detach()}
+                            teacher_info = teacher_logits_info(outputs.logits, batch["labels"], topk=args.kd_topk)
                             model.set_sample_config(config_dict["moe_biggest_config_2"], drop_layers=True)
                             outputs = model(**batch)
                             (moe_biggest_config_2_loss, moe_biggest_config_2_losses_dict) = compute_student_loss(outputs, teacher_info, args, track_layerwise_loss=track_loss, logits_kd=True)
@@ -2055,8 +2142,10 @@ def main():
                             if "attentionlastlayer" in args.distillation_type or "tinybert" in args.distillation_type:
                                 teacher_info["teacher_attention_maps"] = outputs.attentions
                             
-                            if "logits" in args.distillation_type:
-                                teacher_info["teacher_logits"] = outputs.logits.detach()
+                            if "logits" in args.distillation_type and args.teacher_topk_cache is not None:
+                                teacher_info.update(cached_teacher_info(*teacher_topk, batch["labels"], topk=args.kd_topk))
+                            elif "logits" in args.distillation_type:
+                                teacher_info.update(teacher_logits_info(outputs.logits, batch["labels"], topk=args.kd_topk))
 
                         # teacher_hidden_states = outputs.hidden_states
                         # teacher_attention_maps = outputs.attentions
@@ -2076,7 +2165,9 @@ def main():
                         # batch["labels"] = soft_logits
                 elif args.inplace_distillation and args.freeze_largest_model == "yes" and args.freeze_smallest_model == "yes":
                     # need teacher logits
-                    if args.teacher_model_path is None:
+                    if args.teacher_topk_cache is not None:
+                        teacher_info = cached_teacher_info(*teacher_topk, batch["labels"], topk=args.kd_topk)
+                    elif args.teacher_model_path is None:
                         model.eval()
                         model.set_sample_config(global_config, drop_layers=True)
                         outputs = model(**batch)
@@ -2086,7 +2177,7 @@ def main():
                         if "attentionlastlayer" in args.distillation_type:
                             teacher_info["teacher_attention_maps"] = outputs.attentions
                         if "logits" in args.distillation_type:
-                            teacher_info["teacher_logits"] = outputs.logits.detach()
+                            teacher_info.update(teacher_logits_info(outputs.logits, batch["labels"], topk=args.kd_topk))
                         model.train()
                     else:
                         with torch.no_grad():
@@ -2097,7 +2188,7 @@ def main():
                         if "attentionlastlayer" in args.distillation_type or "tinybert" in args.distillation_type:
                             teacher_info["teacher_attention_maps"] = outputs.attentions
                         if "logits" in args.distillation_type:
-                            teacher_info["teacher_logits"] = outputs.logits.detach()
+                            teacher_info.update(teacher_logits_info(outputs.logits, batch["labels"], topk=args.kd_topk))
 
                     # freeze_largest_model and freeze_smallest_model automatically works
 
@@ -509,6 +509,7 @@ def post_processing_function(args, examples, features, predictions, stage="eval"
         null_score_diff_threshold=args.null_score_diff_threshold,
         output_dir=args.output_dir,
         prefix=stage,
+        num_workers=args.preprocessing_num_workers,
     )
     # Format the result to the format the metric expects.
     if args.version_2_with_negative:
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# files of a supernet checkpoint dir that determine its fitness
+CHECKPOINT_FILES = ["config.json", "pytorch_model.bin", "model.safetensors"]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha1 of the file content"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def checkpoint_digest(ckpt_dir):
+    """content hash of the supernet weights, so that copies of a checkpoint share their cached scores"""
+    if not os.path.isdir(ckpt_dir):
+        # hub model ids are immutable enough
+        return ckpt_dir
+    return {name: file_digest(os.path.join(ckpt_dir, name)) for name in CHECKPOINT_FILES if os.path.exists(os.path.join(ckpt_dir, name))}
+
+
+def config_hash(config):
+    """canonical hash of a (nested) subnet config: key order and list/tuple types do not matter"""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def subnet_config_dict(bert_config):
+    """canonical view of a sampled BertConfig: only the sample_* attributes define the subnet"""
+    return {k: v for k, v in bert_config.to_dict().items() if k.startswith("sample_")}
+
+
+class FitnessCache:
+    """
+    sqlite store of the fitness of subnets, shared across search runs.
+    scores are keyed by the hash of the subnet config within a namespace, which identifies the
+    supernet checkpoint and the evaluation setup, so a score is only reused when re-evaluating
+    would give the same number.
+    """
+
+    def __init__(self, path, namespace):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.namespace = config_hash(namespace)
+        # several searches may share the store, wait for their writes instead of failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fitness ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, config TEXT, score TEXT NOT NULL, created REAL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.conn.commit()
+        self.hits, self.misses = 0, 0
+
+    def get_many(self, configs):
+        """cached scores of configs, None for the ones never evaluated"""
+        scores = []
+        for config in configs:
+            row = self.conn.execute(
+                "SELECT score FROM fitness WHERE namespace = ? AND key = ?", (self.namespace, config_hash(config))
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                scores.append(None)
+            else:
+                self.hits += 1
+                scores.append(json.loads(row[0]))
+        return scores
+
+    def get(self, config):
+        return self.get_many([config])[0]
+
+    def put_many(self, configs, scores):
+        # metrics may hold scalar tensors (e.g. val_loss)
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO fitness (namespace, key, config, score, created) VALUES (?, ?, ?, ?, ?)",
+            [(self.namespace, config_hash(config), json.dumps(config, sort_keys=True), json.dumps(score, default=float), now)
+             for config, score in zip(configs, scores)],
+        )
+        self.conn.commit()
+
+    def put(self, config, score):
+        self.put_many([config], [score])
+
+    def close(self):
+        self.conn.close()
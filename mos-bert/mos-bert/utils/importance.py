@@ -0,0 +1,122 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def inverse_permutation(permutation_order):
+    inv = torch.empty_like(permutation_order)
+    inv[permutation_order] = torch.arange(
+        permutation_order.size(0), device=permutation_order.device
+    )
+
+    return inv
+
+
+class GradImportance:
+    """
+    neuron importance of modules as the mean |grad| of their outputs over all the tokens seen.
+    a backward hook adds the per-neuron sums and token counts in place (in float64), so the
+    estimate is an exact mean over any number of batches of any shape and can be checkpointed
+    and resumed to process large corpora in chunks. the checkpoints also hold the torch (and cuda)
+    rng state, so a resumed run masks and samples the remaining batches as an uninterrupted one.
+    """
+
+    def __init__(self, token_fraction=1.0):
+        assert 0.0 < token_fraction <= 1.0
+        # only a random subset of the tokens of every batch is accumulated when < 1
+        self.token_fraction = token_fraction
+        self.sums = {}
+        self.counts = {}
+        # number of batches accumulated, to skip them when resuming
+        self.steps = 0
+        # rng state of the checkpoint loaded, applied by restore_rng_state() once the done batches are skipped
+        self.rng_state = None
+        self.handles = []
+
+    def register(self, modules):
+        """modules: {name: module}, the names key the accumulators and the checkpoints"""
+        for name, module in modules.items():
+            self.handles.append(module.register_backward_hook(self._hook(name)))
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _hook(self, name):
+        def hook(module, grad_in, grad_out):
+            self.accumulate(name, grad_out[0])
+
+        return hook
+
+    @torch.no_grad()
+    def accumulate(self, name, grad):
+        grad = grad.reshape(-1, grad.shape[-1])
+        if self.token_fraction < 1.0:
+            grad = grad[torch.rand(grad.shape[0], device=grad.device) < self.token_fraction]
+        if name not in self.sums:
+            self.sums[name] = torch.zeros(grad.shape[-1], dtype=torch.float64, device=grad.device)
+            self.counts[name] = 0
+        self.sums[name].add_(grad.abs().sum(dim=0, dtype=torch.float64))
+        self.counts[name] += grad.shape[0]
+
+    def all_reduce(self):
+        """sum the accumulators of all the processes (call on every process)"""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        for name in sorted(self.sums):
+            dist.all_reduce(self.sums[name])
+            count = torch.tensor([self.counts[name]], dtype=torch.float64, device=self.sums[name].device)
+            dist.all_reduce(count)
+            self.counts[name] = int(count.item())
+
+    def mean(self, name):
+        return self.sums[name] / max(self.counts[name], 1)
+
+    def importance_order(self, name):
+        return torch.argsort(self.mean(name), descending=True)
+
+    def export(self, modules):
+        """register importance_order / inv_importance_order buffers on all the modules at once"""
+        for name, module in modules.items():
+            importance_order = self.importance_order(name).to(module.weight.device)
+            module.register_buffer("importance_order", importance_order)
+            module.register_buffer("inv_importance_order", inverse_permutation(importance_order))
+
+    def state_dict(self):
+        return {
+            "token_fraction": self.token_fraction,
+            "steps": self.steps,
+            "sums": {name: s.cpu() for name, s in self.sums.items()},
+            "counts": dict(self.counts),
+            "rng_state": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+
+    def load_state_dict(self, state, device=None):
+        self.token_fraction = state["token_fraction"]
+        self.steps = state["steps"]
+        self.sums = {name: s.to(device) if device is not None else s for name, s in state["sums"].items()}
+        self.counts = dict(state["counts"])
+        self.rng_state = state.get("rng_state")
+
+    def restore_rng_state(self):
+        """put the rng back where it was when the loaded checkpoint was saved"""
+        if self.rng_state is None:
+            return
+        torch.set_rng_state(self.rng_state["torch"])
+        if self.rng_state["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(self.rng_state["cuda"])
+        self.rng_state = None
+
+    def save(self, path):
+        # write then rename, a crash while saving keeps the previous checkpoint
+        tmp_path = path + ".tmp"
+        torch.save(self.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+
+    def load(self, path, device=None):
+        self.load_state_dict(torch.load(path, map_location="cpu"), device=device)
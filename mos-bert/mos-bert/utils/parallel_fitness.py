@@ -0,0 +1,97 @@
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+# how often a search waiting for scores checks that its workers are alive, in seconds
+RESULT_POLL_SECONDS = 60
+
+
+def worker_devices(num_workers):
+    """one gpu per worker (round robin) when available, else cpu workers"""
+    if torch.cuda.is_available():
+        return ["cuda:%d" % (i % torch.cuda.device_count()) for i in range(num_workers)]
+    return ["cpu" for _ in range(num_workers)]
+
+
+def _worker_main(device, num_threads, build_fn, build_args, tasks, results):
+    # must happen before cuda is initialized in the worker, its device is then cuda:0.
+    # the index is relative to the gpus visible to the search (inherited CUDA_VISIBLE_DEVICES)
+    if device.startswith("cuda"):
+        index = int(device.split(":")[1])
+        visible = [d.strip() for d in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if d.strip()]
+        os.environ["CUDA_VISIBLE_DEVICES"] = visible[index] if visible else str(index)
+    else:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+        torch.set_num_threads(num_threads)
+
+    try:
+        evaluate = build_fn(*build_args)
+    except Exception:
+        # reported on the results queue, otherwise the search would wait for this worker forever
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, config = task
+        try:
+            results.put((index, evaluate(config), None))
+        except Exception:
+            results.put((index, None, traceback.format_exc()))
+
+
+class FitnessWorkerPool:
+    """
+    evaluates subnet configs in worker processes, each holding its own replica of the supernet.
+    build_fn(*build_args) runs once in every worker and returns the function scoring one config,
+    configs are dispatched from a shared queue and the scores come back in completion order.
+    """
+
+    def __init__(self, num_workers, build_fn, build_args=()):
+        devices = worker_devices(num_workers)
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [
+            ctx.Process(
+                target=_worker_main,
+                args=(device, num_threads, build_fn, build_args, self.tasks, self.results),
+                daemon=True,
+            )
+            for device in devices
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def imap_unordered(self, configs):
+        """yields (index of the config, score) as the workers finish them"""
+        for index, config in enumerate(configs):
+            self.tasks.put((index, config))
+        for _ in range(len(configs)):
+            index, score, error = self._get_result()
+            if error is not None:
+                if index is None:
+                    raise RuntimeError("fitness worker failed to load the supernet:\n%s" % error)
+                raise RuntimeError("fitness worker failed on config %d:\n%s" % (index, error))
+            yield index, score
+
+    def _get_result(self):
+        """next result, raises instead of waiting forever once a worker died (its configs are never answered)"""
+        while True:
+            try:
+                return self.results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError("%d fitness worker(s) died (exit codes %s)" % (len(dead), [w.exitcode for w in dead]))
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,323 @@
+import glob
+import math
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+from utils.teacher_cache import TeacherTopKCache
+
+# hdf5 shards of academic-bert-dataset/generate_samples.py, by split
+HDF5_PATTERNS = {"train": ["training*.hdf5", "train*.hdf5"], "validation": ["test*.hdf5"]}
+# column names of the two layouts written by create_pretraining_data.py
+HDF5_COLUMNS = {
+    "attention_mask": ["attention_mask", "input_mask"],
+    "token_type_ids": ["token_type_ids", "segment_ids"],
+}
+# columns of the masked_lm layout (input_mask/segment_ids), whose input_ids already hold the [MASK] replacements
+HDF5_MASKED_LM_COLUMNS = ["masked_lm_positions", "masked_lm_ids"]
+
+
+def mask_tokens(input_ids, special_tokens_mask, mlm_probability, mask_token_id, vocab_size, generator=None):
+    """
+    BERT masking of a whole batch at once, as DataCollatorForLanguageModeling: mlm_probability of the
+    non special tokens are predicted, 80% of them replaced by [MASK], 10% by a random token.
+    input_ids is modified in place.
+    """
+    labels = input_ids.clone()
+    probability_matrix = torch.full(labels.shape, mlm_probability)
+    probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
+    masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
+    labels[~masked_indices] = -100
+
+    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8), generator=generator).bool() & masked_indices
+    input_ids[indices_replaced] = mask_token_id
+
+    indices_random = (
+        torch.bernoulli(torch.full(labels.shape, 0.5), generator=generator).bool() & masked_indices & ~indices_replaced
+    )
+    random_words = torch.randint(vocab_size, labels.shape, dtype=torch.long, generator=generator)
+    input_ids[indices_random] = random_words[indices_random]
+    return input_ids, labels
+
+
+class PretokenizedMLMDataset(Dataset):
+    """
+    pre-tokenized sequences read from the hdf5 shards of academic-bert-dataset, or from a flat uint16
+    token memmap (consecutive windows of max_seq_length tokens).
+    items are whole batches: the dataset is indexed by the (seed, row indices) of ShardedBatchSampler,
+    so the rows are read with one slice per shard and masked at once in the dataloader workers.
+    with a teacher_cache (utils.teacher_cache.TeacherTopKCache keyed by row), the batches also hold the
+    cached top-k teacher probabilities of all their tokens.
+    with a static_mask_seed every row is masked the same way in every epoch (seeded by the row), so that
+    a teacher dumped on the masked rows saw the inputs of the student.
+    shards of the masked_lm layout are already masked: their stored masked_lm_positions / masked_lm_ids
+    are the labels and no dynamic masking is applied.
+    """
+
+    def __init__(
+        self, paths, tokenizer, mlm_probability=0.15, max_seq_length=None, teacher_cache=None, static_mask_seed=None
+    ):
+        self.paths = paths
+        self.teacher_cache = teacher_cache
+        self.static_mask_seed = static_mask_seed
+        self.mlm_probability = mlm_probability
+        self.mask_token_id = tokenizer.mask_token_id
+        self.pad_token_id = tokenizer.pad_token_id
+        self.vocab_size = len(tokenizer)
+        self.special_tokens = torch.zeros(self.vocab_size, dtype=torch.bool)
+        self.special_tokens[tokenizer.all_special_ids] = True
+
+        self.memmap = len(paths) == 1 and paths[0].endswith(".bin")
+        self.premasked = False
+        if self.memmap:
+            assert max_seq_length is not None, "max_seq_length is needed to split a token memmap in sequences"
+            self.seq_length = max_seq_length
+            self.sizes = [os.path.getsize(paths[0]) // 2 // max_seq_length]
+        else:
+            import h5py
+
+            self.sizes = []
+            premasked = set()
+            for path in paths:
+                with h5py.File(path, "r") as f:
+                    self.sizes.append(f["input_ids"].shape[0])
+                    self.seq_length = f["input_ids"].shape[1]
+                    premasked.add(all(c in f for c in HDF5_MASKED_LM_COLUMNS))
+            assert len(premasked) == 1, "the shards mix the masked_lm layout with unmasked ones"
+            self.premasked = premasked.pop()
+        self.offsets = np.cumsum([0] + self.sizes)
+        # opened lazily, in every dataloader worker
+        self._files = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = None
+        return state
+
+    def _open(self):
+        if self._files is None:
+            if self.memmap:
+                tokens = np.memmap(self.paths[0], dtype=np.uint16, mode="r")
+                self._files = [tokens[: self.sizes[0] * self.seq_length].reshape(-1, self.seq_length)]
+            else:
+                import h5py
+
+                self._files = [h5py.File(path, "r") for path in self.paths]
+        return self._files
+
+    def _read(self, f, rows):
+        """columns of the rows of a shard, rows are sorted"""
+        if self.memmap:
+            # only the rows of the batch are copied out of the memmap
+            input_ids = np.asarray(f[rows], dtype=np.int64)
+            return input_ids, (input_ids != self.pad_token_id).astype(np.int64), np.zeros_like(input_ids)
+
+        if rows[-1] - rows[0] + 1 == len(rows):
+            index = slice(int(rows[0]), int(rows[-1]) + 1)
+        else:
+            index = rows
+        columns = [f["input_ids"][index]]
+        for name, candidates in HDF5_COLUMNS.items():
+            column = next((c for c in candidates if c in f), None)
+            if column is None:
+                columns.append(np.zeros_like(columns[0]) if name == "token_type_ids" else columns[0] != 0)
+            else:
+                columns.append(f[column][index])
+        if self.premasked:
+            # labels from the stored predictions, positions are 0-padded ([CLS] is never masked)
+            positions = np.asarray(f["masked_lm_positions"][index], dtype=np.int64)
+            ids = np.asarray(f["masked_lm_ids"][index], dtype=np.int64)
+            labels = np.full(columns[0].shape, -100, dtype=np.int64)
+            r, c = np.nonzero(positions > 0)
+            labels[r, positions[r, c]] = ids[r, c]
+            columns.append(labels)
+        return [np.asarray(c, dtype=np.int64) for c in columns]
+
+    def read_rows(self, indices):
+        """(input_ids, attention_mask, token_type_ids) of global row indices, in their order, and labels for premasked shards"""
+        files = self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(indices, kind="stable")
+        sorted_indices = indices[order]
+        shards = np.searchsorted(self.offsets, sorted_indices, side="right") - 1
+
+        parts = [[] for _ in range(4 if self.premasked else 3)]
+        for shard in np.unique(shards):
+            rows = sorted_indices[shards == shard] - self.offsets[shard]
+            for part, column in zip(parts, self._read(files[shard], rows)):
+                part.append(column)
+        columns = [np.concatenate(part) for part in parts]
+
+        # back to the order of the indices
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return [torch.from_numpy(column[inverse]) for column in columns]
+
+    def _mask(self, input_ids, generator):
+        return mask_tokens(
+            input_ids,
+            self.special_tokens[input_ids],
+            self.mlm_probability,
+            self.mask_token_id,
+            self.vocab_size,
+            generator=generator,
+        )
+
+    def masked_rows(self, indices, seed=None):
+        """(input_ids, attention_mask, token_type_ids, labels) of the rows, masked with the batch seed or the static masks"""
+        if self.premasked:
+            # masked once and for all by create_pretraining_data.py
+            return self.read_rows(indices)
+        input_ids, attention_mask, token_type_ids = self.read_rows(indices)
+        if self.static_mask_seed is None:
+            # seeded by the sampler, so the masks do not depend on the number of workers
+            input_ids, labels = self._mask(input_ids, torch.Generator().manual_seed(seed))
+        else:
+            # one generator per row, the masks do not depend on the batches either
+            labels = torch.cat(
+                [
+                    self._mask(input_ids[i : i + 1], torch.Generator().manual_seed(self.static_mask_seed * 2 ** 32 + int(row)))[1]
+                    for i, row in enumerate(indices)
+                ]
+            )
+        return input_ids, attention_mask, token_type_ids, labels
+
+    def __getitem__(self, item):
+        seed, indices = item
+        input_ids, attention_mask, token_type_ids, labels = self.masked_rows(indices, seed)
+        batch = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+            "labels": labels,
+        }
+        if self.teacher_cache is not None:
+            topk_idx, topk_prob = self.teacher_cache.read_rows(indices)
+            batch["teacher_topk_indices"] = torch.from_numpy(topk_idx.astype(np.int64))
+            batch["teacher_topk_probs"] = torch.from_numpy(np.ascontiguousarray(topk_prob))
+        return batch
+
+
+class ShardedBatchSampler(Sampler):
+    """
+    batches of row indices for one of num_replicas processes, the same on all of them for an epoch.
+    hdf5 batches are random rows of a single shard (read_rows sorts them into one fancy read of the
+    shard, which does not rely on the shards having been shuffled by create_pretraining_data),
+    shuffled in order. memmap batches are random rows.
+    """
+
+    def __init__(self, dataset, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, rng):
+        if self.dataset.memmap:
+            rows = rng.permutation(len(self.dataset)) if self.shuffle else np.arange(len(self.dataset))
+            batches = [rows[i : i + self.batch_size] for i in range(0, len(rows), self.batch_size)]
+        else:
+            batches = []
+            for offset, size in zip(self.dataset.offsets, self.dataset.sizes):
+                rows = offset + (rng.permutation(size) if self.shuffle else np.arange(size))
+                # sorted, so the teacher cache is read front to back as well
+                batches.extend(np.sort(rows[i : i + self.batch_size]) for i in range(0, size, self.batch_size))
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return batches
+
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        batches = self._batches(rng)
+        # every process gets as many batches, as with accelerate
+        num_batches = len(self) * self.num_replicas
+        batches = (batches * math.ceil(num_batches / max(len(batches), 1)))[:num_batches]
+        mask_seed = int(rng.randint(2 ** 31))
+        for i in range(self.rank, num_batches, self.num_replicas):
+            yield mask_seed + i, batches[i]
+
+    def __len__(self):
+        if self.dataset.memmap:
+            num_rows = len(self.dataset)
+            num_batches = num_rows // self.batch_size if self.drop_last else math.ceil(num_rows / self.batch_size)
+        elif self.drop_last:
+            num_batches = sum(size // self.batch_size for size in self.dataset.sizes)
+        else:
+            num_batches = sum(math.ceil(size / self.batch_size) for size in self.dataset.sizes)
+        return math.ceil(num_batches / self.num_replicas)
+
+
+class DeviceDataLoader:
+    """moves the batches of a dataloader to the device (what accelerate does for the dataloaders it prepares)"""
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+
+    def set_epoch(self, epoch):
+        self.dataloader.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            yield {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+
+def find_pretokenized_files(data_dir, split):
+    """train/validation hdf5 shards of data_dir, or its {split}.bin token memmap"""
+    memmap_path = os.path.join(data_dir, split + ".bin")
+    if os.path.exists(memmap_path):
+        return [memmap_path]
+    paths = set()
+    for pattern in HDF5_PATTERNS[split]:
+        paths.update(glob.glob(os.path.join(data_dir, pattern)))
+    if not paths:
+        raise ValueError("no %s data (%s.bin or %s) in %s" % (split, split, " ".join(HDF5_PATTERNS[split]), data_dir))
+    return sorted(paths)
+
+
+def build_pretokenized_dataloader(
+    data_dir, split, tokenizer, batch_size, accelerator, mlm_probability=0.15, max_seq_length=None,
+    shuffle=True, seed=0, num_workers=8, prefetch_factor=4, teacher_cache_prefix=None,
+):
+    teacher_cache = TeacherTopKCache(teacher_cache_prefix) if teacher_cache_prefix is not None else None
+    static_mask_seed = None
+    if teacher_cache is not None:
+        # the teacher was dumped on statically masked rows, the student is trained on the same masks
+        assert "mask_seed" in teacher_cache.meta, "the teacher cache was dumped on unmasked rows, dump it again"
+        assert teacher_cache.meta.get("mlm_probability") == mlm_probability, (
+            "the teacher cache was dumped with --mlm_probability %s" % teacher_cache.meta.get("mlm_probability")
+        )
+        static_mask_seed = teacher_cache.meta["mask_seed"]
+    dataset = PretokenizedMLMDataset(
+        find_pretokenized_files(data_dir, split), tokenizer, mlm_probability=mlm_probability,
+        max_seq_length=max_seq_length, teacher_cache=teacher_cache, static_mask_seed=static_mask_seed,
+    )
+    if dataset.teacher_cache is not None:
+        assert len(dataset.teacher_cache) == len(dataset), "the teacher cache was not dumped from these %s rows" % split
+    sampler = ShardedBatchSampler(
+        dataset, batch_size, num_replicas=accelerator.num_processes, rank=accelerator.process_index,
+        shuffle=shuffle, seed=seed,
+    )
+    kwargs = {"persistent_workers": True, "prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+    # batch_size=None: every item of the dataset is already a batch
+    dataloader = DataLoader(
+        dataset, sampler=sampler, batch_size=None, num_workers=num_workers, pin_memory=True, **kwargs
+    )
+    return dataset, DeviceDataLoader(dataloader, accelerator.device)
@@ -0,0 +1,103 @@
+import json
+import os
+
+import numpy as np
+
+# files of a cache with prefix p: p.json (topk, sizes), p.idx.npy ((token offset, num tokens) of every
+# example id, -1 when missing), p.topk_idx.bin (int32) and p.topk_prob.bin (float16), num tokens x topk.
+# the same layout as fairseq/data/teacher_topk_dataset.py of mos-mt
+
+
+def teacher_cache_exists(prefix):
+    return all(os.path.exists(prefix + suffix) for suffix in [".json", ".idx.npy", ".topk_idx.bin", ".topk_prob.bin"])
+
+
+class TeacherTopKWriter:
+    """
+    one-time dump of the per-token top-k teacher probabilities, appended example by example (in any order)
+    to the .bin files, the index of the example ids is written by close.
+    """
+
+    def __init__(self, prefix, topk, num_examples, meta=None):
+        self.prefix = prefix
+        self.topk = topk
+        # written to the json, e.g. how the inputs of the teacher were masked
+        self.meta = meta or {}
+        self.index = np.full((num_examples, 2), -1, dtype=np.int64)
+        self.num_tokens = 0
+        self.idx_file = open(prefix + ".topk_idx.bin", "wb")
+        self.prob_file = open(prefix + ".topk_prob.bin", "wb")
+
+    def add(self, example_ids, topk_idx, topk_prob):
+        """topk_idx / topk_prob: (num examples, num tokens, topk), or lists of (num tokens, topk) arrays"""
+        for example_id, idx, prob in zip(example_ids, topk_idx, topk_prob):
+            assert idx.shape[-1] == self.topk
+            self.index[example_id] = self.num_tokens, idx.shape[0]
+            self.idx_file.write(np.ascontiguousarray(idx, dtype=np.int32).tobytes())
+            self.prob_file.write(np.ascontiguousarray(prob, dtype=np.float16).tobytes())
+            self.num_tokens += idx.shape[0]
+
+    def close(self):
+        self.idx_file.close()
+        self.prob_file.close()
+        np.save(self.prefix + ".idx.npy", self.index)
+        # written last, an interrupted dump is not a cache
+        with open(self.prefix + ".json", "w") as f:
+            json.dump(dict(self.meta, topk=self.topk, num_tokens=self.num_tokens, num_examples=len(self.index)), f)
+
+
+class TeacherTopKCache:
+    """
+    zero-copy reader of a TeacherTopKWriter dump: the .bin files are memory-mapped (copy on write, nothing is
+    ever written back) and the top-k of an example are views into them. opened lazily, in every dataloader worker.
+    """
+
+    def __init__(self, prefix):
+        assert teacher_cache_exists(prefix), "no teacher top-k cache at %s" % prefix
+        self.prefix = prefix
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        self.topk = meta["topk"]
+        self.num_tokens = meta["num_tokens"]
+        self.meta = meta
+        self.index = np.load(prefix + ".idx.npy")
+        self._files = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = None
+        return state
+
+    def _open(self):
+        if self._files is None:
+            shape = (self.num_tokens, self.topk)
+            self._files = (
+                np.memmap(self.prefix + ".topk_idx.bin", dtype=np.int32, mode="c", shape=shape),
+                np.memmap(self.prefix + ".topk_prob.bin", dtype=np.float16, mode="c", shape=shape),
+            )
+        return self._files
+
+    def __getitem__(self, example_id):
+        """(topk_idx, topk_prob) views of shape (num tokens, topk)"""
+        offset, num_tokens = self.index[example_id]
+        assert offset >= 0, "example %d is not in the teacher cache" % example_id
+        topk_idx, topk_prob = self._open()
+        return topk_idx[offset : offset + num_tokens], topk_prob[offset : offset + num_tokens]
+
+    def read_rows(self, example_ids):
+        """(num examples, num tokens, topk) arrays of examples of the same length"""
+        example_ids = np.asarray(example_ids, dtype=np.int64)
+        offsets, num_tokens = self.index[example_ids, 0], self.index[example_ids, 1]
+        assert (offsets >= 0).all(), "examples missing from the teacher cache"
+        assert (num_tokens == num_tokens[0]).all()
+        topk_idx, topk_prob = self._open()
+        shape = (len(example_ids), int(num_tokens[0]), self.topk)
+        if (np.diff(offsets) == num_tokens[0]).all():
+            # consecutive examples, dumped in order: a single slice (a view)
+            rows = slice(int(offsets[0]), int(offsets[-1] + num_tokens[-1]))
+        else:
+            rows = (offsets[:, None] + np.arange(num_tokens[0])).reshape(-1)
+        return topk_idx[rows].reshape(shape), topk_prob[rows].reshape(shape)
@@ -21,6 +21,7 @@ Post-processing utilities for question answering.
 import collections
 import json
 import logging
+import multiprocessing
 import os
 from typing import Optional, Tuple
 
@@ -31,6 +32,218 @@ from tqdm.auto import tqdm
 logger = logging.getLogger(__name__)
 
 
+# below this many features per worker, postprocess_qa_predictions does not start a multiprocessing pool
+MIN_FEATURES_PER_WORKER = 20000
+
+
+def _feature_column(features, name):
+    """
+    A column of the features (a `datasets.Dataset` or a list of dicts), None when the features do not have it.
+    """
+    if hasattr(features, "column_names"):
+        return features[name] if name in features.column_names else None
+    return [feature.get(name, None) for feature in features]
+
+
+def _top_k_indices(logits, k):
+    """
+    `np.argsort(logits[i])[-1 : -k - 1 : -1]` of every row of :obj:`logits` (num features, seq len), with a partial
+    sort. The tie order of :obj:`np.argsort` is implementation defined: the rows with tied logits in their top k take
+    the full sort, so that the indices are always the same as the ones of the full sort.
+    """
+    k = min(k, logits.shape[-1])
+    if k <= 0:
+        return np.zeros((len(logits), 0), dtype=np.int64)
+    top = np.argpartition(-logits, k - 1, axis=-1)[:, :k]
+    top_logits = np.take_along_axis(logits, top, axis=-1)
+    order = np.argsort(-top_logits, axis=-1, kind="stable")
+    top = np.take_along_axis(top, order, axis=-1)
+    top_logits = np.take_along_axis(top_logits, order, axis=-1)
+    ties = (np.diff(top_logits, axis=-1) == 0).any(axis=-1) | (
+        (logits >= top_logits[:, -1:]).sum(axis=-1) > k
+    )
+    for i in np.nonzero(ties)[0]:
+        top[i] = np.argsort(logits[i])[-1 : -k - 1 : -1]
+    return top
+
+
+def _postprocess_qa_chunk(
+    example_ids,
+    contexts,
+    features_per_example,
+    all_start_logits,
+    all_end_logits,
+    offset_mappings,
+    max_contexts,
+    version_2_with_negative,
+    n_best_size,
+    max_answer_length,
+    null_score_diff_threshold,
+    show_progress=True,
+):
+    """
+    The predictions of a chunk of examples, see :obj:`postprocess_qa_predictions`. :obj:`features_per_example` index
+    the rows of the logits and of the feature columns of the chunk.
+
+    The `n_best_size` x `n_best_size` start / end pairs of all the features are scored at once: a (num features,
+    n_best_size, n_best_size) score matrix with a mask of the valid spans. Returns lists of (example id, value) pairs
+    of the predictions, n-best predictions and score differences.
+    """
+    # Go through all possibilities for the `n_best_size` greater start and end logits.
+    start_indexes = _top_k_indices(all_start_logits, n_best_size)
+    end_indexes = _top_k_indices(all_end_logits, n_best_size)
+    start_top_logits = np.take_along_axis(all_start_logits, start_indexes, axis=-1)
+    end_top_logits = np.take_along_axis(all_end_logits, end_indexes, axis=-1)
+
+    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond to part of the
+    # input_ids that are not in the context, or answers that don't have the maximum context available (if such
+    # information is provided). Only the offsets of the top start and end indices are looked up.
+    start_chars = np.zeros(start_indexes.shape, dtype=np.int64)
+    end_chars = np.zeros(end_indexes.shape, dtype=np.int64)
+    start_valid = np.zeros(start_indexes.shape, dtype=bool)
+    end_valid = np.zeros(end_indexes.shape, dtype=bool)
+    for feature_index, offset_mapping in enumerate(offset_mappings):
+        token_is_max_context = max_contexts[feature_index] if max_contexts is not None else None
+        for j, start_index in enumerate(start_indexes[feature_index].tolist()):
+            if (
+                start_index < len(offset_mapping)
+                and offset_mapping[start_index] is not None
+                and (token_is_max_context is None or token_is_max_context.get(str(start_index), False))
+            ):
+                start_valid[feature_index, j] = True
+                start_chars[feature_index, j] = offset_mapping[start_index][0]
+        for j, end_index in enumerate(end_indexes[feature_index].tolist()):
+            if end_index < len(offset_mapping) and offset_mapping[end_index] is not None:
+                end_valid[feature_index, j] = True
+                end_chars[feature_index, j] = offset_mapping[end_index][1]
+
+    # Don't consider answers with a length that is either < 0 or > max_answer_length.
+    span_lengths = end_indexes[:, None, :] - start_indexes[:, :, None] + 1
+    valid_spans = (
+        start_valid[:, :, None]
+        & end_valid[:, None, :]
+        & (span_lengths >= 1)
+        & (span_lengths <= max_answer_length)
+    )
+    span_scores = start_top_logits[:, :, None] + end_top_logits[:, None, :]
+
+    chunk_predictions, chunk_nbest_json, chunk_scores_diff = [], [], []
+    for example_index, example_id in enumerate(tqdm(example_ids, disable=not show_progress)):
+        # Those are the indices of the features associated to the current example.
+        feature_indices = np.asarray(features_per_example[example_index], dtype=np.int64)
+
+        # The valid spans of all the features, in the order of the features, then of the start and end logits.
+        feature_pos, start_pos, end_pos = np.nonzero(valid_spans[feature_indices])
+        rows = feature_indices[feature_pos]
+        scores = span_scores[rows, start_pos, end_pos]
+        start_logits = start_top_logits[rows, start_pos]
+        end_logits = end_top_logits[rows, end_pos]
+        offsets_start = start_chars[rows, start_pos]
+        offsets_end = end_chars[rows, end_pos]
+
+        if version_2_with_negative:
+            # Add the minimum null prediction (of the first feature with the minimum null score)
+            null_row = feature_indices[
+                np.argmin(all_start_logits[feature_indices, 0] + all_end_logits[feature_indices, 0])
+            ]
+            min_null_prediction = {
+                "offsets": (0, 0),
+                "score": all_start_logits[null_row, 0] + all_end_logits[null_row, 0],
+                "start_logit": all_start_logits[null_row, 0],
+                "end_logit": all_end_logits[null_row, 0],
+            }
+            null_score = min_null_prediction["score"]
+            scores = np.append(scores, null_score)
+            start_logits = np.append(start_logits, min_null_prediction["start_logit"])
+            end_logits = np.append(end_logits, min_null_prediction["end_logit"])
+            offsets_start = np.append(offsets_start, 0)
+            offsets_end = np.append(offsets_end, 0)
+
+        # Only keep the best `n_best_size` predictions (a stable sort, as `sorted`).
+        predictions = [
+            {
+                "offsets": (int(offsets_start[i]), int(offsets_end[i])),
+                "score": scores[i],
+                "start_logit": start_logits[i],
+                "end_logit": end_logits[i],
+            }
+            for i in np.argsort(-scores, kind="stable")[:n_best_size]
+        ]
+
+        # Add back the minimum null prediction if it was removed because of its low score.
+        if version_2_with_negative and not any(
+            p["offsets"] == (0, 0) for p in predictions
+        ):
+            predictions.append(min_null_prediction)
+
+        # Use the offsets to gather the answer text in the original context.
+        context = contexts[example_index]
+        for pred in predictions:
+            offsets = pred.pop("offsets")
+            pred["text"] = context[offsets[0] : offsets[1]]
+
+        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
+        # failure.
+        if len(predictions) == 0 or (
+            len(predictions) == 1 and predictions[0]["text"] == ""
+        ):
+            predictions.insert(
+                0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0}
+            )
+
+        # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
+        # the LogSumExp trick).
+        scores = np.array([pred.pop("score") for pred in predictions])
+        exp_scores = np.exp(scores - np.max(scores))
+        probs = exp_scores / exp_scores.sum()
+
+        # Include the probabilities in our predictions.
+        for prob, pred in zip(probs, predictions):
+            pred["probability"] = prob
+
+        # Pick the best prediction. If the null answer is not possible, this is easy.
+        if not version_2_with_negative:
+            chunk_predictions.append((example_id, predictions[0]["text"]))
+        else:
+            # Otherwise we first need to find the best non-empty prediction.
+            i = 0
+            while predictions[i]["text"] == "":
+                i += 1
+            best_non_null_pred = predictions[i]
+
+            # Then we compare to the null prediction using the threshold.
+            score_diff = (
+                null_score
+                - best_non_null_pred["start_logit"]
+                - best_non_null_pred["end_logit"]
+            )
+            chunk_scores_diff.append((example_id, float(score_diff)))  # To be JSON-serializable.
+            if score_diff > null_score_diff_threshold:
+                chunk_predictions.append((example_id, ""))
+            else:
+                chunk_predictions.append((example_id, best_non_null_pred["text"]))
+
+        # Make `predictions` JSON-serializable by casting np.float back to float.
+        chunk_nbest_json.append(
+            (
+                example_id,
+                [
+                    {
+                        k: (
+                            float(v)
+                            if isinstance(v, (np.float16, np.float32, np.float64))
+                            else v
+                        )
+                        for k, v in pred.items()
+                    }
+                    for pred in predictions
+                ],
+            )
+        )
+
+    return chunk_predictions, chunk_nbest_json, chunk_scores_diff
+
+
 def postprocess_qa_predictions(
     examples,
     features,
@@ -42,6 +255,7 @@ def postprocess_qa_predictions(
     output_dir: Optional[str] = None,
     prefix: Optional[str] = None,
     log_level: Optional[int] = logging.WARNING,
+    num_workers: int = 1,
 ):
     """
     Post-processes the predictions of a question-answering model to convert them to answers that are substrings of the
@@ -75,6 +289,9 @@ def postprocess_qa_predictions(
             If provided, the dictionaries mentioned above are saved with `prefix` added to their names.
         log_level (:obj:`int`, `optional`, defaults to ``logging.WARNING``):
             ``logging`` log level (e.g., ``logging.WARNING``)
+        num_workers (:obj:`int`, `optional`, defaults to 1):
+            The maximum number of processes to post-process very large sets in, each of them taking at least
+            :obj:`MIN_FEATURES_PER_WORKER` features. The predictions do not depend on it.
     """
     assert (
         len(predictions) == 2
@@ -86,16 +303,12 @@ def postprocess_qa_predictions(
     ), f"Got {len(predictions[0])} predictions and {len(features)} features."
 
     # Build a map example to its corresponding features.
-    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
+    example_ids = examples["id"]
+    example_id_to_index = {k: i for i, k in enumerate(example_ids)}
     features_per_example = collections.defaultdict(list)
-    for i, feature in enumerate(features):
-        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
-
-    # The dictionaries we have to fill.
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    if version_2_with_negative:
-        scores_diff_json = collections.OrderedDict()
+    for i, example_id in enumerate(_feature_column(features, "example_id")):
+        features_per_example[example_id_to_index[example_id]].append(i)
+    features_per_example = [features_per_example[i] for i in range(len(example_ids))]
 
     # Logging.
     logger.setLevel(log_level)
@@ -103,158 +316,70 @@ def postprocess_qa_predictions(
         f"Post-processing {len(examples)} example predictions split into {len(features)} features."
     )
 
-    # Let's loop over all the examples!
-    for example_index, example in enumerate(tqdm(examples)):
-        # Those are the indices of the features associated to the current example.
-        feature_indices = features_per_example[example_index]
-
-        min_null_prediction = None
-        prelim_predictions = []
-
-        # Looping through all the features associated to the current example.
-        for feature_index in feature_indices:
-            # We grab the predictions of the model for this feature.
-            start_logits = all_start_logits[feature_index]
-            end_logits = all_end_logits[feature_index]
-            # This is what will allow us to map some the positions in our logits to span of texts in the original
-            # context.
-            offset_mapping = features[feature_index]["offset_mapping"]
-            # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
-            # available in the current feature.
-            token_is_max_context = features[feature_index].get(
-                "token_is_max_context", None
-            )
-
-            # Update minimum null prediction.
-            feature_null_score = start_logits[0] + end_logits[0]
-            if (
-                min_null_prediction is None
-                or min_null_prediction["score"] > feature_null_score
-            ):
-                min_null_prediction = {
-                    "offsets": (0, 0),
-                    "score": feature_null_score,
-                    "start_logit": start_logits[0],
-                    "end_logit": end_logits[0],
-                }
-
-            # Go through all possibilities for the `n_best_size` greater start and end logits.
-            start_indexes = np.argsort(start_logits)[
-                -1 : -n_best_size - 1 : -1
-            ].tolist()
-            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1].tolist()
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # Don't consider out-of-scope answers, either because the indices are out of bounds or correspond
-                    # to part of the input_ids that are not in the context.
-                    if (
-                        start_index >= len(offset_mapping)
-                        or end_index >= len(offset_mapping)
-                        or offset_mapping[start_index] is None
-                        or offset_mapping[end_index] is None
-                    ):
-                        continue
-                    # Don't consider answers with a length that is either < 0 or > max_answer_length.
-                    if (
-                        end_index < start_index
-                        or end_index - start_index + 1 > max_answer_length
-                    ):
-                        continue
-                    # Don't consider answer that don't have the maximum context available (if such information is
-                    # provided).
-                    if (
-                        token_is_max_context is not None
-                        and not token_is_max_context.get(str(start_index), False)
-                    ):
-                        continue
-                    prelim_predictions.append(
-                        {
-                            "offsets": (
-                                offset_mapping[start_index][0],
-                                offset_mapping[end_index][1],
-                            ),
-                            "score": start_logits[start_index] + end_logits[end_index],
-                            "start_logit": start_logits[start_index],
-                            "end_logit": end_logits[end_index],
-                        }
-                    )
-        if version_2_with_negative:
-            # Add the minimum null prediction
-            prelim_predictions.append(min_null_prediction)
-            null_score = min_null_prediction["score"]
-
-        # Only keep the best `n_best_size` predictions.
-        predictions = sorted(
-            prelim_predictions, key=lambda x: x["score"], reverse=True
-        )[:n_best_size]
-
-        # Add back the minimum null prediction if it was removed because of its low score.
-        if version_2_with_negative and not any(
-            p["offsets"] == (0, 0) for p in predictions
-        ):
-            predictions.append(min_null_prediction)
-
-        # Use the offsets to gather the answer text in the original context.
-        context = example["context"]
-        for pred in predictions:
-            offsets = pred.pop("offsets")
-            pred["text"] = context[offsets[0] : offsets[1]]
+    contexts = examples["context"]
+    offset_mappings = _feature_column(features, "offset_mapping")
+    # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
+    # available in the current feature.
+    max_contexts = _feature_column(features, "token_is_max_context")
+    span_args = (
+        version_2_with_negative,
+        n_best_size,
+        max_answer_length,
+        null_score_diff_threshold,
+    )
 
-        # In the very rare edge case we have not a single non-null prediction, we create a fake prediction to avoid
-        # failure.
-        if len(predictions) == 0 or (
-            len(predictions) == 1 and predictions[0]["text"] == ""
-        ):
-            predictions.insert(
-                0, {"text": "empty", "start_logit": 0.0, "end_logit": 0.0, "score": 0.0}
+    num_workers = min(num_workers, len(features) // MIN_FEATURES_PER_WORKER)
+    if num_workers <= 1:
+        chunk_outputs = [
+            _postprocess_qa_chunk(
+                example_ids,
+                contexts,
+                features_per_example,
+                all_start_logits,
+                all_end_logits,
+                offset_mappings,
+                max_contexts,
+                *span_args,
             )
-
-        # Compute the softmax of all scores (we do it with numpy to stay independent from torch/tf in this file, using
-        # the LogSumExp trick).
-        scores = np.array([pred.pop("score") for pred in predictions])
-        exp_scores = np.exp(scores - np.max(scores))
-        probs = exp_scores / exp_scores.sum()
-
-        # Include the probabilities in our predictions.
-        for prob, pred in zip(probs, predictions):
-            pred["probability"] = prob
-
-        # Pick the best prediction. If the null answer is not possible, this is easy.
-        if not version_2_with_negative:
-            all_predictions[example["id"]] = predictions[0]["text"]
-        else:
-            # Otherwise we first need to find the best non-empty prediction.
-            i = 0
-            while predictions[i]["text"] == "":
-                i += 1
-            best_non_null_pred = predictions[i]
-
-            # Then we compare to the null prediction using the threshold.
-            score_diff = (
-                null_score
-                - best_non_null_pred["start_logit"]
-                - best_non_null_pred["end_logit"]
+        ]
+    else:
+        # Very large sets: contiguous chunks of the examples (with their features) in a pool of processes.
+        chunks = []
+        for example_range in np.array_split(np.arange(len(example_ids)), num_workers):
+            example_range = example_range.tolist()
+            rows = [i for example_index in example_range for i in features_per_example[example_index]]
+            local_features, start = [], 0
+            for example_index in example_range:
+                num = len(features_per_example[example_index])
+                local_features.append(list(range(start, start + num)))
+                start += num
+            chunks.append(
+                (
+                    [example_ids[i] for i in example_range],
+                    [contexts[i] for i in example_range],
+                    local_features,
+                    all_start_logits[rows],
+                    all_end_logits[rows],
+                    [offset_mappings[i] for i in rows],
+                    [max_contexts[i] for i in rows] if max_contexts is not None else None,
+                )
+                + span_args
+                + (False,)
             )
-            scores_diff_json[example["id"]] = float(
-                score_diff
-            )  # To be JSON-serializable.
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example["id"]] = ""
-            else:
-                all_predictions[example["id"]] = best_non_null_pred["text"]
+        logger.info(f"Post-processing in {num_workers} processes.")
+        with multiprocessing.Pool(num_workers) as pool:
+            chunk_outputs = pool.starmap(_postprocess_qa_chunk, chunks)
 
-        # Make `predictions` JSON-serializable by casting np.float back to float.
-        all_nbest_json[example["id"]] = [
-            {
-                k: (
-                    float(v)
-                    if isinstance(v, (np.float16, np.float32, np.float64))
-                    else v
-                )
-                for k, v in pred.items()
-            }
-            for pred in predictions
-        ]
+    # The dictionaries we have to fill.
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    if version_2_with_negative:
+        scores_diff_json = collections.OrderedDict()
+    for chunk_predictions, chunk_nbest_json, chunk_scores_diff in chunk_outputs:
+        all_predictions.update(chunk_predictions)
+        all_nbest_json.update(chunk_nbest_json)
+        if version_2_with_negative:
+            scores_diff_json.update(chunk_scores_diff)
 
     # If we have an output_dir, let's save all those dicts.
     if output_dir is not None:
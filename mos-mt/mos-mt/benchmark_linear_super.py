@@ -0,0 +1,72 @@
+#!/usr/bin/env python3 -u
+"""
+CPU micro-benchmark of LinearSuper with strided sampled slices (the default)
+against frozen contiguous slices (LinearSuper.freeze_samples), for the fc1,
+fc2 and attention projections of typical sampled dims.
+"""
+
+import argparse
+import time
+
+import torch
+
+from fairseq.modules import LinearSuper
+
+
+def time_forward(layer, x, iters, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            layer(x)
+        start = time.perf_counter()
+        for _ in range(iters):
+            layer(x)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def benchmark(super_in_dim, super_out_dim, sample_in_dim, sample_out_dim, args):
+    layer = LinearSuper(super_in_dim=super_in_dim, super_out_dim=super_out_dim)
+    layer.eval()
+    layer.set_sample_config(sample_in_dim=sample_in_dim, sample_out_dim=sample_out_dim)
+    x = torch.randn(args.tokens, sample_in_dim)
+
+    layer.freeze_samples(False)
+    strided = time_forward(layer, x, args.iters, args.warmup)
+    expected = layer(x)
+
+    layer.freeze_samples(True)
+    frozen = time_forward(layer, x, args.iters, args.warmup)
+    with torch.no_grad():
+        assert torch.allclose(layer(x), expected, atol=1e-5)
+
+    return strided, frozen
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-layer speedup of frozen contiguous LinearSuper slices on CPU')
+    parser.add_argument('--super-embed-dim', type=int, default=640)
+    parser.add_argument('--super-ffn-embed-dim', type=int, default=3072)
+    parser.add_argument('--embed-dims', type=int, nargs='+', default=[512, 640])
+    parser.add_argument('--ffn-embed-dims', type=int, nargs='+', default=[1024, 2048, 3072])
+    parser.add_argument('--tokens', type=int, default=128, help='rows of the input, e.g. batch size x beam for one decoding step')
+    parser.add_argument('--iters', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--num-threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(1)
+
+    print(f'| tokens {args.tokens}, {args.num_threads} thread(s), latency in ms')
+    print(f'| {"layer":<8}{"in":>6}{"out":>6}{"strided":>10}{"frozen":>10}{"speedup":>9}')
+    for embed_dim in args.embed_dims:
+        layers = [('qkv', args.super_embed_dim, args.super_embed_dim, embed_dim, args.super_embed_dim)]
+        for ffn_embed_dim in args.ffn_embed_dims:
+            layers.append(('fc1', args.super_embed_dim, args.super_ffn_embed_dim, embed_dim, ffn_embed_dim))
+            layers.append(('fc2', args.super_ffn_embed_dim, args.super_embed_dim, ffn_embed_dim, embed_dim))
+        for name, super_in_dim, super_out_dim, sample_in_dim, sample_out_dim in layers:
+            strided, frozen = benchmark(super_in_dim, super_out_dim, sample_in_dim, sample_out_dim, args)
+            print(f'| {name:<8}{sample_in_dim:>6}{sample_out_dim:>6}{strided:>10.3f}{frozen:>10.3f}{strided / frozen:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
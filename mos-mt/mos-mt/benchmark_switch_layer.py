@@ -0,0 +1,83 @@
+#!/usr/bin/env python3 -u
+"""
+CPU micro-benchmark of the batched expert dispatch of SwitchFNN against a
+per-expert loop over the tokens routed to every expert, for top-k routing
+without token dropping (the outputs of both are then compared).
+"""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+import fairseq.init as init
+from fairseq.modules import SwitchFNN
+
+
+def loop_forward(layer, x):
+    """Reference: every expert runs on its own tokens with the sampled LinearSuper layers."""
+    seq_len, batch_size, d_model = x.shape
+    x = x.reshape(seq_len * batch_size, d_model)
+    route_prob = layer.softmax(layer.router_forward(x))
+    route_prob_max, routes = torch.topk(route_prob, k=layer.sample_num_experts_to_route, dim=-1)
+    output = x.new_zeros(x.shape)
+    for k in range(layer.sample_num_experts_to_route):
+        expert_output = x.new_zeros(x.shape)
+        for i in range(layer.sample_n_experts):
+            indexes = torch.eq(routes[:, k], i).nonzero(as_tuple=True)[0]
+            if layer.is_first_expert_identity and i == 0:
+                expert_output[indexes] = x[indexes]
+                continue
+            expert_output[indexes] = layer.experts[i][1](layer.activation_fn(layer.experts[i][0](x[indexes])))
+        output += expert_output * route_prob_max[:, k:k + 1]
+    return output.view(seq_len, batch_size, d_model)
+
+
+def time_forward(fn, x, iters, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(x)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speedup of the batched SwitchFNN expert dispatch on CPU')
+    parser.add_argument('--embed-dim', type=int, default=512)
+    parser.add_argument('--ffn-embed-dim', type=int, default=2048)
+    parser.add_argument('--n-experts', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--num-experts-to-route', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--tokens', type=int, default=4096, help='rows of the input, e.g. tokens of a training batch')
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--num-threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(1)
+
+    print(f'| tokens {args.tokens}, embed {args.embed_dim}, ffn {args.ffn_embed_dim}, {args.num_threads} thread(s), latency in ms')
+    print(f'| {"experts":>8}{"top-k":>7}{"loop":>10}{"batched":>10}{"speedup":>9}{"max diff":>11}')
+    for n_experts in args.n_experts:
+        layer = SwitchFNN(capacity_factor=1.0, drop_tokens=False, is_scale_prob=True, super_n_experts=n_experts,
+                          super_d_model=args.embed_dim, super_ffn_embed_dim_this_layer=args.ffn_embed_dim,
+                          uniform_=init.uniform_, ffn1_non_linear='relu', ffn2_non_linear='linear',
+                          activation_fn=F.relu, expert_dropout_ratio=1.0)
+        layer.eval()
+        x = torch.rand(args.tokens // 8, 8, args.embed_dim)
+        for num_experts_to_route in args.num_experts_to_route:
+            if num_experts_to_route > n_experts:
+                continue
+            layer.set_sample_config(args.embed_dim, args.ffn_embed_dim, 0.0, 0.0, n_experts, num_experts_to_route)
+            loop = time_forward(lambda x: loop_forward(layer, x), x, args.iters, args.warmup)
+            batched = time_forward(layer, x, args.iters, args.warmup)
+            with torch.no_grad():
+                diff = (loop_forward(layer, x) - layer(x)[0]).abs().max().item()
+            print(f'| {n_experts:>8}{num_experts_to_route:>7}{loop:>10.3f}{batched:>10.3f}{loop / batched:>8.2f}x{diff:>11.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3 -u
+"""
+Dump the top-k output probabilities of a fixed teacher (a SubTransformer of a
+trained SuperTransformer, or a plain Transformer) on every target token of a
+split, for training with --teacher-topk-cache instead of running the teacher.
+"""
+
+import torch
+
+from fairseq import checkpoint_utils, fed_utils, options, tasks, utils
+
+
+def main(args):
+    assert args.path is not None, '--path required for the teacher!'
+    assert args.teacher_topk_prefix is not None, '--teacher-topk-prefix required for the dump!'
+
+    utils.import_user_module(args)
+
+    if args.max_tokens is None and args.max_sentences is None:
+        args.max_tokens = 12000
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    task = tasks.setup_task(args)
+    task.load_dataset(args.gen_subset)
+
+    print('| loading teacher from {}'.format(args.path))
+    models, _model_args = checkpoint_utils.load_model_ensemble(
+        [args.path],
+        arg_overrides=eval(args.model_overrides),
+        task=task,
+    )
+    model = models[0]
+    if hasattr(model, 'set_sample_config'):
+        config = utils.get_subtransformer_config(args)
+        model.set_sample_config(config, arch_embeds=utils.get_config_features(config, args))
+    if args.fp16 and use_cuda:
+        model.half()
+    if use_cuda:
+        model.cuda()
+
+    num_tokens = fed_utils.dump_teacher_topk(args, task, model, args.teacher_topk_prefix)
+    print('| dumped the top-{} teacher probabilities of {} {} examples ({} tokens) to {}'.format(
+        args.distill_topk, len(task.dataset(args.gen_subset)), args.gen_subset, num_tokens, args.teacher_topk_prefix))
+
+
+def cli_main():
+    parser = options.get_generation_parser()
+    parser.add_argument('--teacher-topk-prefix', type=str, help='prefix of the teacher cache files to write')
+    parser.add_argument('--distill-topk', type=int, default=8, help='number of teacher probabilities kept per target token')
+
+    parser.add_argument('--encoder-embed-dim-subtransformer', type=int, help='subtransformer encoder embedding dimension',
+                        default=None)
+    parser.add_argument('--decoder-embed-dim-subtransformer', type=int, help='subtransformer decoder embedding dimension',
+                        default=None)
+
+    parser.add_argument('--encoder-ffn-embed-dim-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-ffn-embed-dim-all-subtransformer', nargs='+', default=None, type=int)
+
+    parser.add_argument('--encoder-layer-num-subtransformer', type=int, help='subtransformer num encoder layers')
+    parser.add_argument('--decoder-layer-num-subtransformer', type=int, help='subtransformer num decoder layers')
+
+    parser.add_argument('--encoder-self-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-self-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-ende-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+
+    parser.add_argument('--decoder-arbitrary-ende-attn-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--encoder-n-experts', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-n-experts', nargs='+', default=None, type=int)
+
+    parser.add_argument('--encoder-num-experts-to-route', type=int, nargs='+', default=[1], help="Number of experts route to")
+    parser.add_argument('--encoder-drop-ffn-sublayer', type=int, nargs='+', default=[1], help="Drop FFN sublayers?")
+    parser.add_argument('--encoder-drop-mha-sublayer', type=int, nargs='+', default=[1], help="Drop MHA sublayers?")
+    parser.add_argument('--decoder-num-experts-to-route', type=int, nargs='+', default=[1], help="Number of experts route to")
+    parser.add_argument('--decoder-drop-ffn-sublayer', type=int, nargs='+', default=[1], help="Drop FFN sublayers?")
+    parser.add_argument('--decoder-drop-mha-sublayer', type=int, nargs='+', default=[1], help="Drop MHA sublayers?")
+
+    parser.add_argument('--encoder-std-vs-dummy-experts', type=int, nargs='+', default=[1], help="To put Std. vs. Dummy Experts in a layer. Used only for layers where number of experts is more than one. 1 means std experts, 0 means dummy experts")
+    parser.add_argument('--decoder-std-vs-dummy-experts', type=int, nargs='+', default=[1], help="To put Std. vs. Dummy Experts in a layer. Used only for layers where number of experts is more than one. 1 means std experts, 0 means dummy experts")
+    parser.add_argument('--encoder-each-expert-ffn-dim-listoflist', type=str, nargs='+', default=None, help="FFN-dim for each expert from evo search. Used only for layers where number of experts is more than one. 1 means homogeneous experts, 0 means heterogenous experts")
+    parser.add_argument('--decoder-each-expert-ffn-dim-listoflist', type=str, nargs='+', default=None, help="FFN-dim for each expert from evo search. Used only for layers where number of experts is more than one. 1 means homogeneous experts, 0 means heterogenous experts")
+
+    parser.add_argument("--hypernet-input-format", type=str, default="aggr", help=f"aggregate or fine grained features")
+
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
@@ -9,7 +9,8 @@ import pdb
 import json
 from fairseq import checkpoint_utils, distributed_utils, options, progress_bar, tasks, utils
 from fairseq.trainer import Trainer
-from fairseq.evolution import Evolution
+from fairseq.evolution import Evolution, build_supernet
+from fairseq.latency_harness import LatencyHarness
 
 
 def main(args):
@@ -28,31 +29,15 @@ def main(args):
     # Print args
     print(args)
 
-    # Setup task, e.g., translation, language modeling, etc.
-    task = tasks.setup_task(args)
-
-    # Load valid dataset (we load training data below, based on the latest checkpoint)
-    for valid_sub_split in args.valid_subset.split(','):
-        task.load_dataset(valid_sub_split, combine=False, epoch=0)
-
-    # Build model and criterion
-    model = task.build_model(args)
-    criterion = task.build_criterion(args)
-    generator = None
-    if args.validation_metric == "bleu":
-        generator = task.build_generator(args)
+    # task, model and trainer loaded from the latest checkpoint
+    task, model, trainer, epoch_itr, generator = build_supernet(args)
     print(model)
 
-    # Build trainer
-    trainer = Trainer(args, task, model, criterion)
-
-    # Load the latest checkpoint if one is available and restore the corresponding train iterator
-    args.train_subset = 'valid' # no need to train, so just set a small subset to save loading time
-    extra_state, epoch_itr = checkpoint_utils.load_checkpoint(args, trainer)
-
     # run evolutionary search to find the model with lowest loss and satisfies the latency requirement
     evolver = Evolution(args, trainer, task, epoch_itr, generator=generator)
     best_config, final_popu = evolver.run_evo_search()
+    if evolver.fitness_pool is not None:
+        evolver.fitness_pool.close()
     print('search done')
     print(best_config)
 
@@ -168,13 +153,23 @@ def cli_main():
 
     parser.add_argument('--write-config-path', type=str, help='path to write out the searched best SubTransformer')
 
-    parser.add_argument('--validation-metric', type=str, default="loss", help='loss or bleu or active_nonemb_params or nonemb_params')
+    parser.add_argument('--validation-metric', type=str, default="loss", help='loss or bleu or bleu_proxy or active_nonemb_params or nonemb_params')
+    parser.add_argument('--bleu-proxy-calib-size', type=int, default=16, help='number of random SubTransformers decoded with beam search to calibrate the BLEU proxy on (bleu_proxy only)')
+    parser.add_argument('--bleu-proxy-rescore-topk', type=int, default=5, help='re-rank this many of the best final SubTransformers by their real BLEU (bleu_proxy only)')
     parser.add_argument('--ind-bias-encoder-layers-greater-than-equal-to-decoder-layers', action='store_true', default=False)
 
     parser.add_argument('--flops-constraint-giga', type=float, default=-1, help='flops constraint in giga flops. -1 means no FLOPs constraint')
     parser.add_argument('--latency-compute', type=str, default="predictor", help='predictor or gold')
-    parser.add_argument('--latiter', type=int, default=50, help='number of latency iterations for using real latency. only used when latency-compute is gold')
+    parser.add_argument('--latiter', type=int, default=50, help='maximum number of latency iterations for using real latency. only used when latency-compute is gold')
+    LatencyHarness.add_args(parser)
     parser.add_argument('--deduppopu', type=int, default=0, help='remove duplicates in the evolutionary search population')
+    parser.add_argument('--candidate-batch-factor', type=int, default=4, help='draw mutated/crossovered/random genes in batches this many times larger than needed and check their constraints at once')
+    parser.add_argument('--fitness-cache-path', type=str, default=None, help='sqlite file to persist the fitness of evaluated SubTransformers across searches (keyed by config, checkpoint and validation setup)')
+    parser.add_argument('--fitness-workers', type=int, default=0, help='validate the population in this many worker processes, each with its own SuperTransformer replica (one GPU each when available, else CPU); 0 validates in the search process')
+    parser.add_argument('--successive-halving', action='store_true', default=False, help='validate the population with successive halving over the validation batches (loss only)')
+    parser.add_argument('--sh-min-batches', type=int, default=8, help='number of validation batches every config is run on before the first pruning')
+    parser.add_argument('--sh-eta', type=float, default=2, help='successive halving keeps the best 1/eta configs at each rung')
+    parser.add_argument('--sh-z', type=float, default=1.96, help='z-value of the confidence interval used to prune configs against the parent cutoff')
     parser.add_argument('--gpt4nas_out', type=str, default="", help='path to the gpt4nas output directory')
 
     options.add_generation_args(parser)
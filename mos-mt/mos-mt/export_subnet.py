@@ -0,0 +1,163 @@
+#!/usr/bin/env python3 -u
+"""
+Export a searched SubTransformer of a trained SuperTransformer as a compact
+standalone checkpoint: the hypernet-mixed experts are folded into plain
+fc1/fc2 weights and every parameter is sliced down to the sampled dims.
+"""
+
+import copy
+import os
+
+import torch
+
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.models.transformer_super import mix_arch_expert_weights
+
+
+def build_subnet_args(model_args, config):
+    """Model args of a SuperTransformer whose super dims are exactly the SubTransformer dims."""
+    if getattr(model_args, 'vocab_original_scaling', False):
+        raise NotImplementedError('--vocab-original-scaling scales embeddings by the super embed dim and cannot be exported')
+    if model_args.encoder_embed_dim != model_args.decoder_embed_dim:
+        raise NotImplementedError('exporting SuperTransformers with different encoder and decoder embed dims is not supported')
+
+    encoder_layer_num = config['encoder']['encoder_layer_num']
+    decoder_layer_num = config['decoder']['decoder_layer_num']
+    # keep a single embed dim so shared embeddings and the en-de attention projections keep their layout
+    embed_dim = max(config['encoder']['encoder_embed_dim'], config['decoder']['decoder_embed_dim'])
+
+    args = copy.deepcopy(model_args)
+    args.qkv_dim = model_args.qkv_dim if model_args.qkv_dim is not None else model_args.encoder_embed_dim
+    args.encoder_positional_embed_dim = getattr(model_args, 'encoder_positional_embed_dim', None) or model_args.encoder_embed_dim
+    args.decoder_positional_embed_dim = getattr(model_args, 'decoder_positional_embed_dim', None) or model_args.decoder_embed_dim
+
+    args.encoder_embed_dim = embed_dim
+    args.encoder_layers = encoder_layer_num
+    args.encoder_ffn_embed_dim = max(config['encoder']['encoder_ffn_embed_dim'][:encoder_layer_num])
+    args.decoder_embed_dim = embed_dim
+    args.decoder_layers = decoder_layer_num
+    args.decoder_ffn_embed_dim = max(config['decoder']['decoder_ffn_embed_dim'][:decoder_layer_num])
+    args.decoder_input_dim = args.decoder_output_dim = embed_dim
+
+    # the mixed experts live in fc1/fc2, so the hypernet and the other experts are dropped
+    args.max_experts = -1
+    return args
+
+
+def extract_subnet_state_dict(model, subnet, config):
+    """Slice the sampled weights of `model` into the state dict layout of `subnet`."""
+    super_state = model.state_dict()
+    state = subnet.state_dict()
+    for name, tensor in state.items():
+        super_tensor = super_state[name]
+        state[name] = super_tensor[tuple(slice(0, dim) for dim in tensor.size())].clone()
+
+    for part, layers in (('encoder', model.encoder.layers), ('decoder', model.decoder.layers)):
+        for i in range(config[part][part + '_layer_num']):
+            layer = layers[i]
+            if not hasattr(layer, 'max_experts'):
+                continue
+            mixed_weights = mix_arch_expert_weights(layer)
+            if mixed_weights is None:
+                continue
+            for key, weight in zip(['fc1.weight', 'fc1.bias', 'fc2.weight', 'fc2.bias'], mixed_weights):
+                name = '{}.layers.{}.{}'.format(part, i, key)
+                # rows beyond the sampled ffn dim of this layer are never used
+                state[name].zero_()
+                state[name][tuple(slice(0, dim) for dim in weight.size())] = weight
+    return state
+
+
+def main(args):
+    assert args.path is not None, '--path required for export!'
+    assert args.export_path is not None, '--export-path required for export!'
+
+    utils.import_user_module(args)
+
+    task = tasks.setup_task(args)
+
+    print('| loading supernet from {}'.format(args.path))
+    state = checkpoint_utils.load_checkpoint_to_cpu(args.path, arg_overrides=eval(args.model_overrides))
+    model = task.build_model(state['args'])
+    model.load_state_dict(state['model'], strict=False)
+    model.eval()
+
+    config = utils.get_subtransformer_config(args)
+    model.set_sample_config(config, arch_embeds=utils.get_config_features(config, args))
+
+    subnet_args = build_subnet_args(state['args'], config)
+    subnet = task.build_model(subnet_args)
+    with torch.no_grad():
+        subnet.load_state_dict(extract_subnet_state_dict(model, subnet, config), strict=True)
+    subnet.eval()
+    subnet.set_sample_config(config)
+
+    super_params = sum(p.numel() for p in model.parameters())
+    subnet_params = sum(p.numel() for p in subnet.parameters())
+    print('| supernet params: {}, subnet params: {} ({:.2f}x smaller)'.format(super_params, subnet_params, super_params / subnet_params))
+
+    # the exported SubTransformer has to reproduce the sampled supernet
+    src_dict, tgt_dict = task.source_dictionary, task.target_dictionary
+    src_tokens = torch.randint(src_dict.nspecial, len(src_dict), (2, 16))
+    src_lengths = torch.LongTensor([16, 16])
+    prev_output_tokens = torch.randint(tgt_dict.nspecial, len(tgt_dict), (2, 12))
+    with torch.no_grad():
+        super_out = model(src_tokens, src_lengths, prev_output_tokens)[0]
+        subnet_out = subnet(src_tokens, src_lengths, prev_output_tokens)[0]
+    print('| max abs diff of the decoder outputs: {:.3e}'.format((super_out - subnet_out).abs().max().item()))
+
+    state['args'] = subnet_args
+    state['model'] = subnet.state_dict()
+    # the optimizer state belongs to the supernet parameters
+    state.pop('last_optimizer_state', None)
+    state['extra_state']['subtransformer_config'] = config
+    dirname = os.path.dirname(args.export_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    checkpoint_utils.torch_persistent_save(state, args.export_path)
+    print('| exported SubTransformer to {}'.format(args.export_path))
+
+
+def cli_main():
+    parser = options.get_generation_parser()
+    parser.add_argument('--export-path', type=str, help='path to write the exported SubTransformer checkpoint')
+
+    parser.add_argument('--encoder-embed-dim-subtransformer', type=int, help='subtransformer encoder embedding dimension',
+                        default=None)
+    parser.add_argument('--decoder-embed-dim-subtransformer', type=int, help='subtransformer decoder embedding dimension',
+                        default=None)
+
+    parser.add_argument('--encoder-ffn-embed-dim-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-ffn-embed-dim-all-subtransformer', nargs='+', default=None, type=int)
+
+    parser.add_argument('--encoder-layer-num-subtransformer', type=int, help='subtransformer num encoder layers')
+    parser.add_argument('--decoder-layer-num-subtransformer', type=int, help='subtransformer num decoder layers')
+
+    parser.add_argument('--encoder-self-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-self-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-ende-attention-heads-all-subtransformer', nargs='+', default=None, type=int)
+
+    parser.add_argument('--decoder-arbitrary-ende-attn-all-subtransformer', nargs='+', default=None, type=int)
+    parser.add_argument('--encoder-n-experts', nargs='+', default=None, type=int)
+    parser.add_argument('--decoder-n-experts', nargs='+', default=None, type=int)
+
+    parser.add_argument('--encoder-num-experts-to-route', type=int, nargs='+', default=[1], help="Number of experts route to")
+    parser.add_argument('--encoder-drop-ffn-sublayer', type=int, nargs='+', default=[1], help="Drop FFN sublayers?")
+    parser.add_argument('--encoder-drop-mha-sublayer', type=int, nargs='+', default=[1], help="Drop MHA sublayers?")
+    parser.add_argument('--decoder-num-experts-to-route', type=int, nargs='+', default=[1], help="Number of experts route to")
+    parser.add_argument('--decoder-drop-ffn-sublayer', type=int, nargs='+', default=[1], help="Drop FFN sublayers?")
+    parser.add_argument('--decoder-drop-mha-sublayer', type=int, nargs='+', default=[1], help="Drop MHA sublayers?")
+
+    parser.add_argument('--encoder-std-vs-dummy-experts', type=int, nargs='+', default=[1], help="To put Std. vs. Dummy Experts in a layer. Used only for layers where number of experts is more than one. 1 means std experts, 0 means dummy experts")
+    parser.add_argument('--decoder-std-vs-dummy-experts', type=int, nargs='+', default=[1], help="To put Std. vs. Dummy Experts in a layer. Used only for layers where number of experts is more than one. 1 means std experts, 0 means dummy experts")
+    parser.add_argument('--encoder-each-expert-ffn-dim-listoflist', type=str, nargs='+', default=None, help="FFN-dim for each expert from evo search. Used only for layers where number of experts is more than one. 1 means homogeneous experts, 0 means heterogenous experts")
+    parser.add_argument('--decoder-each-expert-ffn-dim-listoflist', type=str, nargs='+', default=None, help="FFN-dim for each expert from evo search. Used only for layers where number of experts is more than one. 1 means homogeneous experts, 0 means heterogenous experts")
+
+    parser.add_argument("--hypernet-input-format", type=str, default="aggr", help=f"aggregate or fine grained features")
+
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
@@ -127,3 +127,68 @@ class Scorer(object):
         return fmt.format(order, self.score(order=order), *bleup,
                           self.brevity(), self.stat.predlen/self.stat.reflen,
                           self.stat.predlen, self.stat.reflen)
+
+
+class TensorScorer(Scorer):
+    """
+    Scorer of batches of padded token tensors, without leaving their device.
+
+    The n-grams of a batch are compared all at once, each prediction n-gram with the
+    n-grams of its own prediction and reference: the clipped matches are summed over
+    the first occurrence of every n-gram. The statistics are accumulated in a single
+    tensor (laid out as a BleuStat) and only copied to the host when they are read.
+    """
+
+    def __init__(self, pad, eos, unk):
+        self.pad = pad
+        self.eos = eos
+        self.unk = unk
+        self.reset()
+
+    def reset(self, one_init=False):
+        # initial counts, as bleu_zero_init / bleu_one_init of libbleu
+        if one_init:
+            self.init = [0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
+        else:
+            self.init = [0] * 10
+        self.stats = None
+        self._stat = None
+
+    def add(self, ref, pred):
+        """ref, pred: (bsz, len) token tensors padded with pad, eos tokens are left out."""
+        ref, pred = ref.long(), pred.long()
+        ref_valid = ref.ne(self.pad) & ref.ne(self.eos)
+        pred_valid = pred.ne(self.pad) & pred.ne(self.eos)
+        # don't match unknown words
+        ref = ref.masked_fill(ref.eq(self.unk), -1)
+
+        zero = pred_valid.new_zeros((), dtype=torch.long)
+        stats = [ref_valid.sum(), pred_valid.sum()]
+        for n in range(1, 5):
+            if pred.size(1) < n:
+                stats += [zero, zero]
+                continue
+            pred_ngrams = pred.unfold(1, n, 1)
+            pred_mask = pred_valid.unfold(1, n, 1).all(dim=-1)
+            if ref.size(1) < n:
+                stats += [zero, pred_mask.sum()]
+                continue
+            ref_ngrams = ref.unfold(1, n, 1)
+            ref_mask = ref_valid.unfold(1, n, 1).all(dim=-1)
+
+            # (bsz, pred n-gram, pred / ref n-gram) equalities between valid n-grams
+            same_pred = (pred_ngrams.unsqueeze(2) == pred_ngrams.unsqueeze(1)).all(dim=-1) & pred_mask.unsqueeze(1)
+            same_ref = (pred_ngrams.unsqueeze(2) == ref_ngrams.unsqueeze(1)).all(dim=-1) & ref_mask.unsqueeze(1)
+            earlier = torch.ones_like(same_pred[0]).tril(diagonal=-1)
+            first = pred_mask & ~(same_pred & earlier).any(dim=-1)
+            match = torch.min(same_pred.sum(dim=-1), same_ref.sum(dim=-1))
+            stats += [(match * first).sum(), pred_mask.sum()]
+        stats = torch.stack(stats)
+        self.stats = stats + stats.new_tensor(self.init) if self.stats is None else self.stats + stats
+        self._stat = None
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = BleuStat(*(self.stats.tolist() if self.stats is not None else self.init))
+        return self._stat
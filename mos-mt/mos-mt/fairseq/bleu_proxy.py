@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class BleuProxy(object):
+    """
+    Decoding-free stand-in for the BLEU of a SubTransformer.
+
+    A SubTransformer is described by teacher-forced statistics of a single forward over the
+    validation set: the token accuracy of its argmax predictions and their 1- to 4-gram
+    precisions against the references. The proxy is a ridge regression from the accuracy
+    and the log precisions to BLEU, fit on a few calibration SubTransformers scored with
+    real beam search BLEU.
+    """
+
+    def __init__(self, l2=1e-2):
+        self.l2 = l2
+        self.weights = None
+
+    @staticmethod
+    def _features(stats):
+        stats = np.asarray(stats, dtype=np.float64).reshape(-1, 5)
+        return np.concatenate([stats[:, :1], np.log(np.maximum(stats[:, 1:], 1e-9))], axis=1)
+
+    def fit(self, stats, bleus):
+        """Fits the proxy on the teacher-forced statistics and the BLEU of the calibration SubTransformers.
+
+        Returns the Pearson and Spearman correlations of the fitted proxy with the BLEU."""
+        assert len(stats) == len(bleus) and len(bleus) >= 2, 'calibration needs at least two SubTransformers'
+        x = self._features(stats)
+        self.mean, self.std = x.mean(axis=0), x.std(axis=0) + 1e-9
+        x = (x - self.mean) / self.std
+        y = np.asarray(bleus, dtype=np.float64)
+        self.bias = y.mean()
+        self.weights = np.linalg.solve(x.T @ x + self.l2 * len(y) * np.eye(x.shape[1]), x.T @ (y - self.bias))
+
+        pred = np.array(self.predict(stats))
+        if pred.std() == 0 or y.std() == 0:
+            return 0., 0.
+        pearson = np.corrcoef(pred, y)[0, 1]
+        spearman = np.corrcoef(pred.argsort().argsort(), y.argsort().argsort())[0, 1]
+        return pearson, spearman
+
+    def predict(self, stats):
+        assert self.weights is not None, 'the BLEU proxy is not calibrated'
+        x = (self._features(stats) - self.mean) / self.std
+        return (x @ self.weights + self.bias).tolist()
@@ -41,6 +41,7 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         self.decoder_load_balancing_loss_coeff = args.decoder_load_balancing_loss_coeff
         self.encoder_load_balancing_loss_coeff = args.encoder_load_balancing_loss_coeff
         self.thor_consistency_alpha = args.thor_consistency_alpha
+        self.sandwich_distill_alpha = getattr(args, 'sandwich_distill_alpha', 0.0)
 
     @staticmethod
     def add_args(parser):
@@ -53,9 +54,13 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         parser.add_argument('--thor-consistency-alpha', type=float, default=0.0)
         # fmt: on
 
-    def forward(self, model, sample, reduce=True):
+    def forward(self, model, sample, reduce=True, distill_target=None):
         """Compute the loss for the given sample.
 
+        *distill_target* (dict) is shared by the SubTransformers trained on the
+        same batch with the sandwich rule: the first call (the teacher) stores its
+        output distribution in it, the following calls are distilled from it.
+
         Returns a tuple with three elements:
         1) the loss
         2) the sample size, which is used as the denominator for the gradient
@@ -66,6 +71,11 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             loss, nll_loss, lprobs, target = self.compute_loss(model, net_output, sample, reduce=reduce)
         else:
             loss, nll_loss = self.compute_loss(model, net_output, sample, reduce=reduce)
+        distill_loss = None
+        if distill_target is not None:
+            distill_loss = self.compute_distill_loss(model, net_output, sample, distill_target, reduce=reduce)
+            if distill_loss is not None:
+                loss = (1. - self.sandwich_distill_alpha) * loss + self.sandwich_distill_alpha * distill_loss
         sample_size = sample['target'].size(0) if self.args.sentence_avg else sample['ntokens']
         logging_output = {
             'loss': utils.item(loss.data) if reduce else loss.data,
@@ -74,6 +84,8 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             'nsentences': sample['target'].size(0),
             'sample_size': sample_size,
         }
+        if distill_loss is not None:
+            logging_output['distill_loss'] = utils.item(distill_loss.data) if reduce else distill_loss.data
 
         # check to add switch load balancing loss
         if self.encoder_load_balancing_loss_coeff > 0 or self.decoder_load_balancing_loss_coeff > 0:
@@ -111,6 +123,33 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             return loss, nll_loss, model.get_normalized_probs(net_output, log_probs=False), target
         return loss, nll_loss
 
+    def compute_distill_loss(self, model, net_output, sample, distill_target, reduce=True):
+        """Soft cross-entropy with the teacher distribution over the non-pad tokens (None for the teacher).
+
+        With a teacher top-k cache (*teacher_output* of the batch) every config is distilled
+        from the cached top-k, renormalized, instead of from the first config.
+        """
+        lprobs = model.get_normalized_probs(net_output, log_probs=True)
+        lprobs = lprobs.view(-1, lprobs.size(-1))
+        non_pad_mask = model.get_targets(sample, net_output).view(-1).ne(self.padding_idx)
+        lprobs = lprobs[non_pad_mask]
+        if 'teacher_output' in sample:
+            topk_idx, topk_prob = sample['teacher_output']
+            topk_idx = topk_idx.view(-1, topk_idx.size(-1))[non_pad_mask]
+            topk_prob = topk_prob.view(-1, topk_prob.size(-1))[non_pad_mask].float()
+            topk_prob = topk_prob / topk_prob.sum(dim=-1, keepdim=True)
+            distill_loss = -(topk_prob * lprobs.gather(dim=-1, index=topk_idx)).sum(dim=-1)
+            if reduce:
+                distill_loss = distill_loss.sum()
+            return distill_loss
+        if 'probs' not in distill_target:
+            distill_target['probs'] = lprobs.detach().exp()
+            return None
+        distill_loss = -(distill_target['probs'] * lprobs).sum(dim=-1)
+        if reduce:
+            distill_loss = distill_loss.sum()
+        return distill_loss
+
     def symmetric_KL_loss(self, p, q, target, ignore_index):
         """ symmetric KL-divergence 1/2*(KL(p||q)+KL(q||p)) """
         non_pad_mask = target.ne(ignore_index)
@@ -135,6 +174,10 @@ class LabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         # check to add switch load balancing loss aggregate
         if len(logging_outputs) > 0 and 'switch_lb_loss' in logging_outputs[0]:
             aggregate_outputs['switch_lb_loss'] = sum(log.get('switch_lb_loss', 0) for log in logging_outputs) / sample_size / math.log(2) if sample_size > 0 else 0.
+        # check to add distillation loss, the teacher of the sandwich rule does not have one
+        if any('distill_loss' in log for log in logging_outputs):
+            distill_sample_size = sum(log.get('sample_size', 0) for log in logging_outputs if 'distill_loss' in log)
+            aggregate_outputs['distill_loss'] = sum(log.get('distill_loss', 0) for log in logging_outputs) / distill_sample_size / math.log(2) if distill_sample_size > 0 else 0.
         # check to add consistency loss
         if len(logging_outputs) > 0 and 'consistency_loss' in logging_outputs[0]:
             aggregate_outputs['consistency_loss'] = sum(log.get('consistency_loss', 0) for log in logging_outputs) / sample_size / math.log(2) if sample_size > 0 else 0.
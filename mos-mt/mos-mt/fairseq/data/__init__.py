@@ -16,6 +16,7 @@ from .language_pair_dataset import LanguagePairDataset
 from .distill_dataset import DistillDataset
 
 from .strip_token_dataset import StripTokenDataset
+from .teacher_topk_dataset import TeacherTopKBuilder, TeacherTopKDataset
 from .truncate_dataset import TruncateDataset
 
 from .iterators import (
@@ -42,6 +43,8 @@ __all__ = [
     'MMapIndexedDataset',
     'ShardedIterator',
     'StripTokenDataset',
+    'TeacherTopKBuilder',
+    'TeacherTopKDataset',
     "TruncateDataset",
     'TruncatedDictionary',
 ]
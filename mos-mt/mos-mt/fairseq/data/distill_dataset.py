@@ -116,6 +116,9 @@ class DistillDataset(FairseqDataset):
             source if it's present. Default: ``False``
         append_eos_to_target (bool, optional): if set, appends eos to end of
             target if it's absent. Default: ``False``
+        teacher_topk (~fairseq.data.TeacherTopKDataset, optional): top-k teacher
+            probabilities of the target tokens, used for training in place of
+            *topk_idxs* / *topk_probs*. Default: ``None``
     """
 
     def __init__(
@@ -125,7 +128,7 @@ class DistillDataset(FairseqDataset):
             left_pad_source=True, left_pad_target=False,
             max_source_positions=1024, max_target_positions=1024,
             shuffle=True, input_feeding=True, remove_eos_from_source=False, append_eos_to_target=False,
-            is_train=False,
+            is_train=False, teacher_topk=None,
             # upsampling_max=100000, expert_scores=None, 
     ):
         if tgt_dict is not None:
@@ -152,6 +155,7 @@ class DistillDataset(FairseqDataset):
 
         self.topk_idxs = topk_idxs
         self.topk_probs = topk_probs
+        self.teacher_topk = teacher_topk
 
         self.num_attn = num_attn
         self.attns = attns
@@ -191,6 +195,10 @@ class DistillDataset(FairseqDataset):
             it['alpha'] = self.DEFAULT_ALPHA
             it['num_attn'] = self.num_attn
             it['attns'] = self.attns[index]
+        elif self.teacher_topk is not None and self.is_train:
+            it['topk_idx'], it['topk_prob'] = self.teacher_topk[index]
+            assert it['topk_idx'].shape[0] == tgt_item.shape[0], (it['topk_idx'].shape, tgt_item.shape)
+            it['alpha'] = self.DEFAULT_ALPHA
         return it
 
     def __len__(self):
@@ -223,7 +231,8 @@ class DistillDataset(FairseqDataset):
         return collate(
             samples, pad_idx=self.src_dict.pad(), eos_idx=self.src_dict.eos(),
             left_pad_source=self.left_pad_source, left_pad_target=self.left_pad_target,
-            input_feeding=self.input_feeding, fp16=self.fp16
+            input_feeding=self.input_feeding, fp16=self.fp16,
+            **({'distill_topk': self.teacher_topk.topk} if self.teacher_topk is not None else {})
         )
 
     def get_dummy_batch(self, num_tokens, max_positions, src_len=128, tgt_len=128):
@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+# Files of a teacher cache with prefix p:
+#   p.json          topk and sizes, written last so that an interrupted dump is not a cache
+#   p.idx.npy       (token offset, number of tokens) of every example id, -1 for missing examples
+#   p.topk_idx.bin  int32 top-k target indices, number of tokens x topk
+#   p.topk_prob.bin float16 top-k teacher probabilities, number of tokens x topk
+# mos-bert reads and writes the same layout (utils/teacher_cache.py).
+
+
+def teacher_topk_exists(prefix):
+    return all(os.path.exists(prefix + suffix) for suffix in ['.json', '.idx.npy', '.topk_idx.bin', '.topk_prob.bin'])
+
+
+class TeacherTopKBuilder(object):
+    """Streams the per-token top-k of the teacher, example by example in any order, to a teacher cache."""
+
+    def __init__(self, prefix, topk, num_examples):
+        self.prefix = prefix
+        self.topk = topk
+        self.index = np.full((num_examples, 2), -1, dtype=np.int64)
+        self.num_tokens = 0
+        self.idx_file = open(prefix + '.topk_idx.bin', 'wb')
+        self.prob_file = open(prefix + '.topk_prob.bin', 'wb')
+
+    def add_item(self, example_id, topk_idx, topk_prob):
+        """topk_idx, topk_prob: (num tokens, topk) of one example."""
+        assert topk_idx.shape[-1] == self.topk
+        self.index[example_id] = self.num_tokens, topk_idx.shape[0]
+        self.idx_file.write(np.ascontiguousarray(topk_idx, dtype=np.int32).tobytes())
+        self.prob_file.write(np.ascontiguousarray(topk_prob, dtype=np.float16).tobytes())
+        self.num_tokens += topk_idx.shape[0]
+
+    def finalize(self):
+        self.idx_file.close()
+        self.prob_file.close()
+        np.save(self.prefix + '.idx.npy', self.index)
+        with open(self.prefix + '.json', 'w') as f:
+            json.dump({'topk': self.topk, 'num_tokens': self.num_tokens, 'num_examples': len(self.index)}, f)
+
+
+class TeacherTopKDataset(torch.utils.data.Dataset):
+    """
+    Zero-copy reader of a teacher cache, indexed by example id.
+
+    The .bin files are memory-mapped copy-on-write (nothing is written back), so an item is a pair of
+    (num tokens, topk) tensors viewing the mapped pages: int32 indices and float16 probabilities,
+    nothing is cached in memory besides what the OS keeps in its page cache.
+    """
+
+    def __init__(self, prefix):
+        assert teacher_topk_exists(prefix), f'no teacher top-k cache at {prefix}'
+        self.prefix = prefix
+        with open(prefix + '.json') as f:
+            meta = json.load(f)
+        self.topk = meta['topk']
+        self.num_tokens = meta['num_tokens']
+        self.index = np.load(prefix + '.idx.npy')
+        self._files = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'] = None
+        return state
+
+    def _open(self):
+        # lazily, so that every data loading worker maps the files itself
+        if self._files is None:
+            shape = (self.num_tokens, self.topk)
+            self._files = (
+                np.memmap(self.prefix + '.topk_idx.bin', dtype=np.int32, mode='c', shape=shape),
+                np.memmap(self.prefix + '.topk_prob.bin', dtype=np.float16, mode='c', shape=shape),
+            )
+        return self._files
+
+    def __getitem__(self, i):
+        offset, num_tokens = self.index[i]
+        assert offset >= 0, f'example {i} is not in the teacher cache'
+        topk_idx, topk_prob = self._open()
+        return (
+            torch.from_numpy(topk_idx[offset:offset + num_tokens]),
+            torch.from_numpy(topk_prob[offset:offset + num_tokens]),
+        )
@@ -9,10 +9,19 @@ import random
 import torchprofile
 import numpy as np
 import fairseq.utils as utils
-import time, json
-
-from fairseq import progress_bar, bleu
-from fairseq.data import dictionary
+import time, json, os, copy
+import contextlib
+
+from fairseq import checkpoint_utils, progress_bar, bleu, tasks
+from fairseq.meters import AverageMeter
+from fairseq.modules import LinearSuper
+from fairseq.bleu_proxy import BleuProxy
+from fairseq.fitness_cache import FitnessCache, file_digest
+from fairseq.gene_codec import GeneCodec
+from fairseq.successive_halving import SuccessiveHalving
+from fairseq.latency_harness import LatencyHarness
+from fairseq.parallel_fitness import FitnessWorkerPool
+from fairseq.trainer import Trainer
 from latency_predictor import LatencyPredictor
 
 
@@ -357,6 +366,8 @@ class Evolution(object):
         self.converter = Converter(args)
         self.gene_choice = self.converter.get_gene_choice()
         self.gene_len = len(self.gene_choice)
+        # populations are (num_genes, width) arrays, decoded to configs only for the genes that are scored
+        self.codec = GeneCodec(self.converter, self.gene_choice)
         self.evo_iter = args.evo_iter
         self.trainer = trainer
         self.task=task
@@ -398,54 +409,67 @@ class Evolution(object):
         # todo make it modifable from command line
         # todo max iterations = 5
         self.extra_args = {"latcpu": False, "latgpu": True, "beam": 5, "latiter": args.latiter}
+        self.latency_harness = LatencyHarness.from_args(args, 'cuda', max_iters=args.latiter)
 
         self.deduppopu = args.deduppopu
+        # candidates are drawn in batches this many times larger than needed and filtered by the constraints at once
+        self.candidate_batch_factor = getattr(args, 'candidate_batch_factor', 4)
+
+        self.fitness_cache = None
+        if getattr(args, 'fitness_cache_path', None):
+            self.fitness_cache = FitnessCache(args.fitness_cache_path, fitness_cache_namespace(args))
+
+        # worker processes with a SuperTransformer replica each, the population is then validated in parallel
+        self.fitness_pool = None
+        if getattr(args, 'fitness_workers', 0) > 0:
+            self.fitness_pool = FitnessWorkerPool(args.fitness_workers, build_fitness_evaluator, (args,))
+
+        # the population is ranked by a BLEU predicted from teacher-forced statistics (no decoding),
+        # calibrated on real BLEU at the start of the search, the best ones are re-scored with real BLEU at the end
+        self.bleu_proxy = None
+        if self.validation_metric == "bleu_proxy":
+            self.bleu_proxy = BleuProxy()
 
     def run_evo_search(self):
         start_time = time.time()
+        if self.bleu_proxy is not None:
+            self.calibrate_bleu_proxy()
         popu = None
         if len(self.args.gpt4nas_out) == 0:
             popu = self.random_sample(self.population_size)
         else:
-            popu = self.gpt4nas_sample(self.population_size)
+            popu = self.codec.encode(self.gpt4nas_sample(self.population_size))
 
         # save random popu
         # import pickle
-        # configs = [self.converter.gene2config(m) for m in popu]
+        # configs = [self.codec.gene2config(m) for m in popu]
         # pickle.dump(configs, open("/tmp/random_popu.pkl", "wb"))
 
         all_scores_list = []
 
-        '''
-        # remove duplicates from popu
-        existing_candidates_hash = {}
-        new_popu = []
-        for cand in popu:
-            if str(cand) in existing_candidates_hash:
-                continue
-            existing_candidates_hash[str(cand)] = True
-            new_popu.append(cand)
-        '''
         final_population = {}
         for i in range(self.evo_iter):
             print(f"| Start Iteration {i}:")
             popu_scores = self.get_scores(popu)
             print(f"| Iteration {i}, Lowest loss: {min(popu_scores)}")
 
-            if self.validation_metric == "bleu" or self.validation_metric == "active_nonemb_params" or self.validation_metric == "nonemb_params":
-                sorted_ind = np.array(popu_scores).argsort()[-self.parent_size:] # changed for BLEU
+            if self.validation_metric in ["bleu", "bleu_proxy", "active_nonemb_params", "nonemb_params"]:
+                sorted_ind = np.array(popu_scores).argsort()[::-1][:self.parent_size] # changed for BLEU, best first
             elif self.validation_metric == "loss":
                 sorted_ind = np.array(popu_scores).argsort()[:self.parent_size]
 
-            self.best_config = self.converter.gene2config(popu[sorted_ind[0]])
+            real_bleus = {}
+            if i == self.evo_iter-1 and self.bleu_proxy is not None and self.args.bleu_proxy_rescore_topk > 0:
+                sorted_ind, real_bleus = self.rescore_real_bleu(popu, sorted_ind)
+
+            self.best_config = self.codec.gene2config(popu[sorted_ind[0]])
             print(f"| Config for lowest loss model: {self.best_config}")
             if self.latency_compute == "predictor":
-                print(f"| Predicted latency for lowest loss model: {self.latency_predictor.predict_lat(self.converter.gene2config(popu[sorted_ind[0]]))}")
-            print(f"| Real latency for lowest loss model: {self.get_real_latency(self.converter.gene2config(popu[sorted_ind[0]]))}")
-            # print(self.converter.gene2config(popu[sorted_ind[0]]))
-            # print(f"| FLOPs for lowest loss model: {self.get_macs(self.converter.gene2config(popu[sorted_ind[0]]))}") # printing crazy-size tensor (todo: debug)
+                print(f"| Predicted latency for lowest loss model: {self.latency_predictor.predict_lat(self.best_config)}")
+            print(f"| Real latency for lowest loss model: {self.get_real_latency(self.best_config)}")
+            # print(f"| FLOPs for lowest loss model: {self.get_macs(self.best_config)}") # printing crazy-size tensor (todo: debug)
 
-            parents_popu = [popu[m] for m in sorted_ind]
+            parents_popu = popu[sorted_ind]
 
             parents_score = [popu_scores[m] for m in sorted_ind]
 
@@ -455,57 +479,26 @@ class Evolution(object):
                 for m in sorted_ind:
                     final_population[idx] = {}
                     final_population[idx]["supernet_val_score"] = popu_scores[m]
-                    final_population[idx]["gene_info"] = popu[m]
-                    cur_config = self.converter.gene2config(popu[m])
+                    if m in real_bleus:
+                        final_population[idx]["supernet_val_bleu"] = real_bleus[m]
+                    final_population[idx]["gene_info"] = self.codec.decode(popu[m])
+                    cur_config = self.codec.gene2config(popu[m])
                     if self.latency_compute == "predictor":
                         final_population[idx]["predicted_latency"] = self.latency_predictor.predict_lat(cur_config)
                     final_population[idx]["real_latency"] = self.get_real_latency(cur_config)
                     # final_population[idx]["macs"] = self.get_macs(cur_config)
                     final_population[idx]["model_size"] = self.trainer.model.get_sampled_params_numel(cur_config)
-                    final_population[idx]["config_info"] = cur_config                    
+                    final_population[idx]["config_info"] = cur_config
                     idx += 1
 
             all_scores_list.append(parents_score)
 
-            mutate_popu = []
-
-            k = 0
-            existing_candidates_hash = {}
-            for popu in parents_popu:
-                existing_candidates_hash[str(popu)] = True
-            retries = 0
-            while k < self.mutation_size:
-                mutated_gene = self.mutate(random.choices(parents_popu)[0])
-                if self.satisfy_constraints(mutated_gene): # and str(mutated_gene) not in existing_candidates_hash:
-                    if self.deduppopu == 1 and str(mutated_gene) in existing_candidates_hash:
-                        # print("duplicate ", str(mutated_gene))
-                        retries += 1
-                        if retries > 1000:
-                            break
-                        continue
-                    mutate_popu.append(mutated_gene)
-                    k += 1
-                    existing_candidates_hash[str(mutated_gene)] = True
-
-
-            crossover_popu = []
-
-            k = 0
-            retries = 0
-            while k < self.crossover_size:
-                crossovered_gene = self.crossover(random.sample(parents_popu, 2))
-                if self.satisfy_constraints(crossovered_gene):
-                    if self.deduppopu == 1 and str(crossovered_gene) in existing_candidates_hash:
-                        # print("duplicate ", str(crossovered_gene))
-                        retries += 1
-                        if retries > 1000:
-                            break
-                        continue
-                    crossover_popu.append(crossovered_gene)
-                    k += 1
-                    existing_candidates_hash[str(crossovered_gene)] = True
-
-            popu = parents_popu + mutate_popu + crossover_popu
+            existing_candidates_hash = set(self.codec.keys(parents_popu))
+            mutate_popu = self.sample_satisfying(lambda num: self.mutate(parents_popu, num), self.mutation_size, existing_candidates_hash)
+
+            crossover_popu = self.sample_satisfying(lambda num: self.crossover(parents_popu, num), self.crossover_size, existing_candidates_hash)
+
+            popu = np.concatenate([parents_popu, mutate_popu, crossover_popu])
 
             if len(popu) == 0:
                 print('popu is empty...')
@@ -513,95 +506,109 @@ class Evolution(object):
         return self.best_config, final_population
 
 
-    def crossover(self, genes):
-        crossovered_gene = []
-        for i in range(self.gene_len):
-            if i not in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] and i not in self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"]:
-                if np.random.uniform() < 0.5:
-                    crossovered_gene.append(genes[0][i])
-                else:
-                    crossovered_gene.append(genes[1][i])
-            else:
-                assert(isinstance(genes[0][i], list))
-                assert(isinstance(genes[1][i], list))
-                cur_parent, cur_child = None, None
-                if np.random.uniform() < 0.5:
-                    cur_parent = 0
-                    cur_child = genes[0][i]
-                else:
-                    cur_parent = 1
-                    cur_child = genes[1][i]
-                num_experts_in_this_layer = crossovered_gene[self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"][i]] if i in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] else crossovered_gene[self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"][i]]
-                possible_ffn_dims = self.converter.gene2config_bothways["encoder_ffn_embed_dim_choice"] if i in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] else self.converter.gene2config_bothways["decoder_ffn_embed_dim_choice"]
-                if len(cur_child) != num_experts_in_this_layer:
-                    if len(cur_child) > num_experts_in_this_layer:
-                        cur_child = cur_child[0:num_experts_in_this_layer]
-                    else:
-                        cur_child += [random.choice(possible_ffn_dims) for j in range(num_experts_in_this_layer-len(cur_child))]
-                assert(len(cur_child)==num_experts_in_this_layer)
-                crossovered_gene.append(cur_child)
-
-        self.gene_checker(crossovered_gene)
-        return crossovered_gene
-
-
-    def mutate(self, gene):
-        mutated_gene = []
-        for i in range(self.gene_len):
-            if np.random.uniform() < self.mutation_prob:
-                if i not in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] and i not in self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"]:
-                    mutated_gene.append(random.choices(self.gene_choice[i])[0])
-                else:
-                    assert(isinstance(gene[i], list))
-                    num_experts_in_this_layer = mutated_gene[self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"][i]] if i in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] else mutated_gene[self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"][i]]
-                    possible_ffn_dims = self.converter.gene2config_bothways["encoder_ffn_embed_dim_choice"] if i in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] else self.converter.gene2config_bothways["decoder_ffn_embed_dim_choice"]
-                    # assert(num_experts_in_this_layer == len(mutated_gene[i]))  # gene might've been mutated as well
-                    cur_gene = []
-                    for j in range(num_experts_in_this_layer):
-                        cur_gene.append(random.choice(possible_ffn_dims))
-                    mutated_gene.append(cur_gene)
-            else:
-                mutated_gene.append(gene[i])
+    def crossover(self, parents, num):
+        """num children of pairs of distinct random parents."""
+        first = np.random.randint(len(parents), size=num)
+        second = (first + np.random.randint(1, len(parents), size=num)) % len(parents)
+        return self.codec.crossover(parents[first], parents[second])
 
-        for gene_id in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"]:
-            num_experts_in_this_layer = mutated_gene[self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"][gene_id]]
-            if len(mutated_gene[gene_id]) != num_experts_in_this_layer:
-                # need to mutate this as well
-                possible_ffn_dims = self.converter.gene2config_bothways["encoder_ffn_embed_dim_choice"]
-                cur_child = mutated_gene[gene_id]
-                if len(cur_child) != num_experts_in_this_layer:
-                    if len(cur_child) > num_experts_in_this_layer:
-                        cur_child = cur_child[0:num_experts_in_this_layer]
-                    else:
-                        cur_child += [random.choice(possible_ffn_dims) for j in range(num_experts_in_this_layer-len(cur_child))]
-                mutated_gene[gene_id] = cur_child
-                
-        for gene_id in self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"]:
-            num_experts_in_this_layer =  mutated_gene[self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"][gene_id]]
-            if len(mutated_gene[gene_id]) != num_experts_in_this_layer:
-                # need to mutate this as well
-                possible_ffn_dims = self.converter.gene2config_bothways["decoder_ffn_embed_dim_choice"]
-                cur_child = mutated_gene[gene_id]
-                if len(cur_child) != num_experts_in_this_layer:
-                    if len(cur_child) > num_experts_in_this_layer:
-                        cur_child = cur_child[0:num_experts_in_this_layer]
-                    else:
-                        cur_child += [random.choice(possible_ffn_dims) for j in range(num_experts_in_this_layer-len(cur_child))]
-                mutated_gene[gene_id] = cur_child
 
-        self.gene_checker(mutated_gene)
-        return mutated_gene
+    def mutate(self, parents, num):
+        """num mutations of random parents."""
+        return self.codec.mutate(parents[np.random.randint(len(parents), size=num)], self.mutation_prob)
 
 
-    def get_scores(self, genes):
-        configs = []
-        for gene in genes:
-            configs.append(self.converter.gene2config(gene))
+    def get_scores(self, popu):
+        configs = [self.codec.gene2config(gene) for gene in popu]
+        scores = self.get_fitness(configs)
+        if self.bleu_proxy is not None:
+            scores = self.bleu_proxy.predict(scores)
+        return scores
 
-        scores = validate_all(self.args, self.trainer, self.task, self.epoch_iter, configs, self.generator)
+    def get_fitness(self, configs):
+        """validate_all of the configs, through the fitness cache and the worker pool."""
+        scores = [None for _ in configs]
+        if self.fitness_cache is not None:
+            # only validate the SubTransformers that no previous search has scored
+            scores = self.fitness_cache.get_many(configs)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if len(missing) > 0:
+            missing_configs = [configs[i] for i in missing]
+            pruned = [False for _ in missing]
+            if self.fitness_pool is not None:
+                # cache every score as soon as its worker is done, an interrupted search keeps them
+                missing_scores = [None for _ in missing]
+                for j, score in self.fitness_pool.imap_unordered(missing_configs):
+                    missing_scores[j] = score
+                    if self.fitness_cache is not None:
+                        self.fitness_cache.put(missing_configs[j], score)
+            elif self.args.successive_halving and self.validation_metric == "loss":
+                missing_scores, pruned = validate_all_successive_halving(self.args, self.trainer, self.task, self.epoch_iter, missing_configs, self.parent_size)
+            else:
+                missing_scores = validate_all(self.args, self.trainer, self.task, self.epoch_iter, missing_configs, self.generator)
+            for i, score in zip(missing, missing_scores):
+                scores[i] = score
+            if self.fitness_cache is not None and self.fitness_pool is None:
+                # scores of pruned configs are not comparable across searches
+                self.fitness_cache.put_many([c for c, p in zip(missing_configs, pruned) if not p], [s for s, p in zip(missing_scores, pruned) if not p])
+        if self.fitness_cache is not None:
+            print(f"| fitness cache: {len(configs) - len(missing)}/{len(configs)} hits")
 
         return scores
 
+    def get_real_bleu(self, configs):
+        return validate_all(self.args, self.trainer, self.task, self.epoch_iter, configs, self.generator, metric="bleu")
+
+    def calibrate_bleu_proxy(self):
+        """Fits the BLEU proxy on random SubTransformers, decoded with beam search."""
+        configs = [self.codec.gene2config(gene) for gene in self.random_sample(self.args.bleu_proxy_calib_size)]
+        stats = self.get_fitness(configs)
+        bleus = self.get_real_bleu(configs)
+        pearson, spearman = self.bleu_proxy.fit(stats, bleus)
+        print(f"| BLEU proxy calibrated on {len(configs)} SubTransformers: BLEU {min(bleus):.2f}-{max(bleus):.2f}, "
+              f"pearson {pearson:.3f}, spearman {spearman:.3f}")
+
+    def rescore_real_bleu(self, popu, sorted_ind):
+        """Re-ranks the top --bleu-proxy-rescore-topk genes of sorted_ind (best first) by their real BLEU."""
+        top = sorted_ind[:self.args.bleu_proxy_rescore_topk]
+        bleus = self.get_real_bleu([self.codec.gene2config(popu[m]) for m in top])
+        order = np.argsort(bleus, kind='stable')[::-1]
+        print(f"| Real BLEU of the top {len(top)} genes by BLEU proxy: {[round(bleus[j], 2) for j in range(len(top))]}")
+        return np.concatenate([top[order], sorted_ind[len(top):]]), {top[j]: bleus[j] for j in range(len(top))}
+
+    def satisfy_constraints_batch(self, popu):
+        """satisfy_constraints of a population array, with a single call to the latency predictor on features computed from the array."""
+        if self.latency_constraint == -1 or self.latency_compute != "predictor":
+            return np.array([self.satisfy_constraints(self.codec.decode(gene)) for gene in popu], dtype=bool)
+
+        latencies = self.latency_predictor.predict_lat_features(self.codec.latency_features(popu))
+        satisfy = np.array(latencies) <= self.latency_constraint
+        if self.args.ind_bias_encoder_layers_greater_than_equal_to_decoder_layers:
+            encoder_layer_num, decoder_layer_num = self.codec.layer_nums(popu)
+            satisfy &= encoder_layer_num >= decoder_layer_num
+        return satisfy
+
+    def sample_satisfying(self, sample_fn, sample_num, existing_candidates_hash):
+        """Draw genes from sample_fn(num) in oversized batches and keep the first sample_num ones that satisfy the constraints."""
+        popu = []
+        retries = 0
+        # oversampling only pays off when the constraints are checked by the predictor, gold latencies and FLOPs are measured per gene
+        batch_factor = self.candidate_batch_factor if self.latency_constraint != -1 and self.latency_compute == "predictor" else 1
+        while len(popu) < sample_num:
+            cands = sample_fn((sample_num - len(popu)) * batch_factor)
+            cands = cands[self.satisfy_constraints_batch(cands)]
+            for gene, key in zip(cands, self.codec.keys(cands)):
+                if self.deduppopu == 1 and key in existing_candidates_hash:
+                    retries += 1
+                    if retries > 1000:
+                        return np.array(popu, dtype=np.int32).reshape(-1, self.codec.width)
+                    continue
+                popu.append(gene)
+                existing_candidates_hash.add(key)
+                if len(popu) == sample_num:
+                    break
+        return np.array(popu, dtype=np.int32).reshape(-1, self.codec.width)
+
     def satisfy_constraints(self, gene):
         satisfy = True
 
@@ -640,7 +647,7 @@ class Evolution(object):
         return macs*2
 
     def get_real_latency(self, config):
-        return utils.measure_latency_during_search(self.args, self.trainer.model, self.dummy_src_tokens, self.dummy_prev, config, self.extra_args)
+        return utils.measure_latency_during_search(self.args, self.trainer.model, self.dummy_src_tokens, self.dummy_prev, config, self.extra_args, harness=self.latency_harness)
 
     def gpt4nas_sample(self, sample_num):
         # read json
@@ -705,33 +712,7 @@ class Evolution(object):
         return popu[0:sample_num]
 
     def random_sample(self, sample_num):
-        popu = []
-        i = 0
-        existing_candidates_hash = {}
-        retries = 0
-        while i < sample_num:
-            samp_gene = []
-            for k in range(self.gene_len):
-                if not isinstance(self.gene_choice[k][0], list):
-                    samp_gene.append(random.choices(self.gene_choice[k])[0])
-                else:
-                    assert k in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] or k in self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"]
-                    # encoder_each_expert_ffn_dim, decoder_each_expert_ffn_dim
-                    num_experts_in_this_layer = samp_gene[self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"][k]] if k in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"] else samp_gene[self.converter.gene2config_bothways["decoder_each_expert_ffn_dim"][k]]
-                    samp_gene.append(random.choices(self.gene_choice[k][0], k=num_experts_in_this_layer))
-            if self.satisfy_constraints(samp_gene):
-                if self.deduppopu == 1 and str(samp_gene) in existing_candidates_hash:
-                    # print("duplicate ", str(samp_gene))
-                    retries += 1
-                    if retries > 1000:
-                        break
-                    continue
-                self.gene_checker(samp_gene)
-                popu.append(samp_gene)
-                i += 1
-                existing_candidates_hash[str(samp_gene)] = True
-
-        return popu
+        return self.sample_satisfying(self.codec.random, sample_num, set())
 
     def gene_checker(self, gene):
         for gene_id in self.converter.gene2config_bothways["encoder_each_expert_ffn_dim"]:
@@ -790,80 +771,250 @@ def test():
     print(converter.get_gene_choice())
 
 
-def validate_all(args, trainer, task, epoch_itr, configs, generator):
-    """Evaluate the model on the validation set(s) and return the losses."""
+def fitness_cache_namespace(args):
+    """Everything besides the SubTransformer config that the score of validate_all depends on."""
+    if args.restore_file == 'checkpoint_last.pt':
+        checkpoint_path = os.path.join(args.save_dir, 'checkpoint_last.pt')
+    else:
+        checkpoint_path = args.restore_file
+    namespace = {'checkpoint': file_digest(checkpoint_path), 'data': os.path.abspath(args.data)}
+    for key in ['source_lang', 'target_lang', 'max_tokens_valid', 'max_sentences_valid', 'valid_cnt_max', 'validation_metric',
+                'distributed_world_size', 'seed', 'beam', 'lenpen', 'max_len_a', 'max_len_b', 'remove_bpe']:
+        namespace[key] = getattr(args, key, None)
+    # the same SubTransformer config is a different model under another SuperTransformer layout or expert routing
+    for key in ['arch', 'qkv_dim', 'vocab_original_scaling', 'encoder_positional_embed_dim', 'decoder_positional_embed_dim',
+                'hypernet_hidden_size', 'max_experts', 'expert_routing_type', 'fixed_hypernet_input', 'expert_layer_freq',
+                'hypernet_input_format']:
+        namespace[key] = getattr(args, key, None)
+    for prefix in ['encoder', 'decoder']:
+        for key in ['n_experts', 'expert_type', 'is_scale_prob', 'drop_tokens', 'capacity_factor', 'expert_dropout_ratio',
+                    'is_first_expert_identity', 'expert_all_fixed_num_experts', 'num_experts_to_route', 'drop_ffn_sublayer',
+                    'drop_mha_sublayer', 'std_vs_dummy_experts', 'each_expert_ffn_dim', 'each_expert_ffn_dim_listoflist']:
+            namespace[prefix + '_' + key] = getattr(args, prefix + '_' + key, None)
+    return namespace
+
+
+def get_valid_itr(args, trainer, task, epoch_itr):
+    # Initialize data iterator
+    itr = task.get_batch_iterator(
+        dataset=task.dataset('valid'),
+        max_tokens=args.max_tokens_valid,
+        max_sentences=args.max_sentences_valid,
+        max_positions=utils.resolve_max_positions(
+            task.max_positions(),
+            trainer.get_model().max_positions(),
+        ),
+        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
+        required_batch_size_multiple=args.required_batch_size_multiple,
+        seed=args.seed,
+        num_shards=args.distributed_world_size,
+        shard_id=args.distributed_rank,
+        num_workers=args.num_workers,
+    ).next_epoch_itr(shuffle=False)
+    progress = progress_bar.build_progress_bar(
+        args, itr, epoch_itr.epoch,
+        prefix='valid on \'{}\' subset'.format('valid'),
+    )
+    return progress
+
+
+@contextlib.contextmanager
+def sample_caches(model, enabled):
+    """Switch the materialized arch experts and the frozen LinearSuper slices on or off, restoring every module on exit.
+
+    Both are dropped by set_sample_config, and the inverted validation loops set every config again on every
+    batch: with a single forward per (batch, config), baking them would only add a copy of the weights."""
+    layers = [(m, m.materialize_experts) for m in model.modules() if hasattr(m, 'materialize_experts')]
+    linears = [(m, m.frozen_samples) for m in model.modules() if isinstance(m, LinearSuper)]
+    for m, mode in layers:
+        m.materialize_arch_experts(mode and enabled)
+    for m, mode in linears:
+        m.freeze_samples(mode and enabled)
+    try:
+        yield
+    finally:
+        for m, mode in layers:
+            m.materialize_arch_experts(mode)
+        for m, mode in linears:
+            m.freeze_samples(mode)
+
+
+def validate_all_successive_halving(args, trainer, task, epoch_itr, configs, keep_size):
+    """Validation loss of the configs with successive halving over the batches (see SuccessiveHalving).
+
+    Returns the scores to select on, pruned configs scoring inf, and which configs were pruned."""
+    halving = SuccessiveHalving(len(configs), keep_size, min_batches=args.sh_min_batches, eta=args.sh_eta, z=args.sh_z)
+    arch_embeds = [utils.get_config_features(config, None) for config in configs]
+    config_meters = [{k: AverageMeter() for k in ['valid_loss', 'valid_nll_loss']} for _ in configs]
+    trainer_meters = {k: trainer.get_meter(k) for k in ['valid_loss', 'valid_nll_loss']}
+
+    progress = get_valid_itr(args, trainer, task, epoch_itr)
+    valid_cnt, sampled = 0, None
+    with sample_caches(trainer.get_model(), enabled=len(configs) == 1):
+        for sample in progress:
+            valid_cnt += 1
+            if valid_cnt > args.valid_cnt_max:
+                break
+            sample = trainer._prepare_sample(sample)
+            for ci in halving.active:
+                if ci != sampled:
+                    trainer.set_sample_config(configs[ci], arch_embeds=arch_embeds[ci])
+                    sampled = ci
+                trainer.meters.update(config_meters[ci])
+                meter = config_meters[ci]['valid_loss']
+                count = meter.count
+                trainer.valid_step(sample)
+                halving.add(ci, meter.val, meter.count - count)
+            halving.step(valid_cnt)
+    trainer.meters.update(trainer_meters)
+
+    pruned = [halving.is_pruned(ci) for ci in range(len(configs))]
+    print(f"| successive halving: {len(configs) - sum(pruned)}/{len(configs)} configs validated on all batches, "
+          f"{sum(halving.num_batches)}/{len(configs) * max(halving.num_batches)} config-batches run")
+    return [halving.selection_score(ci) for ci in range(len(configs))], pruned
+
+
+def teacher_forced_step(trainer, sample, scorer):
+    """One forward of the sampled SubTransformer with the reference as decoder input: the n-gram statistics
+    of its argmax predictions are added to *scorer*, returns the number of correct tokens (on device)."""
+    model = trainer.get_model()
+    model.eval()
+    with torch.no_grad():
+        net_output = model(**sample['net_input'])
+    target = sample['target']
+    non_pad = target.ne(scorer.pad)
+    pred = net_output[0].argmax(dim=-1).masked_fill(~non_pad, scorer.pad)
+    correct = (pred.eq(target) & non_pad).sum()
+    # the final eos of the reference is left out of the n-grams, leave out the prediction at its position too
+    # (whatever was predicted there would otherwise count as an extra token of the hypothesis)
+    scorer.add(target, pred.masked_fill(target.eq(scorer.eos), scorer.eos))
+    return correct
+
+
+def validate_all(args, trainer, task, epoch_itr, configs, generator, metric=None):
+    """Evaluate the model on the validation set(s) and return the losses.
+
+    *metric* defaults to args.validation_metric. With "bleu_proxy" the score of a config is
+    its teacher-forced statistics [token accuracy, 1- to 4-gram precisions] (see BleuProxy)."""
+    metric = metric if metric is not None else args.validation_metric
     valid_losses = []
-        # Initialize data iterator
-    def get_itr():
-        itr = task.get_batch_iterator(
-            dataset=task.dataset('valid'),
-            max_tokens=args.max_tokens_valid,
-            max_sentences=args.max_sentences_valid,
-            max_positions=utils.resolve_max_positions(
-                task.max_positions(),
-                trainer.get_model().max_positions(),
-            ),
-            ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
-            required_batch_size_multiple=args.required_batch_size_multiple,
-            seed=args.seed,
-            num_shards=args.distributed_world_size,
-            shard_id=args.distributed_rank,
-            num_workers=args.num_workers,
-        ).next_epoch_itr(shuffle=False)
-        progress = progress_bar.build_progress_bar(
-            args, itr, epoch_itr.epoch,
-            prefix='valid on \'{}\' subset'.format('valid'),
-        )
-        return progress
-
-
-    for config in configs:
-        trainer.set_sample_config(config, arch_embeds=utils.get_config_features(config, None))
-        if args.validation_metric == "nonemb_params":
+
+    if metric == "nonemb_params":
+        for config in configs:
+            trainer.set_sample_config(config, arch_embeds=utils.get_config_features(config, None))
             nonemb_params = 0
             for name, param in trainer.model.named_parameters():
                 if 'embed' not in name:
                     nonemb_params += param.numel()
             valid_losses.append(nonemb_params)
-            continue
-
-        progress = get_itr()
-
-        # reset validation loss meters
-        for k in ['valid_loss', 'valid_nll_loss']:
-            meter = trainer.get_meter(k)
-            if meter is not None:
-                meter.reset()
-        valid_cnt = 0
-        if args.validation_metric == "bleu":
-            bleu_syss, bleu_refs = [], []
+        return valid_losses
+
+    # the loops are inverted: every batch is loaded and moved to device once and then
+    # run through all the configs, each of them accumulating into its own meters
+    arch_embeds = [utils.get_config_features(config, None) for config in configs]
+    config_meters = [{k: AverageMeter() for k in ['valid_loss', 'valid_nll_loss']} for _ in configs]
+    trainer_meters = {k: trainer.get_meter(k) for k in ['valid_loss', 'valid_nll_loss']}
+    if metric == "bleu" or metric == "bleu_proxy":
+        # BLEU statistics of the token ids, summed on device and read once per config
+        tgt_dict = task.target_dictionary
+        bleu_scorers = [bleu.TensorScorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk()) for _ in configs]
+    if metric == "bleu_proxy":
+        correct, ntokens = [0 for _ in configs], 0
+
+    progress = get_valid_itr(args, trainer, task, epoch_itr)
+    valid_cnt, sampled = 0, None
+    # beam search runs the decoder once per step on the same config, so the baked weights still pay off there
+    with sample_caches(trainer.get_model(), enabled=metric == "bleu" or len(configs) == 1):
         for sample in progress:
             valid_cnt += 1
             if valid_cnt > args.valid_cnt_max:
                 break
-            if args.validation_metric == "bleu":
-                log_output, bleu_input = trainer.valid_step(sample, generator)
-                bleu_syss += bleu_input[1]
-                bleu_refs += bleu_input[0]
-            else:
-                log_output = trainer.valid_step(sample)
+            # valid_step leaves a sample that is already on device (and in fp16) untouched
+            sample = trainer._prepare_sample(sample)
+            if metric == "bleu_proxy":
+                if sample is None:
+                    continue
+                ntokens += sample['ntokens']
+            for ci, config in enumerate(configs):
+                if ci != sampled:
+                    trainer.set_sample_config(config, arch_embeds=arch_embeds[ci])
+                    sampled = ci
+                if metric == "bleu_proxy":
+                    # no decoding, and no loss either
+                    correct[ci] += teacher_forced_step(trainer, sample, bleu_scorers[ci])
+                    continue
+                trainer.meters.update(config_meters[ci])
+                if metric == "bleu":
+                    log_output = trainer.valid_step(sample, generator, bleu_scorer=bleu_scorers[ci])
+                else:
+                    log_output = trainer.valid_step(sample)
+    trainer.meters.update(trainer_meters)
 
-        if args.validation_metric == "bleu":
+    for ci in range(len(configs)):
+        if metric == "bleu":
             # compute valid bleu score
-            dict_obj = dictionary.Dictionary()
-            scorer = bleu.Scorer(dict_obj.pad(), dict_obj.eos(), dict_obj.unk())
-            for (ref_tok, sys_tok) in zip(bleu_refs, bleu_syss):
-                sys_tok = dict_obj.encode_line(sys_tok)
-                ref_tok = dict_obj.encode_line(ref_tok)
-                scorer.add(ref_tok, sys_tok)
-            bleu_score = scorer.score(4) # consider ngrams up to this order 
+            bleu_score = bleu_scorers[ci].score(4) # consider ngrams up to this order 
 
             valid_losses.append(bleu_score)
-        elif args.validation_metric == "loss":
-            valid_losses.append(trainer.get_meter('valid_loss').avg)
+        elif metric == "bleu_proxy":
+            valid_losses.append([utils.item(correct[ci]) / max(ntokens, 1)] + bleu_scorers[ci].precision())
+        elif metric == "loss":
+            valid_losses.append(config_meters[ci]['valid_loss'].avg)
 
     return valid_losses
 
 
+def build_supernet(args):
+    """Task, trainer and valid iterator of the SuperTransformer to search, loaded from the latest checkpoint."""
+    # Setup task, e.g., translation, language modeling, etc.
+    task = tasks.setup_task(args)
+
+    # Load valid dataset (we load training data below, based on the latest checkpoint)
+    for valid_sub_split in args.valid_subset.split(','):
+        task.load_dataset(valid_sub_split, combine=False, epoch=0)
+
+    # Build model and criterion
+    model = task.build_model(args)
+    criterion = task.build_criterion(args)
+    generator = None
+    if args.validation_metric == "bleu" or args.validation_metric == "bleu_proxy":
+        # bleu_proxy decodes the calibration and re-scored SubTransformers
+        generator = task.build_generator(args)
+
+    # Build trainer
+    trainer = Trainer(args, task, model, criterion)
+
+    # Load the latest checkpoint if one is available and restore the corresponding train iterator
+    args.train_subset = 'valid' # no need to train, so just set a small subset to save loading time
+    extra_state, epoch_itr = checkpoint_utils.load_checkpoint(args, trainer)
+
+    # the supernet is only evaluated during search, so bake the arch-routed experts and the
+    # (contiguous) sampled weight slices once per candidate
+    model.materialize_arch_experts()
+    model.freeze_samples()
+
+    return task, model, trainer, epoch_itr, generator
+
+
+def build_fitness_evaluator(args):
+    """Runs in every FitnessWorkerPool worker: loads a replica of the supernet and returns the fitness of one config."""
+    args = copy.copy(args)
+    # the worker only sees its own device
+    args.device_id = 0
+    if torch.cuda.is_available() and not args.cpu:
+        torch.cuda.set_device(args.device_id)
+    else:
+        args.cpu = True
+        args.fp16 = False
+    torch.manual_seed(args.seed)
+
+    task, model, trainer, epoch_itr, generator = build_supernet(args)
+
+    def evaluate(config):
+        return validate_all(args, trainer, task, epoch_itr, [config], generator)[0]
+
+    return evaluate
+
+
 # if __name__=='__main__':
 #    test()
@@ -9,6 +9,7 @@ import numpy as np
 import ujson as json
 
 from fairseq.data.indexed_dataset import IndexedDatasetBuilder, IndexedCachedDataset
+from fairseq.data.teacher_topk_dataset import TeacherTopKBuilder
 
 FED_VERSION_FN = 'fed_version.v3.idx'
 
@@ -144,3 +145,37 @@ def gen_attn(args, task, trainer):
     return outputs
 
 
+def dump_teacher_topk(args, task, model, prefix):
+    """One pass of the teacher *model* over the *args.gen_subset* split, writing the top-k
+    probabilities of its non-pad target tokens to a teacher cache (TeacherTopKDataset)."""
+    model.eval()
+    dataset = task.dataset(args.gen_subset)
+    itr = task.get_batch_iterator(
+        dataset=dataset,
+        max_tokens=args.max_tokens,
+        max_sentences=args.max_sentences,
+        max_positions=utils.resolve_max_positions(
+            task.max_positions(),
+            model.max_positions(),
+        ),
+        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
+        required_batch_size_multiple=8,
+        seed=args.seed,
+    ).next_epoch_itr(shuffle=False)
+
+    builder = TeacherTopKBuilder(prefix, args.distill_topk, len(dataset))
+    for sample in tqdm(itr, mininterval=5):
+        if sample is None or len(sample) == 0:
+            continue
+        if torch.cuda.is_available() and not args.cpu:
+            sample = utils.move_to_cuda(sample)
+        with torch.no_grad():
+            net_output = model(**sample['net_input'])
+            probs = model.get_normalized_probs(net_output, log_probs=False)
+        topk_prob, topk_idx = probs.float().topk(args.distill_topk, dim=-1)
+        non_padding_mask = sample['target'].ne(task.target_dictionary.pad()).cpu().numpy()
+        topk_idx, topk_prob = topk_idx.cpu().numpy(), topk_prob.cpu().numpy()
+        for b, example_id in enumerate(sample['id'].tolist()):
+            builder.add_item(example_id, topk_idx[b, non_padding_mask[b]], topk_prob[b, non_padding_mask[b]])
+    builder.finalize()
+    return builder.num_tokens
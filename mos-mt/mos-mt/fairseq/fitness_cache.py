@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha1 of the file content, so that copies of a checkpoint share their cached scores."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def config_hash(config):
+    """Canonical hash of a (nested) SubTransformer config: key order and list/tuple types do not matter."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class FitnessCache(object):
+    """
+    Persistent store of the fitness of SubTransformers, shared across search runs.
+
+    Scores are keyed by the hash of the config within a namespace, which identifies the
+    supernet weights and the evaluation setup (dataset, subset size, metric, ...) so that
+    a score is only reused when re-evaluating would give the same number.
+    """
+
+    def __init__(self, path, namespace):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.namespace = config_hash(namespace)
+        # several searches may share the store, wait for their writes instead of failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS fitness ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, config TEXT, score TEXT NOT NULL, created REAL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        self.conn.commit()
+        self.hits, self.misses = 0, 0
+
+    def get_many(self, configs):
+        """Cached scores of `configs`, None for the ones never evaluated."""
+        scores = []
+        for config in configs:
+            row = self.conn.execute(
+                'SELECT score FROM fitness WHERE namespace = ? AND key = ?', (self.namespace, config_hash(config))
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                scores.append(None)
+            else:
+                self.hits += 1
+                scores.append(json.loads(row[0]))
+        return scores
+
+    def get(self, config):
+        return self.get_many([config])[0]
+
+    def put_many(self, configs, scores):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO fitness (namespace, key, config, score, created) VALUES (?, ?, ?, ?, ?)',
+            [(self.namespace, config_hash(config), json.dumps(config, sort_keys=True), json.dumps(score, default=float), now)
+             for config, score in zip(configs, scores)]
+        )
+        self.conn.commit()
+
+    def put(self, config, score):
+        self.put_many([config], [score])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,134 @@
+import numpy as np
+
+
+class GeneCodec(object):
+    """
+    Array encoding of the genes of a whole population for the evolutionary search.
+
+    A population is a (num_genes, width) int32 array with one column per gene position, except
+    for the per-expert FFN dims (`*_each_expert_ffn_dim`), which take a block of max-experts columns:
+    the slots past the number of experts of the layer (the linked `*_n_experts` position) hold 0.
+    Sampling, mutation and crossover draw all the random numbers of a population at once, rows are
+    hashed with `bytes`, and rows are only decoded to list genes / configs when needed.
+    """
+
+    def __init__(self, converter, gene_choice):
+        self.converter = converter
+        self.gene_len = len(gene_choice)
+        expert_links = dict(converter.gene2config_bothways['encoder_each_expert_ffn_dim'])
+        expert_links.update(converter.gene2config_bothways['decoder_each_expert_ffn_dim'])
+
+        col_pos = []
+        col_choices = []
+        # (first column, number of columns, column of the number of experts) of the per-expert FFN dims
+        self.expert_blocks = []
+        self.pos_cols = []
+        for i, choices in enumerate(gene_choice):
+            if i in expert_links:
+                width = max(gene_choice[expert_links[i]])
+                self.expert_blocks.append((len(col_pos), width, self.pos_cols[expert_links[i]].start))
+                self.pos_cols.append(slice(len(col_pos), len(col_pos) + width))
+                col_pos += [i] * width
+                col_choices += [choices[0]] * width
+            else:
+                self.pos_cols.append(slice(len(col_pos), len(col_pos) + 1))
+                col_pos.append(i)
+                col_choices.append(choices)
+        self.width = len(col_pos)
+        self.col_pos = np.array(col_pos)
+        self.num_choices = np.array([len(choices) for choices in col_choices])
+        self.choices = np.zeros((self.width, self.num_choices.max()), dtype=np.int32)
+        for col, choices in enumerate(col_choices):
+            self.choices[col, :len(choices)] = choices
+
+    def _fresh(self, num):
+        """A random choice for every column of num genes."""
+        idx = (np.random.uniform(size=(num, self.width)) * self.num_choices).astype(np.int64)
+        return self.choices[np.arange(self.width), idx]
+
+    def _fix_experts(self, popu, fresh):
+        # per-expert FFN dims follow the number of experts of their layer: extra ones are
+        # dropped, missing ones are drawn from fresh
+        for start, width, n_col in self.expert_blocks:
+            block = popu[:, start:start + width]
+            valid = np.arange(width) < popu[:, n_col:n_col + 1]
+            block[:] = np.where(valid & (block == 0), fresh[:, start:start + width], block)
+            block[~valid] = 0
+        return popu
+
+    def random(self, num):
+        fresh = self._fresh(num)
+        return self._fix_experts(fresh.copy(), fresh)
+
+    def mutate(self, parents, mutation_prob):
+        """Every position of every parent is resampled with probability mutation_prob."""
+        mutated = np.random.uniform(size=(len(parents), self.gene_len)) < mutation_prob
+        fresh = self._fresh(len(parents))
+        return self._fix_experts(np.where(mutated[:, self.col_pos], fresh, parents), fresh)
+
+    def crossover(self, parents0, parents1):
+        """Every position is taken from either parent with probability 0.5."""
+        pick0 = np.random.uniform(size=(len(parents0), self.gene_len)) < 0.5
+        fresh = self._fresh(len(parents0))
+        return self._fix_experts(np.where(pick0[:, self.col_pos], parents0, parents1), fresh)
+
+    @staticmethod
+    def keys(popu):
+        return [row.tobytes() for row in np.ascontiguousarray(popu, dtype=np.int32)]
+
+    def encode(self, genes):
+        """List genes (as built by Converter.config2gene) to a population array."""
+        popu = np.zeros((len(genes), self.width), dtype=np.int32)
+        for r, gene in enumerate(genes):
+            for i, cols in enumerate(self.pos_cols):
+                values = gene[i] if isinstance(gene[i], list) else [gene[i]]
+                popu[r, cols.start:cols.start + len(values)] = values
+        return popu
+
+    def decode(self, row):
+        """Population row to a list gene."""
+        values = row.tolist()
+        gene = [values[cols.start] for cols in self.pos_cols]
+        for start, width, n_col in self.expert_blocks:
+            gene[self.col_pos[start]] = values[start:start + values[n_col]]
+        return gene
+
+    def gene2config(self, row):
+        return self.converter.gene2config(self.decode(row))
+
+    def layer_nums(self, popu):
+        """Number of encoder and decoder layers of the genes."""
+        super_encoder_layer_num = self.converter.super_encoder_layer_num
+        return popu[:, 1], popu[:, 3 + 2 * super_encoder_layer_num]
+
+    def latency_features(self, popu):
+        """utils.get_config_features(config, None) of all the genes, computed on the array."""
+        E = self.converter.super_encoder_layer_num
+        D = self.converter.super_decoder_layer_num
+        popu = popu.astype(np.float64)
+        encoder_layer_num, decoder_layer_num = self.layer_nums(popu)
+        encoder_mask = np.arange(E) < encoder_layer_num[:, None]
+        decoder_mask = np.arange(D) < decoder_layer_num[:, None]
+
+        def mean(start, mask):
+            return (popu[:, start:start + mask.shape[1]] * mask).sum(1) / mask.sum(1)
+
+        # arbitrary ende attn -1/1/2 is a 1/2/3 feature, other values are left out of the mean
+        arbitrary_ende_attn = popu[:, 4 + 2 * E + 3 * D:4 + 2 * E + 4 * D]
+        arbitrary_ende_attn_trans = np.select([arbitrary_ende_attn == -1, arbitrary_ende_attn == 1, arbitrary_ende_attn == 2], [1, 2, 3], 0)
+        arbitrary_ende_attn_mask = decoder_mask & (arbitrary_ende_attn_trans > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            arbitrary_ende_attn_mean = (arbitrary_ende_attn_trans * arbitrary_ende_attn_mask).sum(1) / arbitrary_ende_attn_mask.sum(1)
+
+        return np.stack([
+            popu[:, 0],
+            encoder_layer_num,
+            mean(2, encoder_mask),
+            mean(2 + E, encoder_mask),
+            popu[:, 2 + 2 * E],
+            decoder_layer_num,
+            mean(4 + 2 * E, decoder_mask),
+            mean(4 + 2 * E + D, decoder_mask),
+            mean(4 + 2 * E + 2 * D, decoder_mask),
+            arbitrary_ende_attn_mean,
+        ], axis=1)
@@ -0,0 +1,145 @@
+import math
+import os
+import time
+
+import numpy as np
+import torch
+
+
+class LatencyHarness(object):
+    """
+    Measures the encoder and decoder latency of a (sampled) SuperTransformer.
+
+    Each part is warmed up until the timings are stable, then timed until the
+    confidence interval of the mean is within `rel_ci` of the mean (or `max_iters`
+    runs), so stable configs take few runs and noisy ones get more.
+    """
+
+    def __init__(self, device='cuda', min_warmup=5, max_warmup=50, warmup_window=5, warmup_tol=0.05,
+                 min_iters=10, max_iters=300, rel_ci=0.02, z=1.96, num_threads=None, cores=None):
+        assert device in ['cpu', 'cuda']
+        self.device = device
+        self.min_warmup = min_warmup
+        self.max_warmup = max_warmup
+        self.warmup_window = warmup_window
+        self.warmup_tol = warmup_tol
+        self.min_iters = min_iters
+        self.max_iters = max(max_iters, min_iters)
+        self.rel_ci = rel_ci
+        self.z = z
+        self.num_threads = num_threads
+        self.cores = cores
+
+    @staticmethod
+    def add_args(parser):
+        parser.add_argument('--lat-min-iters', type=int, default=10, help='minimum number of timed runs per latency measurement (--latiter is the maximum)')
+        parser.add_argument('--lat-max-warmup', type=int, default=50, help='maximum number of warmup runs, warmup stops earlier once timings are stable')
+        parser.add_argument('--lat-rel-ci', type=float, default=0.02, help='stop timing once the 95%% confidence interval of the mean latency is within this fraction of the mean')
+        parser.add_argument('--lat-num-threads', type=int, default=None, help='number of CPU threads used while measuring latency')
+        parser.add_argument('--lat-cores', type=int, nargs='+', default=None, help='CPU cores to pin the process to while measuring latency')
+
+    @classmethod
+    def from_args(cls, args, device, max_iters=None):
+        return cls(
+            device=device,
+            max_warmup=getattr(args, 'lat_max_warmup', 50),
+            min_iters=getattr(args, 'lat_min_iters', 10),
+            max_iters=max_iters if max_iters is not None else args.latiter,
+            rel_ci=getattr(args, 'lat_rel_ci', 0.02),
+            num_threads=getattr(args, 'lat_num_threads', None),
+            cores=getattr(args, 'lat_cores', None),
+        )
+
+    def time_run(self, fn):
+        """Latency of one call of fn in ms."""
+        if self.device == 'cuda':
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            fn()
+            end.record()
+            torch.cuda.synchronize()
+            return start.elapsed_time(end)
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) * 1000
+
+    def warmup(self, fn):
+        latencies = []
+        for i in range(self.max_warmup):
+            latencies.append(self.time_run(fn))
+            if i + 1 >= max(self.min_warmup, 2 * self.warmup_window):
+                prev = np.mean(latencies[-2 * self.warmup_window:-self.warmup_window])
+                cur = np.mean(latencies[-self.warmup_window:])
+                if abs(cur - prev) <= self.warmup_tol * cur:
+                    break
+        return len(latencies)
+
+    def time_until_stable(self, fn):
+        latencies = []
+        for i in range(self.max_iters):
+            latencies.append(self.time_run(fn))
+            n = len(latencies)
+            if n >= self.min_iters:
+                mean = np.mean(latencies)
+                half_width = self.z * np.std(latencies, ddof=1) / math.sqrt(n)
+                if half_width <= self.rel_ci * mean:
+                    break
+        return latencies
+
+    def summarize(self, latencies, warmup):
+        latencies = np.sort(np.array(latencies))
+        # drop the 10% tails for the mean and std to avoid outliers
+        trim = int(len(latencies) * 0.1)
+        trimmed = latencies[trim:len(latencies) - trim] if trim > 0 else latencies
+        return {
+            'mean': float(np.mean(trimmed)),
+            'std': float(np.std(trimmed)),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'iters': len(latencies),
+            'warmup': warmup,
+        }
+
+    def measure(self, model, src_tokens, src_lengths, prev_output_tokens, decoder_iterations):
+        """
+        Returns {'encoder': stats, 'decoder': stats} with the mean/std/p50/p90 latency in ms.
+        prev_output_tokens holds one row per beam; the decoder is run incrementally for
+        decoder_iterations steps.
+        """
+        prev_num_threads = torch.get_num_threads()
+        prev_cores = os.sched_getaffinity(0) if self.cores is not None else None
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        if self.cores is not None:
+            os.sched_setaffinity(0, self.cores)
+        try:
+            with torch.no_grad():
+                def run_encoder():
+                    return model.encoder(src_tokens=src_tokens, src_lengths=src_lengths)
+
+                encoder_warmup = self.warmup(run_encoder)
+                encoder_latencies = self.time_until_stable(run_encoder)
+
+                # beam to the batch dimension
+                new_order = torch.arange(src_tokens.size(0)).view(-1, 1).repeat(1, prev_output_tokens.size(0) // src_tokens.size(0)).view(-1).long().to(src_tokens.device)
+                encoder_out = model.encoder.reorder_encoder_out(run_encoder(), new_order)
+
+                # decoder is more complicated because we need to deal with incremental states and auto regressive things
+                def run_decoder():
+                    incre_states = {}
+                    for k_regressive in range(decoder_iterations):
+                        model.decoder(prev_output_tokens=prev_output_tokens[:, :k_regressive + 1],
+                                      encoder_out=encoder_out, incremental_state=incre_states)
+
+                decoder_warmup = self.warmup(run_decoder)
+                decoder_latencies = self.time_until_stable(run_decoder)
+        finally:
+            torch.set_num_threads(prev_num_threads)
+            if prev_cores is not None:
+                os.sched_setaffinity(0, prev_cores)
+
+        return {
+            'encoder': self.summarize(encoder_latencies, encoder_warmup),
+            'decoder': self.summarize(decoder_latencies, decoder_warmup),
+        }
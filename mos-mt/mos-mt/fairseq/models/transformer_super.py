@@ -36,6 +36,9 @@ import fairseq.init as init
 DEFAULT_MAX_SOURCE_POSITIONS = 1024
 DEFAULT_MAX_TARGET_POSITIONS = 1024
 
+ARCHROUTING_TYPES = ["archrouting_jack_2L", "archrouting_jack_3L", "archrouting_jack_4L", "archrouting_jack_drop_2L"]
+NEURONROUTING_TYPES = ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L", "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]
+
 class ResNet(torch.nn.Module):
     def __init__(self, module):
         super().__init__()
@@ -168,6 +171,10 @@ class TransformerSuperModel(SuperFairseqEncoderDecoderModel):
 
         parser.add_argument('--vocab-original-scaling', action='store_true', default=False)
 
+        # sinusoidal positions are sliced from the super embed dim, so exported SubTransformers keep that dim here
+        parser.add_argument('--encoder-positional-embed-dim', type=int, default=None, help='dim of the encoder positional embeddings, defaults to encoder-embed-dim')
+        parser.add_argument('--decoder-positional-embed-dim', type=int, default=None, help='dim of the decoder positional embeddings, defaults to decoder-embed-dim')
+
 
         # for SubTransformer
         parser.add_argument('--encoder-embed-dim-subtransformer', type=int, help='subtransformer encoder embedding dimension',
@@ -221,6 +228,7 @@ class TransformerSuperModel(SuperFairseqEncoderDecoderModel):
 
         # supernet tricks
         parser.add_argument('--sandwich-rule', type=int, help='n in sandwich rule', default=-1)
+        parser.add_argument('--sandwich-distill-alpha', type=float, default=0.0, help='with --sandwich-rule 1, weight of the distillation loss of the sampled and smallest SubTransformers from the largest one on the same batch (label_smoothed_cross_entropy only)')
 
         # arch moe params
         parser.add_argument("--hypernet-hidden-size", type=int, default=64, help=f"set hidden size for hypernet")
@@ -236,6 +244,20 @@ class TransformerSuperModel(SuperFairseqEncoderDecoderModel):
             if hasattr(module, 'profile') and self != module:
                 module.profile(mode)
 
+    def materialize_arch_experts(self, mode=True):
+        """Cache the hypernet-mixed FFN weights of every arch-routed layer per
+        sampled config, so eval/search/decoding only pays for the two GEMMs."""
+        for module in self.modules():
+            if hasattr(module, 'materialize_arch_experts') and self != module:
+                module.materialize_arch_experts(mode)
+
+    def freeze_samples(self, mode=True):
+        """Run every LinearSuper on contiguous copies of its sampled slices
+        when no gradients are needed (see LinearSuper.freeze_samples)."""
+        for module in self.modules():
+            if isinstance(module, LinearSuper):
+                module.freeze_samples(mode)
+
     def get_sampled_params_numel(self, config):
         self.set_sample_config(config, arch_embeds=utils.get_config_features(config, None))
         numels = []
@@ -358,7 +380,7 @@ class TransformerEncoder(FairseqEncoder):
         self.embed_tokens = embed_tokens
         # self.embed_scale = math.sqrt(embed_dim)
         self.embed_positions = PositionalEmbedding(
-            args.max_source_positions, self.super_embed_dim, self.padding_idx,
+            args.max_source_positions, getattr(args, 'encoder_positional_embed_dim', None) or self.super_embed_dim, self.padding_idx,
             learned=args.encoder_learned_pos,
         ) if not args.no_token_positional_embeddings else None
 
@@ -375,6 +397,9 @@ class TransformerEncoder(FairseqEncoder):
 
         self.vocab_original_scaling = args.vocab_original_scaling
 
+        # set by make_generation_fast_(), see reorder_encoder_out()
+        self.generation_fast = False
+
         # self.sample_scale = self.embed_scale
 
 
@@ -503,6 +528,12 @@ class TransformerEncoder(FairseqEncoder):
         Returns:
             *encoder_out* rearranged according to *new_order*
         """
+        if self.generation_fast and encoder_out['encoder_out'] is not None \
+                and encoder_out['encoder_out'].size(1) == new_order.size(0):
+            # beam search only reorders the beams of each sentence, which share the same
+            # encoder output, until finished sentences are dropped from the batch
+            return encoder_out
+
         if encoder_out['encoder_out'] is not None:
             encoder_out['encoder_out'] = \
                 encoder_out['encoder_out'].index_select(1, new_order)
@@ -519,6 +550,9 @@ class TransformerEncoder(FairseqEncoder):
 
         return encoder_out
 
+    def make_generation_fast_(self, **kwargs):
+        self.generation_fast = True
+
     def max_positions(self):
         """Maximum input length supported by the encoder."""
         if self.embed_positions is None:
@@ -604,7 +638,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
 
         self.embed_positions = PositionalEmbedding(
-            args.max_target_positions, self.super_embed_dim, padding_idx,
+            args.max_target_positions, getattr(args, 'decoder_positional_embed_dim', None) or self.super_embed_dim, padding_idx,
             learned=args.decoder_learned_pos,
         ) if not args.no_token_positional_embeddings else None
 
@@ -641,6 +675,11 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
         self.vocab_original_scaling = args.vocab_original_scaling
 
+        # inference only: contiguous copy of the sampled output projection and per-batch
+        # caching of the encoder outputs fed to each layer, see make_generation_fast_()
+        self.generation_fast = False
+        self.sampled_embed_out_cache = None
+
     def set_sample_config(self, config:dict, arch_embeds=None):
 
         self.sample_embed_dim = config['decoder']['decoder_embed_dim']
@@ -668,6 +707,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         self.sample_embed_scale = math.sqrt(self.sample_embed_dim) if not self.vocab_original_scaling else self.super_embed_scale
 
         self.embed_tokens.set_sample_config(sample_embed_dim=self.sample_embed_dim, part='decoder')
+        self.sampled_embed_out_cache = None
 
         if self.layer_norm is not None:
             self.layer_norm.set_sample_config(sample_embed_dim=self.sample_embed_dim)
@@ -762,33 +802,9 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             counts, route_prob, max_expert_per_layer = torch.zeros(self.super_n_experts, device=x.device), torch.zeros(self.super_n_experts, device=x.device), 0
 
         # decoder layers
+        encoder_feeds = self.get_encoder_feeds(encoder_out, incremental_state)
         for i, layer in enumerate(self.layers):
-            encoder_out_feed = None
-            encoder_padding_mask_feed = None
-
-            if encoder_out is not None:
-                # only use the last layer
-                if i >= self.sample_layer_num or self.sample_arbitrary_ende_attn[i] == -1:
-                    encoder_out_feed = encoder_out['encoder_out']
-                # concat one second last output layer
-                elif self.sample_arbitrary_ende_attn[i] == 1:
-                    encoder_out_feed = torch.cat([encoder_out['encoder_out'], encoder_out['encoder_out_all'][-2]], dim=0)
-                elif self.sample_arbitrary_ende_attn[i] == 2:
-                    encoder_out_feed = torch.cat([encoder_out['encoder_out'], encoder_out['encoder_out_all'][-2], encoder_out['encoder_out_all'][-3]], dim=0)
-                else:
-                    raise NotImplementedError("arbitrary_ende_attn should in [-1, 1, 2]")
-
-            if encoder_out['encoder_padding_mask'] is not None:
-                if i >= self.sample_layer_num or self.sample_arbitrary_ende_attn[i] == -1:
-                    encoder_padding_mask_feed = encoder_out['encoder_padding_mask']
-                # concat one more
-                elif self.sample_arbitrary_ende_attn[i] == 1:
-                    encoder_padding_mask_feed = torch.cat([encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask']], dim=1)
-                # concat two more
-                elif self.sample_arbitrary_ende_attn[i] == 2:
-                    encoder_padding_mask_feed = torch.cat([encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask']], dim=1)
-                else:
-                    raise NotImplementedError("arbitrary_ende_attn should in [-1, 1, 2]")
+            encoder_out_feed, encoder_padding_mask_feed = encoder_feeds[i]
 
             if self.decoder_return_switch_loss_balancing_params:
                 x, attn, (count, rprob, ndrop, rprobmax, sample_n_experts) = layer(
@@ -836,6 +852,51 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             output_dict['decoder_switch_loss_balancing_params'] = max_expert_per_layer * load_balancing_loss
         return x, output_dict
 
+    def build_encoder_feeds(self, encoder_out):
+        """Encoder output and padding mask fed to the encoder-decoder attention of each layer."""
+        encoder_feeds = []
+        for i in range(len(self.layers)):
+            encoder_out_feed = None
+            encoder_padding_mask_feed = None
+
+            if encoder_out is not None:
+                # only use the last layer
+                if i >= self.sample_layer_num or self.sample_arbitrary_ende_attn[i] == -1:
+                    encoder_out_feed = encoder_out['encoder_out']
+                # concat one second last output layer
+                elif self.sample_arbitrary_ende_attn[i] == 1:
+                    encoder_out_feed = torch.cat([encoder_out['encoder_out'], encoder_out['encoder_out_all'][-2]], dim=0)
+                elif self.sample_arbitrary_ende_attn[i] == 2:
+                    encoder_out_feed = torch.cat([encoder_out['encoder_out'], encoder_out['encoder_out_all'][-2], encoder_out['encoder_out_all'][-3]], dim=0)
+                else:
+                    raise NotImplementedError("arbitrary_ende_attn should in [-1, 1, 2]")
+
+            if encoder_out['encoder_padding_mask'] is not None:
+                if i >= self.sample_layer_num or self.sample_arbitrary_ende_attn[i] == -1:
+                    encoder_padding_mask_feed = encoder_out['encoder_padding_mask']
+                # concat one more
+                elif self.sample_arbitrary_ende_attn[i] == 1:
+                    encoder_padding_mask_feed = torch.cat([encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask']], dim=1)
+                # concat two more
+                elif self.sample_arbitrary_ende_attn[i] == 2:
+                    encoder_padding_mask_feed = torch.cat([encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask'], encoder_out['encoder_padding_mask']], dim=1)
+                else:
+                    raise NotImplementedError("arbitrary_ende_attn should in [-1, 1, 2]")
+
+            encoder_feeds.append((encoder_out_feed, encoder_padding_mask_feed))
+        return encoder_feeds
+
+    def get_encoder_feeds(self, encoder_out, incremental_state=None):
+        if not self.generation_fast or incremental_state is None or encoder_out is None:
+            return self.build_encoder_feeds(encoder_out)
+        # the concatenated encoder outputs only change when the encoder output is reordered,
+        # not at every decoding step
+        cached = utils.get_incremental_state(self, incremental_state, 'encoder_feeds')
+        if cached is None or cached['encoder_out'] is not encoder_out['encoder_out']:
+            cached = {'encoder_out': encoder_out['encoder_out'], 'feeds': self.build_encoder_feeds(encoder_out)}
+            utils.set_incremental_state(self, incremental_state, 'encoder_feeds', cached)
+        return cached['feeds']
+
     def output_layer(self, features, **kwargs):
         """Project features to the vocabulary size."""
         if self.adaptive_softmax is None:
@@ -843,10 +904,29 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             if self.share_input_output_embed:
                 return F.linear(features, self.embed_tokens.sampled_weight('decoder'))
             else:
-                return F.linear(features, self.embed_out[:, :self.sample_embed_dim])
+                return F.linear(features, self.sampled_embed_out())
         else:
             return features
 
+    def sampled_embed_out(self):
+        embed_out = self.embed_out[:, :self.sample_embed_dim]
+        if not self.generation_fast:
+            return embed_out
+        cached = self.sampled_embed_out_cache
+        # the copy does not follow half()/cuda() applied after the arch was sampled
+        if cached is None or cached.dtype != embed_out.dtype or cached.device != embed_out.device:
+            with torch.no_grad():
+                self.sampled_embed_out_cache = cached = embed_out.contiguous()
+        return cached
+
+    def make_generation_fast_(self, **kwargs):
+        self.generation_fast = True
+        self.sampled_embed_out_cache = None
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.sampled_embed_out_cache = None
+        super()._load_from_state_dict(*args, **kwargs)
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
@@ -943,6 +1023,10 @@ class TransformerEncoderLayer(nn.Module):
         self.sample_drop_ffn_sublayer = None
         self.layer_idx = layer_idx
 
+        # inference-only cache of the hypernet-mixed FFN weights, see materialize_arch_experts()
+        self.materialize_experts = False
+        self.materialized_expert_weights = None
+
 
         self.self_attn = MultiheadAttentionSuper(
             super_embed_dim=self.super_embed_dim, num_heads=self.super_self_attention_heads_this_layer, is_encoder=True,
@@ -977,7 +1061,7 @@ class TransformerEncoderLayer(nn.Module):
 
             if self.expert_layer_freq == -1 or (self.expert_layer_freq == 0.5 and (self.layer_idx+1)%2==0):
                 self.max_experts = args.max_experts
-                if self.expert_routing_type in ["archrouting_jack_2L", "archrouting_jack_3L", "archrouting_jack_4L", "archrouting_jack_drop_2L"]:
+                if self.expert_routing_type in ARCHROUTING_TYPES:
                     self.feature_norm = [640, 6, 2048, 6, 640, 6, 2048, 6, 6, 2] # todo: make dynamic
                     self.register_buffer("active_arch_embed", torch.zeros(40) if hasattr(self, "hypernet_input_format") and self.hypernet_input_format == "fine" else torch.zeros(10))
                     self.arch_expert = torch.nn.Sequential(
@@ -1017,7 +1101,7 @@ class TransformerEncoderLayer(nn.Module):
 
                     self.other_intermediate_experts = nn.ModuleList([LinearSuper(super_in_dim=self.super_embed_dim, super_out_dim=self.super_ffn_embed_dim_this_layer, uniform_=init.uniform_, non_linear='relu') for _ in range(self.max_experts-1)] )
                     self.other_output_experts = nn.ModuleList([LinearSuper(super_in_dim=self.super_ffn_embed_dim_this_layer, super_out_dim=self.super_embed_dim, uniform_=init.uniform_, non_linear='linear') for _ in range(self.max_experts-1)] )
-                if self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L", "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
+                if self.expert_routing_type in NEURONROUTING_TYPES:
                     self.feature_norm = [640, 6, 2048, 6, 640, 6, 2048, 6, 6, 2] # todo: make dynamic
                     self.register_buffer("active_arch_embed", torch.zeros(40) if hasattr(self, "hypernet_input_format") and self.hypernet_input_format == "fine" else torch.zeros(10))
                     if self.expert_routing_type == "neuronrouting_jack_2L":
@@ -1230,9 +1314,13 @@ class TransformerEncoderLayer(nn.Module):
             for i in range(len(self.other_intermediate_experts)):
                 self.other_intermediate_experts[i].set_sample_config(sample_in_dim=self.sample_embed_dim, sample_out_dim=self.sample_ffn_embed_dim_this_layer)
                 self.other_output_experts[i].set_sample_config(sample_in_dim=self.sample_ffn_embed_dim_this_layer, sample_out_dim=self.sample_embed_dim)
-            if self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L", "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
+            if self.expert_routing_type in NEURONROUTING_TYPES:
                 self.fc1_expert[-1].set_sample_config(sample_in_dim=self.hypernet_hidden_size, sample_out_dim=self.max_experts*self.sample_ffn_embed_dim_this_layer)
                 self.fc2_expert[-1].set_sample_config(sample_in_dim=self.hypernet_hidden_size, sample_out_dim=self.max_experts*self.sample_embed_dim)
+            # the hypernet input only changes here, so the mixed experts can be baked once for inference
+            self.materialized_expert_weights = None
+            if self.materialize_experts and not self.training:
+                get_arch_expert_weights(self)
 
 
     def upgrade_state_dict_named(self, state_dict, name):
@@ -1294,42 +1382,10 @@ class TransformerEncoderLayer(nn.Module):
             x = self.maybe_layer_norm(self.final_layer_norm, x, before=True)
             if self.super_n_experts == 0:
                 if hasattr(self, "max_experts"):
-                    # arch experts 
-                    if self.expert_routing_type in ["archrouting_jack_2L", "archrouting_jack_3L", "archrouting_jack_4L", "archrouting_jack_drop_2L"]:
-                        route_prob = self.arch_expert(self.active_arch_embed)
-                        route_prob_max, routes = torch.max(route_prob, dim=-1)
-                        intermediate_weights = route_prob[0] * self.fc1.samples["weight"]
-                        intermediate_bias = route_prob[0] * self.fc1.samples["bias"]
-                        layer_output_weights = route_prob[0] * self.fc2.samples["weight"]
-                        layer_output_bias = route_prob[0] * self.fc2.samples["bias"]
-                        for expert_id in range(self.max_experts-1):
-                            intermediate_weights = intermediate_weights + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].samples["weight"])
-                            intermediate_bias = intermediate_bias + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].samples["bias"])
-                            layer_output_weights = layer_output_weights + (route_prob[expert_id+1] * self.other_output_experts[expert_id].samples["weight"])
-                            layer_output_bias = layer_output_bias + (route_prob[expert_id+1] * self.other_output_experts[expert_id].samples["bias"])
-                        attention_output = x
-                        intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
-                        intermediate_output = self.activation_fn(intermediate_output)
-                        intermediate_output = F.dropout(intermediate_output, p=self.sample_activation_dropout, training=self.training)
-                        layer_output = F.linear(intermediate_output, layer_output_weights, layer_output_bias)
-                        layer_output = F.dropout(layer_output, p=self.sample_dropout, training=self.training)
-                        x = layer_output
-                    elif self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L",  "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
-                        fc1_expert_out = self.fc1_expert(self.active_arch_embed)
-                        fc1_expert_out = fc1_expert_out.view(-1, self.max_experts)
-                        fc1_expert_out = torch.nn.Softmax(dim=-1)(fc1_expert_out)
-                        fc2_expert_out = self.fc2_expert(self.active_arch_embed)
-                        fc2_expert_out = fc2_expert_out.view(-1, self.max_experts)
-                        fc2_expert_out = torch.nn.Softmax(dim=-1)(fc2_expert_out)
-                        intermediate_weights = self.fc1.samples["weight"] * fc1_expert_out[:, 0].view(-1,1)
-                        intermediate_bias = self.fc1.samples["bias"] * fc1_expert_out[:, 0]
-                        layer_output_weights = self.fc2.samples["weight"] * fc2_expert_out[:, 0].view(-1,1)
-                        layer_output_bias = self.fc2.samples["bias"] * fc2_expert_out[:, 0]
-                        for expert_id in range(self.max_experts-1):
-                            intermediate_weights = intermediate_weights + (self.other_intermediate_experts[expert_id].samples["weight"] * fc1_expert_out[:, expert_id+1].view(-1,1) )
-                            intermediate_bias = intermediate_bias + (self.other_intermediate_experts[expert_id].samples["bias"]  * fc1_expert_out[:, expert_id+1] )
-                            layer_output_weights = layer_output_weights + (self.other_output_experts[expert_id].samples["weight"]* fc2_expert_out[:, expert_id+1].view(-1,1))
-                            layer_output_bias = layer_output_bias + (self.other_output_experts[expert_id].samples["bias"]* fc2_expert_out[:, expert_id+1])
+                    # arch experts
+                    mixed_weights = get_arch_expert_weights(self)
+                    if mixed_weights is not None:
+                        intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias = mixed_weights
                         attention_output = x
                         intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
                         intermediate_output = self.activation_fn(intermediate_output)
@@ -1364,6 +1420,23 @@ class TransformerEncoderLayer(nn.Module):
         else:
             return x
 
+    def materialize_arch_experts(self, mode=True):
+        self.materialize_experts = mode
+        self.materialized_expert_weights = None
+
+    def train(self, mode=True):
+        # mixed expert weights go stale as soon as the experts are trained again
+        if mode:
+            self.materialized_expert_weights = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.materialized_expert_weights = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def make_generation_fast_(self, **kwargs):
+        self.materialize_arch_experts()
+
 
 class TransformerDecoderLayer(nn.Module):
     """Decoder layer block.
@@ -1425,6 +1498,10 @@ class TransformerDecoderLayer(nn.Module):
 
         self.layer_idx = layer_idx
 
+        # inference-only cache of the hypernet-mixed FFN weights, see materialize_arch_experts()
+        self.materialize_experts = False
+        self.materialized_expert_weights = None
+
 
         self.self_attn = MultiheadAttentionSuper(
             is_encoder=False,
@@ -1490,7 +1567,7 @@ class TransformerDecoderLayer(nn.Module):
             if self.expert_layer_freq == -1 or (self.expert_layer_freq == 0.5 and (self.layer_idx+1)%2==0):
                 self.max_experts = args.max_experts
 
-                if self.expert_routing_type in ["archrouting_jack_2L", "archrouting_jack_3L", "archrouting_jack_4L", "archrouting_jack_drop_2L"]:
+                if self.expert_routing_type in ARCHROUTING_TYPES:
                     self.feature_norm = [640, 6, 2048, 6, 640, 6, 2048, 6, 6, 2] # todo: make dynamic
                     self.register_buffer("active_arch_embed", torch.zeros(40) if hasattr(self, "hypernet_input_format") and self.hypernet_input_format == "fine" else torch.zeros(10))
                     self.arch_expert = torch.nn.Sequential(
@@ -1532,7 +1609,7 @@ class TransformerDecoderLayer(nn.Module):
                     self.other_intermediate_experts = nn.ModuleList([LinearSuper(super_in_dim=self.super_embed_dim, super_out_dim=self.super_ffn_embed_dim_this_layer, uniform_=init.uniform_, non_linear='relu') for _ in range(self.max_experts-1)] )
                     self.other_output_experts = nn.ModuleList([LinearSuper(super_in_dim=self.super_ffn_embed_dim_this_layer, super_out_dim=self.super_embed_dim, uniform_=init.uniform_, non_linear='linear') for _ in range(self.max_experts-1)] )
 
-                if self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L", "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
+                if self.expert_routing_type in NEURONROUTING_TYPES:
                     self.feature_norm = [640, 6, 2048, 6, 640, 6, 2048, 6, 6, 2] # todo: make dynamic
                     self.register_buffer("active_arch_embed", torch.zeros(40) if hasattr(self, "hypernet_input_format") and self.hypernet_input_format == "fine" else torch.zeros(10))
                     if self.expert_routing_type == "neuronrouting_jack_2L":
@@ -1748,9 +1825,13 @@ class TransformerDecoderLayer(nn.Module):
             for i in range(len(self.other_intermediate_experts)):
                 self.other_intermediate_experts[i].set_sample_config(sample_in_dim=self.sample_embed_dim, sample_out_dim=self.sample_ffn_embed_dim_this_layer)
                 self.other_output_experts[i].set_sample_config(sample_in_dim=self.sample_ffn_embed_dim_this_layer, sample_out_dim=self.sample_embed_dim)
-            if self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L", "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
+            if self.expert_routing_type in NEURONROUTING_TYPES:
                 self.fc1_expert[-1].set_sample_config(sample_in_dim=self.hypernet_hidden_size, sample_out_dim=self.max_experts*self.sample_ffn_embed_dim_this_layer)
                 self.fc2_expert[-1].set_sample_config(sample_in_dim=self.hypernet_hidden_size, sample_out_dim=self.max_experts*self.sample_embed_dim)
+            # the hypernet input only changes here, so the mixed experts can be baked once for inference
+            self.materialized_expert_weights = None
+            if self.materialize_experts and not self.training:
+                get_arch_expert_weights(self)
 
 
     def prepare_for_onnx_export_(self):
@@ -1831,42 +1912,10 @@ class TransformerDecoderLayer(nn.Module):
             x = self.maybe_layer_norm(self.final_layer_norm, x, before=True)
             if self.super_n_experts == 0:
                 if hasattr(self, "max_experts"):
-                    # arch experts 
-                    if self.expert_routing_type in ["archrouting_jack_2L", "archrouting_jack_3L", "archrouting_jack_4L", "archrouting_jack_drop_2L"]:
-                        route_prob = self.arch_expert(self.active_arch_embed)
-                        route_prob_max, routes = torch.max(route_prob, dim=-1)
-                        intermediate_weights = route_prob[0] * self.fc1.samples["weight"]
-                        intermediate_bias = route_prob[0] * self.fc1.samples["bias"]
-                        layer_output_weights = route_prob[0] * self.fc2.samples["weight"]
-                        layer_output_bias = route_prob[0] * self.fc2.samples["bias"]
-                        for expert_id in range(self.max_experts-1):
-                            intermediate_weights = intermediate_weights + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].samples["weight"])
-                            intermediate_bias = intermediate_bias + (route_prob[expert_id+1] * self.other_intermediate_experts[expert_id].samples["bias"])
-                            layer_output_weights = layer_output_weights + (route_prob[expert_id+1] * self.other_output_experts[expert_id].samples["weight"])
-                            layer_output_bias = layer_output_bias + (route_prob[expert_id+1] * self.other_output_experts[expert_id].samples["bias"])
-                        attention_output = x
-                        intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
-                        intermediate_output = self.activation_fn(intermediate_output)
-                        intermediate_output = F.dropout(intermediate_output, p=self.sample_activation_dropout, training=self.training)
-                        layer_output = F.linear(intermediate_output, layer_output_weights, layer_output_bias)
-                        layer_output = F.dropout(layer_output, p=self.sample_dropout, training=self.training)
-                        x = layer_output
-                    elif self.expert_routing_type in ["neuronrouting_jack_2L", "neuronrouting_jack_3L", "neuronrouting_jack_4L", "neuronrouting_jack_drop_2L", "neuronrouting_jack_drop_3L", "neuronrouting_jack_drop_4L",  "neuronrouting_jack_drop_gelu_2L", "neuronrouting_jack_drop_resnet_3L", "neuronrouting_jack_drop_resnet_4L"]:
-                        fc1_expert_out = self.fc1_expert(self.active_arch_embed)
-                        fc1_expert_out = fc1_expert_out.view(-1, self.max_experts)
-                        fc1_expert_out = torch.nn.Softmax(dim=-1)(fc1_expert_out)
-                        fc2_expert_out = self.fc2_expert(self.active_arch_embed)
-                        fc2_expert_out = fc2_expert_out.view(-1, self.max_experts)
-                        fc2_expert_out = torch.nn.Softmax(dim=-1)(fc2_expert_out)
-                        intermediate_weights = self.fc1.samples["weight"] * fc1_expert_out[:, 0].view(-1,1)
-                        intermediate_bias = self.fc1.samples["bias"] * fc1_expert_out[:, 0]
-                        layer_output_weights = self.fc2.samples["weight"] * fc2_expert_out[:, 0].view(-1,1)
-                        layer_output_bias = self.fc2.samples["bias"] * fc2_expert_out[:, 0]
-                        for expert_id in range(self.max_experts-1):
-                            intermediate_weights = intermediate_weights + (self.other_intermediate_experts[expert_id].samples["weight"] * fc1_expert_out[:, expert_id+1].view(-1,1) )
-                            intermediate_bias = intermediate_bias + (self.other_intermediate_experts[expert_id].samples["bias"]  * fc1_expert_out[:, expert_id+1] )
-                            layer_output_weights = layer_output_weights + (self.other_output_experts[expert_id].samples["weight"]* fc2_expert_out[:, expert_id+1].view(-1,1))
-                            layer_output_bias = layer_output_bias + (self.other_output_experts[expert_id].samples["bias"]* fc2_expert_out[:, expert_id+1])
+                    # arch experts
+                    mixed_weights = get_arch_expert_weights(self)
+                    if mixed_weights is not None:
+                        intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias = mixed_weights
                         attention_output = x
                         intermediate_output = F.linear(attention_output, intermediate_weights, intermediate_bias)
                         intermediate_output = self.activation_fn(intermediate_output)
@@ -1903,8 +1952,78 @@ class TransformerDecoderLayer(nn.Module):
         else:
             return x
 
+    def materialize_arch_experts(self, mode=True):
+        self.materialize_experts = mode
+        self.materialized_expert_weights = None
+
+    def train(self, mode=True):
+        # mixed expert weights go stale as soon as the experts are trained again
+        if mode:
+            self.materialized_expert_weights = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.materialized_expert_weights = None
+        super()._load_from_state_dict(*args, **kwargs)
+
     def make_generation_fast_(self, need_attn=False, **kwargs):
         self.need_attn = need_attn
+        self.materialize_arch_experts()
+
+def mix_arch_expert_weights(layer):
+    """Blend the sampled fc1/fc2 slices of all experts of an arch-routed layer.
+
+    The hypernet routes on ``layer.active_arch_embed``, so the result only
+    depends on the sampled architecture and the current parameters.
+
+    Returns:
+        tuple: (fc1 weight, fc1 bias, fc2 weight, fc2 bias), or ``None`` if the
+        layer does not use arch/neuron routing.
+    """
+    if layer.expert_routing_type in ARCHROUTING_TYPES:
+        route_prob = layer.arch_expert(layer.active_arch_embed)
+        intermediate_weights = route_prob[0] * layer.fc1.samples["weight"]
+        intermediate_bias = route_prob[0] * layer.fc1.samples["bias"]
+        layer_output_weights = route_prob[0] * layer.fc2.samples["weight"]
+        layer_output_bias = route_prob[0] * layer.fc2.samples["bias"]
+        for expert_id in range(layer.max_experts-1):
+            intermediate_weights = intermediate_weights + (route_prob[expert_id+1] * layer.other_intermediate_experts[expert_id].samples["weight"])
+            intermediate_bias = intermediate_bias + (route_prob[expert_id+1] * layer.other_intermediate_experts[expert_id].samples["bias"])
+            layer_output_weights = layer_output_weights + (route_prob[expert_id+1] * layer.other_output_experts[expert_id].samples["weight"])
+            layer_output_bias = layer_output_bias + (route_prob[expert_id+1] * layer.other_output_experts[expert_id].samples["bias"])
+    elif layer.expert_routing_type in NEURONROUTING_TYPES:
+        fc1_expert_out = layer.fc1_expert(layer.active_arch_embed)
+        fc1_expert_out = fc1_expert_out.view(-1, layer.max_experts)
+        fc1_expert_out = torch.nn.Softmax(dim=-1)(fc1_expert_out)
+        fc2_expert_out = layer.fc2_expert(layer.active_arch_embed)
+        fc2_expert_out = fc2_expert_out.view(-1, layer.max_experts)
+        fc2_expert_out = torch.nn.Softmax(dim=-1)(fc2_expert_out)
+        intermediate_weights = layer.fc1.samples["weight"] * fc1_expert_out[:, 0].view(-1,1)
+        intermediate_bias = layer.fc1.samples["bias"] * fc1_expert_out[:, 0]
+        layer_output_weights = layer.fc2.samples["weight"] * fc2_expert_out[:, 0].view(-1,1)
+        layer_output_bias = layer.fc2.samples["bias"] * fc2_expert_out[:, 0]
+        for expert_id in range(layer.max_experts-1):
+            intermediate_weights = intermediate_weights + (layer.other_intermediate_experts[expert_id].samples["weight"] * fc1_expert_out[:, expert_id+1].view(-1,1))
+            intermediate_bias = intermediate_bias + (layer.other_intermediate_experts[expert_id].samples["bias"] * fc1_expert_out[:, expert_id+1])
+            layer_output_weights = layer_output_weights + (layer.other_output_experts[expert_id].samples["weight"] * fc2_expert_out[:, expert_id+1].view(-1,1))
+            layer_output_bias = layer_output_bias + (layer.other_output_experts[expert_id].samples["bias"] * fc2_expert_out[:, expert_id+1])
+    else:
+        return None
+    return intermediate_weights, intermediate_bias, layer_output_weights, layer_output_bias
+
+def get_arch_expert_weights(layer):
+    """Mixed expert weights of `layer`, served from the materialized cache in eval mode."""
+    if not layer.materialize_experts or layer.training:
+        return mix_arch_expert_weights(layer)
+    cached = layer.materialized_expert_weights
+    weight = layer.fc1.weight
+    if cached is None or cached[0].device != weight.device or cached[0].dtype != weight.dtype:
+        with torch.no_grad():
+            mixed_weights = mix_arch_expert_weights(layer)
+        if mixed_weights is not None:
+            mixed_weights = tuple(t.contiguous() for t in mixed_weights)
+        layer.materialized_expert_weights = cached = mixed_weights
+    return cached
 
 def calc_dropout(dropout, sample_embed_dim, super_embed_dim):
     return dropout * 1.0 * sample_embed_dim / super_embed_dim
@@ -23,6 +23,8 @@ class EmbeddingSuper(nn.Embedding):
 
         self.samples = {'encoder': {}, 'decoder': {}}
         self.profiling = False
+        # inference only: keep contiguous copies of the sampled slices, see make_generation_fast_()
+        self.generation_fast = False
         self.reset_parameters()
 
     def profile(self, mode=True):
@@ -39,12 +41,34 @@ class EmbeddingSuper(nn.Embedding):
 
     def _sample_parameters(self, part):
         weight = self.weight[..., :self.sample_embed_dim[part]]
+        if self.generation_fast:
+            # the column slice is strided, both the lookup and the (shared) output projection want it contiguous
+            with torch.no_grad():
+                weight = weight.contiguous()
         self.samples[part]['weight'] = weight
 
         return self.samples
 
     def sample_parameters(self, part, resample=False):
-        return self._sample_parameters(part) if self.profiling or resample else self.samples
+        return self._sample_parameters(part) if self.profiling or resample or self._samples_stale(part) else self.samples
+
+    def _samples_stale(self, part):
+        # the copies do not follow half()/cuda() applied after the arch was sampled
+        if not self.generation_fast or 'weight' not in self.samples[part]:
+            return False
+        weight = self.samples[part]['weight']
+        return weight.dtype != self.weight.dtype or weight.device != self.weight.device
+
+    def make_generation_fast_(self, **kwargs):
+        self.generation_fast = True
+        for part in self.samples:
+            if self.sample_embed_dim[part] is not None:
+                self._sample_parameters(part)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        if self.generation_fast:
+            self.make_generation_fast_()
 
     def sampled_weight(self, part):
         return self.sample_parameters(part)[part]['weight']
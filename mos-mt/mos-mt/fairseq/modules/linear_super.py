@@ -25,15 +25,47 @@ class LinearSuper(nn.Linear):
 
         self._reset_parameters(bias, uniform_, non_linear)
         self.profiling = False
+        # contiguous copies of the sampled slices, see freeze_samples()
+        self.frozen_samples = False
+        self.frozen_cache = None
 
     def profile(self, mode=True):
         self.profiling = mode
 
+    def freeze_samples(self, mode=True):
+        """
+        Serve contiguous copies of the sampled weight/bias while no gradients are needed.
+
+        weight[:, :in] is strided unless in == super_in_dim, which F.linear pays for on every
+        call. The copies are made once per set_sample_config and dropped on train() and on
+        in-place updates of the weights.
+        """
+        self.frozen_samples = mode
+        self.frozen_cache = None
+
     def sample_parameters(self, resample=False):
         if self.profiling or resample:
             return self._sample_parameters()
+        if self.frozen_samples and not torch.is_grad_enabled():
+            return self._frozen_parameters()
         return self.samples
 
+    def _frozen_parameters(self):
+        params = [p for p in (self.weight, self.bias) if p is not None]
+        key = tuple((p._version, p.dtype, p.device) for p in params)
+        if self.frozen_cache is None or self.frozen_cache[0] != key:
+            # re-slice as well, the views do not follow half()/cuda() applied after set_sample_config
+            samples = self._sample_parameters()
+            with torch.no_grad():
+                self.frozen_cache = (key, {k: v.contiguous() if v is not None else None for k, v in samples.items()})
+        return self.frozen_cache[1]
+
+    def train(self, mode=True):
+        # the fairseq optimizers update p.data, which does not bump the parameter versions
+        if mode:
+            self.frozen_cache = None
+        return super().train(mode)
+
     def _reset_parameters(self, bias, uniform_, non_linear):
         nn.init.xavier_uniform_(self.weight) if uniform_ is None else uniform_(
             self.weight, non_linear=non_linear)
@@ -43,6 +75,7 @@ class LinearSuper(nn.Linear):
     def set_sample_config(self, sample_in_dim, sample_out_dim):
         self.sample_in_dim = sample_in_dim
         self.sample_out_dim = sample_out_dim
+        self.frozen_cache = None
 
         self._sample_parameters()
 
@@ -53,9 +86,12 @@ class LinearSuper(nn.Linear):
             self.samples['bias'] = sample_bias(self.bias, self.sample_out_dim)
         return self.samples
 
+    def make_generation_fast_(self, **kwargs):
+        self.freeze_samples()
+
     def forward(self, x):
-        self.sample_parameters()
-        return F.linear(x, self.samples['weight'], self.samples['bias'])
+        samples = self.sample_parameters()
+        return F.linear(x, samples['weight'], samples['bias'])
 
     def calc_sampled_param_num(self):
         assert 'weight' in self.samples.keys()
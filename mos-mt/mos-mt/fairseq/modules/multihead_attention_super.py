@@ -95,6 +95,10 @@ class MultiheadAttentionSuper(nn.Module):
 
         self.onnx_trace = False
 
+        # inference only: contiguous copies of the sampled q/k/v projections, see make_generation_fast_()
+        self.generation_fast = False
+        self.proj_cache = {}
+
         self.enable_torch_version = False
         if hasattr(F, "multi_head_attention_forward"):
             self.enable_torch_version = True
@@ -128,11 +132,20 @@ class MultiheadAttentionSuper(nn.Module):
         self.scaling = self.head_dim ** -0.5
 
         self.out_proj.set_sample_config(sample_in_dim=self.qkv_dim, sample_out_dim=self.sample_q_embed_dim)
+        self.proj_cache = {}
 
 
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
 
+    def make_generation_fast_(self, **kwargs):
+        self.generation_fast = True
+        self.proj_cache = {}
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.proj_cache = {}
+        super()._load_from_state_dict(*args, **kwargs)
+
     def reset_parameters(self):
         if self.qkv_same_dim:
             nn.init.xavier_uniform_(self.in_proj_weight)
@@ -319,7 +332,8 @@ class MultiheadAttentionSuper(nn.Module):
             bias = self.in_proj_bias
             if bias is not None:
                 bias = bias[:self.qkv_dim]
-            return F.linear(query, self.q_proj_weight[..., :self.sample_q_embed_dim], bias)
+            weight, bias = self._sampled_proj('q', self.q_proj_weight[..., :self.sample_q_embed_dim], bias)
+            return F.linear(query, weight, bias)
 
     def in_proj_k(self, key):
         if self.qkv_same_dim:
@@ -329,7 +343,8 @@ class MultiheadAttentionSuper(nn.Module):
             bias = self.in_proj_bias
             if bias is not None:
                 bias = bias[self.qkv_dim:2 * self.qkv_dim]
-            return F.linear(key, weight[..., :self.sample_kv_embed_dim], bias)
+            weight, bias = self._sampled_proj('k', weight[..., :self.sample_kv_embed_dim], bias)
+            return F.linear(key, weight, bias)
 
     def in_proj_v(self, value):
         if self.qkv_same_dim:
@@ -339,7 +354,8 @@ class MultiheadAttentionSuper(nn.Module):
             bias = self.in_proj_bias
             if bias is not None:
                 bias = bias[2 * self.qkv_dim:]
-            return F.linear(value, weight[..., :self.sample_kv_embed_dim], bias)
+            weight, bias = self._sampled_proj('v', weight[..., :self.sample_kv_embed_dim], bias)
+            return F.linear(value, weight, bias)
 
     def _in_proj(self, input, sample_dim, start=0, end=None):
         weight = self.in_proj_weight
@@ -347,13 +363,30 @@ class MultiheadAttentionSuper(nn.Module):
         weight = weight[start:end, :sample_dim]
         if bias is not None:
             bias = bias[start:end]
+        weight, bias = self._sampled_proj((start, end), weight, bias)
         return F.linear(input, weight, bias)
 
+    def _sampled_proj(self, key, weight, bias):
+        """In generation-fast mode, serve the sampled (strided) projection slices from contiguous copies."""
+        if not self.generation_fast:
+            return weight, bias
+        cached = self.proj_cache.get(key)
+        # the copies do not follow half()/cuda() applied after the arch was sampled
+        if cached is None or cached[0].dtype != weight.dtype or cached[0].device != weight.device:
+            with torch.no_grad():
+                cached = (weight.contiguous(), bias.contiguous() if bias is not None else None)
+            self.proj_cache[key] = cached
+        return cached
+
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
         if input_buffer is not None:
             for k in input_buffer.keys():
+                if self.generation_fast and self.encoder_decoder_attention and input_buffer[k].size(0) == new_order.size(0):
+                    # the static encoder keys/values are the same for all beams of a sentence, so only
+                    # dropping finished sentences (which shrinks the batch) changes them
+                    continue
                 input_buffer[k] = input_buffer[k].index_select(0, new_order)
             self._set_input_buffer(incremental_state, input_buffer)
 
@@ -108,7 +108,10 @@ class SwitchFNN(nn.Module):
         self.sample_dropout = None
         self.sample_activation_dropout = None
         self.sample_n_experts = None
-        
+
+        # (key, stacked weights) of the last forward without grad, see `stacked_expert_weights`
+        self.stacked_cache = None
+
         self.profiling = False
 
     def profile(self, mode=True):
@@ -145,171 +148,140 @@ class SwitchFNN(nn.Module):
       router_logits = F.linear(x, sample_router_weights, sample_router_bias)
       return router_logits
 
+    def stacked_expert_weights(self):
+      """
+      Sampled FFN weights of the sampled experts stacked for `bmm`: `[n_experts, ffn, d_model]`, `[n_experts, ffn]`,
+      `[n_experts, d_model, ffn]` and `[n_experts, d_model]`. Experts with a smaller ffn dim are zero padded,
+      which leaves their outputs unchanged. Identity experts get zero weights, their tokens are passed through.
+
+      Without grad (validation, search, decoding) the stack is reused until the sampled config or the
+      weights change (the version counter of a parameter is bumped by every in-place update).
+      With grad it is rebuilt every forward, as the autograd graph of the stack is freed by backward.
+      """
+      if torch.is_grad_enabled():
+        self.stacked_cache = None
+        return self.stack_expert_weights()
+      key = (self.sample_n_experts, self.sample_embed_dim, self.is_first_expert_identity,
+             tuple((self.experts[i][0].sample_out_dim, self.experts[i][0].weight._version, self.experts[i][0].bias._version,
+                    self.experts[i][1].weight._version, self.experts[i][1].bias._version)
+                   for i in range(self.sample_n_experts) if not (self.is_first_expert_identity and i == 0)),
+             self.switch.weight.device, self.switch.weight.dtype)
+      if self.stacked_cache is None or self.stacked_cache[0] != key:
+        self.stacked_cache = (key, self.stack_expert_weights())
+      return self.stacked_cache[1]
+
+    def stack_expert_weights(self):
+      fc1, fc2 = [], []
+      for i in range(self.sample_n_experts):
+        if self.is_first_expert_identity and i == 0:
+          fc1.append(None)
+          fc2.append(None)
+          continue
+        fc1.append(self.experts[i][0].sample_parameters())
+        fc2.append(self.experts[i][1].sample_parameters())
+
+      ffn_dims = [samples['weight'].size(0) for samples in fc1 if samples is not None]
+      if len(ffn_dims) == self.sample_n_experts and min(ffn_dims) == max(ffn_dims):
+        return (torch.stack([samples['weight'] for samples in fc1]), torch.stack([samples['bias'] for samples in fc1]),
+                torch.stack([samples['weight'] for samples in fc2]), torch.stack([samples['bias'] for samples in fc2]))
+
+      max_ffn_dim = max(ffn_dims) if ffn_dims else 1
+      weight = self.switch.weight
+      fc1_weight = weight.new_zeros(self.sample_n_experts, max_ffn_dim, self.sample_embed_dim)
+      fc1_bias = weight.new_zeros(self.sample_n_experts, max_ffn_dim)
+      fc2_weight = weight.new_zeros(self.sample_n_experts, self.sample_embed_dim, max_ffn_dim)
+      fc2_bias = weight.new_zeros(self.sample_n_experts, self.sample_embed_dim)
+      for i in range(self.sample_n_experts):
+        if fc1[i] is None:
+          continue
+        ffn_dim = fc1[i]['weight'].size(0)
+        fc1_weight[i, :ffn_dim] = fc1[i]['weight']
+        fc1_bias[i, :ffn_dim] = fc1[i]['bias']
+        fc2_weight[i, :, :ffn_dim] = fc2[i]['weight']
+        fc2_bias[i] = fc2[i]['bias']
+      return fc1_weight, fc1_bias, fc2_weight, fc2_bias
+
+    def experts_forward(self, x, routes, capacity=None):
+      """
+      Run each token of `x` (`[n_tokens, d_model]`) through the expert given by `routes`.
+
+      The tokens are sorted by route and packed into a `[n_experts, capacity, d_model]` buffer, so all experts
+      run as one batched matmul per FFN layer, and the outputs are scattered back in the original order.
+      Tokens over the `capacity` of their expert are dropped at random; `None` keeps every token.
+
+      Returns the expert outputs (zero for dropped tokens), the number of tokens routed to each expert and
+      the indexes of the dropped tokens.
+      """
+      n_tokens = x.size(0)
+      counts = torch.bincount(routes, minlength=self.sample_n_experts)
+
+      # sort by route; a random order within each expert picks the tokens to drop
+      ranks = torch.randperm(n_tokens, device=x.device) if capacity is not None else torch.arange(n_tokens, device=x.device)
+      order = torch.argsort(routes * n_tokens + ranks)
+      sorted_routes = routes[order]
+      positions = torch.arange(n_tokens, device=x.device) - (torch.cumsum(counts, dim=0) - counts)[sorted_routes]
+      if capacity is None:
+        capacity = int(counts.max()) if n_tokens > 0 else 0
+      keep = positions < capacity
+      dropped = order[~keep]
+      order, sorted_routes, positions = order[keep], sorted_routes[keep], positions[keep]
+
+      fc1_weight, fc1_bias, fc2_weight, fc2_bias = self.stacked_expert_weights()
+      dispatched = x.new_zeros(self.sample_n_experts, capacity, x.size(1))
+      dispatched[sorted_routes, positions] = x[order]
+      y = self.activation_fn(torch.baddbmm(fc1_bias.unsqueeze(1), dispatched, fc1_weight.transpose(1, 2)))
+      y = F.dropout(y, p=self.sample_activation_dropout, training=self.training)
+      y = torch.baddbmm(fc2_bias.unsqueeze(1), y, fc2_weight.transpose(1, 2))
+      y = F.dropout(y, p=self.sample_dropout, training=self.training)
+
+      expert_output = x.new_zeros(x.shape)
+      expert_output[order] = y[sorted_routes, positions]
+      if self.is_first_expert_identity:
+        identity = order[sorted_routes == 0]
+        expert_output[identity] = x[identity]
+      return expert_output, counts, dropped
+
     def forward(self, x: torch.Tensor):
         """
-        * `x` is the input to the switching module with shape  
+        * `x` is the input to the switching module with shape `[seq_len, batch_size, d_model]`
         """
 
         if self.sample_num_experts_to_route > 1:
           return self.forward_multiple_num_expert_to_route(x)
 
-        # convert from `[batch_size, seq_len, d_model]` to `[seq_len, batch_size, d_model]`
-        # x = x.permute(1, 0, 2)  # input is already [seq_len, batch_size, d_model]
-
-        timer_set = False
-        if timer_set:
-          main_start_time = time.time()
-
-        # Capture the shape to change shapes later
         seq_len, batch_size, d_model = x.shape
-        # Flatten the sequence and batch dimensions
-        if timer_set:
-          start_time = time.time()
         x = x.reshape(seq_len*batch_size, d_model)
-        if timer_set:
-          print("--- Flatten the sequence and batch dimensions = %s seconds ---" % (time.time() - start_time))
-
-        # Get routing probabilities for each of the tokens.
-        # $$p_i(x) = \frac{e^{h(x)_i}}{\sum^N_j e^{h(x)_j}}$$
-        # where $N$ is the number of experts `n_experts` and
-        # $h(\cdot)$ is the linear transformation of token embeddings.
-        if timer_set:
-          start_time = time.time()
-        route_prob = self.softmax(self.router_forward(x))
-        if timer_set:
-          print("--- Get routing probabilities = %s seconds ---" % (time.time() - start_time))
 
-        # Get the maximum routing probabilities and the routes.
-        # We route to the expert with highest probability
-        if timer_set:
-          start_time = time.time()
+        route_prob = self.softmax(self.router_forward(x))
         route_prob_max, routes = torch.max(route_prob, dim=-1)
-        if timer_set:
-          print("---  route to the expert with highest probability = %s seconds ---" % (time.time() - start_time))
-
-        # Get indexes of tokens going to each expert
-        if timer_set:
-          start_time = time.time()
-        indexes_list = [torch.eq(routes, i).nonzero(as_tuple=True)[0] for i in range(self.sample_n_experts)]
-        if timer_set:
-          print("---  Get indexes of tokens going to each expert = %s seconds ---" % (time.time() - start_time))
-
-        if timer_set:
-          start_time = time.time()
-        # Initialize an empty tensor to store outputs
-        final_output = x.new_zeros(x.shape)
-        if timer_set:
-          print("---  Initialize an empty tensor = %s seconds ---" % (time.time() - start_time))
-
-        # Capacity of each expert.
-        # $$\mathrm{expert\;capacity} =
-        # \frac{\mathrm{tokens\;per\;batch}}{\mathrm{number\;of\;experts}}
-        # \times \mathrm{capacity\;factor}$$
-        if timer_set:
-          start_time = time.time()
-        capacity = int(self.capacity_factor * len(x) / self.sample_n_experts)
-        # Number of tokens routed to each expert.
-        counts = x.new_tensor([len(indexes_list[i]) for i in range(self.sample_n_experts)])
-        if timer_set:
-          print("---  Capacity of each expert = %s seconds ---" % (time.time() - start_time))
-
-        # Initialize an empty list of dropped tokens
-        dropped = []
-        # Only drop tokens if `drop_tokens` is `True`.
-        if self.drop_tokens:
-            # Drop tokens in each of the experts
-            for i in range(self.sample_n_experts):
-                # Ignore if the expert is not over capacity
-                if len(indexes_list[i]) <= capacity:
-                    continue
-                # Shuffle indexes before dropping
-                indexes_list[i] = indexes_list[i][torch.randperm(len(indexes_list[i]))]
-                # Collect the tokens over capacity as dropped tokens
-                dropped.append(indexes_list[i][capacity:])
-                # Keep only the tokens upto the capacity of the expert
-                indexes_list[i] = indexes_list[i][:capacity]
-
-        # Get outputs of the expert FFNs
-        # expert_output = [self.experts[i](x[indexes_list[i], :]) for i in range(self.sample_n_experts)]
-        if timer_set:
-          start_time = time.time()
-        expert_output = []
-        for i in range(self.sample_n_experts): #TODO: slow in GPU. see deepseed impl. 
-          if self.is_first_expert_identity and i == 0:
-            expert_output.append(x[indexes_list[i], :])
-            continue
-          y = self.activation_fn(self.experts[i][0](x[indexes_list[i], :]))
-          y = F.dropout(y, p=self.sample_activation_dropout, training=self.training)
-          y = self.experts[i][1](y)
-          y = F.dropout(y, p=self.sample_dropout, training=self.training)
-          expert_output.append(y)
-
-        # Assign to final output
-        for i in range(self.sample_n_experts):
-            final_output[indexes_list[i], :] = expert_output[i] #.float()
-        if timer_set:
-          print("--- Get outputs of the expert FFNs = %s seconds ---" % (time.time() - start_time))
+
+        # Capacity of each expert, only enforced if `drop_tokens` is `True`.
+        capacity = int(self.capacity_factor * len(x) / self.sample_n_experts) if self.drop_tokens else None
+        final_output, counts, dropped = self.experts_forward(x, routes, capacity)
 
         # Pass through the dropped tokens
-        if dropped:
-            dropped = torch.cat(dropped)
+        if len(dropped):
             final_output[dropped, :] = x[dropped, :]
 
         if self.is_scale_prob:
-            # Multiply by the expert outputs by the probabilities $y = p_i(x) E_i(x)$
             final_output = final_output * route_prob_max.view(-1, 1)
         else:
-            # Don't scale the values but multiply by $\frac{p}{\hat{p}} = 1$ so that the gradients flow
-            # (this is something we experimented with).
             final_output = final_output * (route_prob_max / route_prob_max.detach()).view(-1, 1)
 
-        # Change the shape of the final output back to `[seq_len, batch_size, d_model]`
         final_output = final_output.view(seq_len, batch_size, d_model)
 
-        # Return
-        #
-        # * the final output
-        # * number of tokens routed to each expert
-        # * sum of probabilities for each expert
-        # * number of tokens dropped.
-        # * routing probabilities of the selected experts
-        #
-        # These are used for the load balancing loss and logging
-
-        # convert from `[seq_len, batch_size, d_model]` to `[batch_size, seq_len, d_model]`
-        # final_output = final_output.permute(1, 0, 2)
-
-        if timer_set:
-          print("--- Overall main = %s seconds ---" % (time.time() - main_start_time))
-
-        return final_output, counts, route_prob.sum(0), len(dropped), route_prob_max
+        # used for the load balancing loss and logging
+        return final_output, counts.type_as(x), route_prob.sum(0), len(dropped), route_prob_max
 
     def forward_multiple_num_expert_to_route(self, x: torch.Tensor):
       seq_len, batch_size, d_model = x.shape
       x = x.reshape(seq_len*batch_size, d_model)
       route_prob = self.softmax(self.router_forward(x))
       global_route_prob_max, global_routes = torch.topk(route_prob, k=self.sample_num_experts_to_route, dim=-1)
-      global_final_output = x.new_zeros(x.shape)
-      for k in range(self.sample_num_experts_to_route):
-        final_output = x.new_zeros(x.shape)
-        route_prob_max, routes = global_route_prob_max[:, k], global_routes[:, k]
-        indexes_list = [torch.eq(routes, i).nonzero(as_tuple=True)[0] for i in range(self.sample_n_experts)]
-        capacity = int(self.capacity_factor * len(x) / self.sample_n_experts)
-        counts = x.new_tensor([len(indexes_list[i]) for i in range(self.sample_n_experts)])
-        expert_output = []
-        for i in range(self.sample_n_experts):
-          if self.is_first_expert_identity and i == 0:
-            expert_output.append(x[indexes_list[i], :])
-            continue
-          y = self.activation_fn(self.experts[i][0](x[indexes_list[i], :]))
-          y = F.dropout(y, p=self.sample_activation_dropout, training=self.training)
-          y = self.experts[i][1](y)
-          y = F.dropout(y, p=self.sample_dropout, training=self.training)
-          expert_output.append(y)
-        for i in range(self.sample_n_experts):
-          final_output[indexes_list[i], :] = expert_output[i] 
-        final_output = final_output * route_prob_max.view(-1, 1)
-        global_final_output += final_output
+      # dispatch the k copies of every token together, `[n_tokens * k, d_model]` in token-major order
+      expert_output, _, _ = self.experts_forward(x.repeat_interleave(self.sample_num_experts_to_route, dim=0), global_routes.reshape(-1))
+      expert_output = expert_output * global_route_prob_max.reshape(-1, 1)
+      global_final_output = expert_output.view(seq_len*batch_size, self.sample_num_experts_to_route, d_model).sum(1)
       global_final_output = global_final_output.view(seq_len, batch_size, d_model)
       return global_final_output, None, None, None, None
 
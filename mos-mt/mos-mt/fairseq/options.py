@@ -362,6 +362,9 @@ def add_optimization_args(parser):
                        help='stop training when the learning rate reaches this minimum')
     group.add_argument('--use-bmuf', default=False, action='store_true',
                        help='specify global optimizer for syncing models on different GPUs/shards')
+    group.add_argument('--profile-train-step', default=False, action='store_true',
+                       help='log the time spent preparing batches, sampling SubTransformers, in forward/backward'
+                            ' and in the optimizer step (synchronizes CUDA, so slightly slows training down)')
     # fmt: on
     return group
 
@@ -0,0 +1,100 @@
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+# how often a search waiting for scores checks that its workers are alive, in seconds
+RESULT_POLL_SECONDS = 60
+
+
+def worker_devices(num_workers):
+    """One GPU per worker (round robin over the visible GPUs) when available, else CPU workers."""
+    if torch.cuda.is_available():
+        return [f'cuda:{i % torch.cuda.device_count()}' for i in range(num_workers)]
+    return ['cpu' for _ in range(num_workers)]
+
+
+def _worker_main(device, num_threads, build_fn, build_args, tasks, results):
+    # restrict the worker to its device before CUDA is initialized, it is then cuda:0 in the worker.
+    # The index is relative to the GPUs visible to the search (inherited CUDA_VISIBLE_DEVICES)
+    if device.startswith('cuda'):
+        index = int(device.split(':')[1])
+        visible = [d.strip() for d in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if d.strip()]
+        os.environ['CUDA_VISIBLE_DEVICES'] = visible[index] if visible else str(index)
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        torch.set_num_threads(num_threads)
+
+    try:
+        evaluate = build_fn(*build_args)
+    except Exception:
+        # reported on the results queue, otherwise the search would wait for this worker forever
+        results.put((None, None, traceback.format_exc()))
+        return
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, config = task
+        try:
+            results.put((index, evaluate(config), None))
+        except Exception:
+            results.put((index, None, traceback.format_exc()))
+
+
+class FitnessWorkerPool(object):
+    """
+    Scores SubTransformer configs in worker processes, each holding its own replica of the SuperTransformer.
+
+    `build_fn(*build_args)` runs once in every (spawned) worker and returns the function scoring one
+    config. Configs are dispatched from a shared queue, so a fast worker takes more of them, and the
+    scores are returned in completion order.
+    """
+
+    def __init__(self, num_workers, build_fn, build_args=()):
+        devices = worker_devices(num_workers)
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [
+            ctx.Process(
+                target=_worker_main,
+                args=(device, num_threads, build_fn, build_args, self.tasks, self.results),
+                daemon=True,
+            )
+            for device in devices
+        ]
+        for worker in self.workers:
+            worker.start()
+        print(f'| fitness workers: {len(self.workers)} on {", ".join(devices)}')
+
+    def imap_unordered(self, configs):
+        """Yields (index of the config, score) as the workers complete them."""
+        for index, config in enumerate(configs):
+            self.tasks.put((index, config))
+        for _ in range(len(configs)):
+            index, score, error = self._get_result()
+            if error is not None:
+                if index is None:
+                    raise RuntimeError(f'fitness worker failed to load the SuperTransformer:\n{error}')
+                raise RuntimeError(f'fitness worker failed on config {index}:\n{error}')
+            yield index, score
+
+    def _get_result(self):
+        """Next result, raises instead of waiting forever once a worker died (its configs are never answered)."""
+        while True:
+            try:
+                return self.results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError(f'{len(dead)} fitness worker(s) died (exit codes {[w.exitcode for w in dead]})')
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,84 @@
+import math
+
+
+class SuccessiveHalving(object):
+    """
+    Successive halving over the batches of a single validation pass.
+
+    All candidates are scored batch by batch. At every rung (min_batches, min_batches * eta, ...)
+    the candidates that are confidently outside the top `keep_size` are pruned, and only the best
+    1 / eta fraction of the rest (never fewer than `keep_size`) is run on the following batches.
+    A candidate is pruned by the confidence interval when its optimistic bound is worse than the
+    pessimistic bound of the current `keep_size`-th candidate (the parent cutoff).
+
+    Usage: call add() with the per-batch score of every active candidate, then step() once the
+    batch has been run through all of them; active holds the candidates to run on the next batch.
+    """
+
+    def __init__(self, num_candidates, keep_size, min_batches=8, eta=2, z=1.96, higher_is_better=False):
+        assert min_batches > 0 and eta > 1
+        self.keep_size = keep_size
+        self.min_batches = min_batches
+        self.eta = eta
+        self.z = z
+        # everything is kept lower-is-better internally
+        self.sign = -1 if higher_is_better else 1
+
+        self.active = list(range(num_candidates))
+        self.weighted_sums = [0. for _ in range(num_candidates)]
+        self.weights = [0. for _ in range(num_candidates)]
+        self.sums = [0. for _ in range(num_candidates)]
+        self.sq_sums = [0. for _ in range(num_candidates)]
+        self.num_batches = [0 for _ in range(num_candidates)]
+        self.pruned_at = [None for _ in range(num_candidates)]
+        self.next_rung = min_batches
+
+    def add(self, candidate, score, weight=1.):
+        if weight <= 0:
+            return
+        score = self.sign * float(score)
+        self.weighted_sums[candidate] += score * weight
+        self.weights[candidate] += weight
+        self.sums[candidate] += score
+        self.sq_sums[candidate] += score * score
+        self.num_batches[candidate] += 1
+
+    def mean(self, candidate):
+        if self.weights[candidate] == 0:
+            return float('inf')
+        return self.weighted_sums[candidate] / self.weights[candidate]
+
+    def stderr(self, candidate):
+        n = self.num_batches[candidate]
+        if n < 2:
+            return float('inf')
+        var = (self.sq_sums[candidate] - self.sums[candidate] ** 2 / n) / (n - 1)
+        return math.sqrt(max(var, 0.) / n)
+
+    def step(self, num_batches_done):
+        """Prune at the rungs, returns the candidates to run on the next batch."""
+        if num_batches_done < self.next_rung or len(self.active) <= self.keep_size:
+            return self.active
+        self.next_rung = int(math.ceil(self.next_rung * self.eta))
+
+        keep_size = min(self.keep_size, len(self.active))
+        upper = sorted(self.mean(c) + self.z * self.stderr(c) for c in self.active)
+        cutoff = upper[keep_size - 1]
+        survivors = [c for c in self.active if self.mean(c) - self.z * self.stderr(c) <= cutoff]
+        survivors.sort(key=self.mean)
+        survivors = survivors[:max(keep_size, int(math.ceil(len(self.active) / self.eta)))]
+
+        for c in self.active:
+            if c not in survivors:
+                self.pruned_at[c] = num_batches_done
+        self.active = sorted(survivors)
+        return self.active
+
+    def is_pruned(self, candidate):
+        return self.pruned_at[candidate] is not None
+
+    def selection_score(self, candidate):
+        """Score to rank on: pruned candidates can never displace fully evaluated ones."""
+        if self.is_pruned(candidate):
+            return self.sign * float('inf')
+        return self.sign * self.mean(candidate)
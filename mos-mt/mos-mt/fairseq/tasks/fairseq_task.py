@@ -208,7 +208,7 @@ class FairseqTask(object):
                 no_repeat_ngram_size=getattr(args, 'no_repeat_ngram_size', 0),
             )
 
-    def train_step(self, sample, model, criterion, optimizer, ignore_grad=False):
+    def train_step(self, sample, model, criterion, optimizer, ignore_grad=False, **criterion_kwargs):
         """
         Do forward and backward, and return the loss as computed by *criterion*
         for the given *model* and *sample*.
@@ -220,6 +220,7 @@ class FairseqTask(object):
             criterion (~fairseq.criterions.FairseqCriterion): the criterion
             optimizer (~fairseq.optim.FairseqOptimizer): the optimizer
             ignore_grad (bool): multiply loss by 0 if this is set to True
+            criterion_kwargs: passed on to the criterion (e.g. *distill_target*)
 
         Returns:
             tuple:
@@ -229,7 +230,7 @@ class FairseqTask(object):
                 - logging outputs to display while training
         """
         model.train()
-        loss, sample_size, logging_output = criterion(model, sample)
+        loss, sample_size, logging_output = criterion(model, sample, **criterion_kwargs)
         if ignore_grad:
             loss *= 0
         optimizer.backward(loss)
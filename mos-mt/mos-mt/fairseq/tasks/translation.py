@@ -10,8 +10,10 @@ from fairseq import options, utils
 from fairseq.data import (
     ConcatDataset,
     data_utils,
+    DistillDataset,
     indexed_dataset,
     LanguagePairDataset,
+    TeacherTopKDataset,
 )
 
 from . import FairseqTask, register_task
@@ -123,6 +125,10 @@ class TranslationTask(FairseqTask):
                             help='max number of tokens in the target sequence')
         parser.add_argument('--upsample-primary', default=1, type=int,
                             help='amount to upsample primary dataset')
+        parser.add_argument('--teacher-topk-cache', default=None, metavar='PREFIX',
+                            help='distill the train split from the top-k teacher probabilities '
+                                 'dumped by dump_teacher_topk.py under this prefix, '
+                                 'weighted by --sandwich-distill-alpha (> 0)')
         # fmt: on
 
     def __init__(self, args, src_dict, tgt_dict):
@@ -189,6 +195,26 @@ class TranslationTask(FairseqTask):
             max_target_positions=self.args.max_target_positions,
         )
 
+        if split == 'train' and getattr(self.args, 'teacher_topk_cache', None):
+            if getattr(self.args, 'sandwich_distill_alpha', 0) <= 0:
+                # the criterion only adds the distillation loss with a positive weight
+                raise ValueError('--teacher-topk-cache requires --sandwich-distill-alpha > 0')
+            dataset = self.datasets[split]
+            teacher_topk = TeacherTopKDataset(self.args.teacher_topk_cache)
+            assert len(teacher_topk) == len(dataset), \
+                f'teacher cache of {len(teacher_topk)} examples for a train split of {len(dataset)}'
+            print(f'| teacher top-{teacher_topk.topk} cache {self.args.teacher_topk_cache}')
+            self.datasets[split] = DistillDataset(
+                self.args, dataset.src, dataset.src_sizes, dataset.src_dict,
+                dataset.tgt, dataset.tgt_sizes, dataset.tgt_dict,
+                teacher_topk=teacher_topk,
+                left_pad_source=dataset.left_pad_source,
+                left_pad_target=dataset.left_pad_target,
+                max_source_positions=dataset.max_source_positions,
+                max_target_positions=dataset.max_target_positions,
+                is_train=True,
+            )
+
     def build_dataset_for_inference(self, src_tokens, src_lengths):
         return LanguagePairDataset(src_tokens, src_lengths, self.source_dictionary)
 
@@ -18,6 +18,7 @@ from copy import deepcopy
 import torch
 
 from fairseq import checkpoint_utils, distributed_utils, models, optim, utils, tokenizer
+from fairseq.data import data_utils
 from fairseq.meters import AverageMeter, StopwatchMeter, TimeMeter
 from fairseq.optim import lr_scheduler
 from fairseq.sequence_generator import SequenceGenerator
@@ -80,6 +81,12 @@ class Trainer(object):
             self.meters['loss_scale'] = AverageMeter()  # dynamic loss scale
         self.meters['wall'] = TimeMeter()      # wall time in seconds
         self.meters['train_wall'] = StopwatchMeter()  # train wall time in seconds
+        if getattr(args, 'profile_train_step', False):
+            # breakdown of train_wall, see train_step()
+            self.meters['train_prepare'] = StopwatchMeter()     # moving the batch to the GPU
+            self.meters['train_set_config'] = StopwatchMeter()  # sampling the SubTransformers
+            self.meters['train_fwd_bwd'] = StopwatchMeter()     # forward and backward passes
+            self.meters['train_update'] = StopwatchMeter()      # gradient sync and optimizer step
 
 
     def set_sample_config(self, config, arch_embeds=None):
@@ -269,63 +276,93 @@ class Trainer(object):
 
         # forward and backward pass
         logging_outputs, sample_sizes, ooms = [], [], 0
-        for config in configs:
-            if config is not None:
-                self.set_sample_config(config, arch_embeds=utils.get_config_features(config, args))
-            for i, sample in enumerate(samples):
+
+        # the batches are moved to the GPU (and to half) once and shared by all the sampled configs
+        with self._profile('train_prepare'):
+            prepared_samples = []
+            for sample in samples:
                 sample = self._prepare_sample(sample)
                 if sample is None:
                     # when sample is None, run forward/backward on a dummy batch
                     # and ignore the resulting gradients
-                    sample = self._prepare_sample(self._dummy_batch)
-                    ignore_grad = True
+                    prepared_samples.append((self._prepare_sample(self._dummy_batch), True))
+                else:
+                    prepared_samples.append((sample, False))
+
+        # with --sandwich-distill-alpha the first (largest) config is the teacher of the others,
+        # its output distribution on each batch is kept in distill_targets by the criterion.
+        # with --teacher-topk-cache all the configs are distilled from the cached teacher top-k
+        distill = getattr(self.args, 'sandwich_distill_alpha', 0) > 0 and (
+            len(configs) > 1 or getattr(self.args, 'teacher_topk_cache', None) is not None
+        )
+        distill_targets = [{} for _ in prepared_samples]
+
+        # (config, batch) pairs to run. When distilling, the batches are the outer loop: the teacher output
+        # of a batch is only kept while its configs run and is freed before the next batch, so that at most
+        # one dense teacher distribution is held whatever --update-freq
+        if distill:
+            steps = [(ci, i) for i in range(len(prepared_samples)) for ci in range(len(configs))]
+        else:
+            steps = [(ci, i) for ci in range(len(configs)) for i in range(len(prepared_samples))]
+
+        current_ci = None
+        for step, (ci, i) in enumerate(steps):
+            config = configs[ci]
+            if config is not None and ci != current_ci:
+                with self._profile('train_set_config'):
+                    self.set_sample_config(config, arch_embeds=utils.get_config_features(config, args))
+            current_ci = ci
+            sample, ignore_grad = prepared_samples[i]
+
+            def maybe_no_sync():
+                """
+                Whenever *samples* contains more than one mini-batch (or there
+                are several configs), we want to accumulate gradients locally
+                and only call all-reduce in the last backwards pass.
+                """
+                if (
+                    self.args.distributed_world_size > 1
+                    and hasattr(self.model, 'no_sync')
+                    and step < len(steps) - 1
+                ):
+                    return self.model.no_sync()
                 else:
-                    ignore_grad = False
-
-                def maybe_no_sync():
-                    """
-                    Whenever *samples* contains more than one mini-batch, we
-                    want to accumulate gradients locally and only call
-                    all-reduce in the last backwards pass.
-                    """
-                    if (
-                        self.args.distributed_world_size > 1
-                        and hasattr(self.model, 'no_sync')
-                        and i < len(samples) - 1
-                    ):
-                        return self.model.no_sync()
-                    else:
-                        return contextlib.ExitStack()  # dummy contextmanager
-
-                try:
-                    with maybe_no_sync():
-                        # forward and backward
-                        loss, sample_size, logging_output = self.task.train_step(
-                            sample, self.model, self.criterion, self.optimizer,
-                            ignore_grad
-                        )
-
-                    if not ignore_grad:
-                        logging_outputs.append(logging_output)
-                        sample_sizes.append(sample_size)
-                except RuntimeError as e:
-                    if 'out of memory' in str(e):
-                        msg = (
-                            '| WARNING: ran out of memory with exception: '
-                            + '{};'.format(e)
-                            + '\n Skipping batch'
-                        )
-                        # TODO: print should really go to logger, this print goes
-                        # to stdout, which is buffered, which in many case is not
-                        # printed out if another exception happens
-                        # print(msg)
-                        print(msg, file=sys.stderr)
-                        if raise_oom:
-                            raise ValueError(msg)
-                        ooms += 1
-                        self.zero_grad()
-                    else:
-                        raise e
+                    return contextlib.ExitStack()  # dummy contextmanager
+
+            try:
+                with maybe_no_sync(), self._profile('train_fwd_bwd'):
+                    # forward and backward
+                    loss, sample_size, logging_output = self.task.train_step(
+                        sample, self.model, self.criterion, self.optimizer,
+                        ignore_grad, **({'distill_target': distill_targets[i]} if distill else {})
+                    )
+
+                if not ignore_grad:
+                    logging_outputs.append(logging_output)
+                    sample_sizes.append(sample_size)
+            except RuntimeError as e:
+                if 'out of memory' in str(e):
+                    msg = (
+                        '| WARNING: ran out of memory with exception: '
+                        + '{};'.format(e)
+                        + '\n Skipping batch'
+                    )
+                    # TODO: print should really go to logger, this print goes
+                    # to stdout, which is buffered, which in many case is not
+                    # printed out if another exception happens
+                    # print(msg)
+                    print(msg, file=sys.stderr)
+                    if raise_oom:
+                        raise ValueError(msg)
+                    ooms += 1
+                    self.zero_grad()
+                else:
+                    raise e
+
+            if distill and ci == len(configs) - 1:
+                # every config has seen this batch, release its teacher output
+                distill_targets[i] = None
+        del prepared_samples, distill_targets
 
         if ooms > 0 and self._oom_batch is not None:
             self.handle_ooms(ooms)
@@ -374,16 +411,17 @@ class Trainer(object):
             ).format(self.task.__class__.__name__))
 
         try:
-            # normalize grads by sample size
-            if sample_size > 0:
-                self.optimizer.multiply_grads(self.args.distributed_world_size / float(sample_size))
+            with self._profile('train_update'):
+                # normalize grads by sample size
+                if sample_size > 0:
+                    self.optimizer.multiply_grads(self.args.distributed_world_size / float(sample_size))
 
-            # clip grads
-            grad_norm = self.optimizer.clip_grad_norm(self.args.clip_norm)
-            self._prev_grad_norm = grad_norm
+                # clip grads
+                grad_norm = self.optimizer.clip_grad_norm(self.args.clip_norm)
+                self._prev_grad_norm = grad_norm
 
-            # take an optimization step
-            self.optimizer.step()
+                # take an optimization step
+                self.optimizer.step()
             self.set_num_updates(self.get_num_updates() + 1)
 
             # task specific update per step
@@ -422,9 +460,14 @@ class Trainer(object):
 
 
 
-    def valid_step(self, sample, generator=None, raise_oom=False):
-        """Do forward pass in evaluation mode."""
-        if generator:
+    def valid_step(self, sample, generator=None, raise_oom=False, bleu_scorer=None):
+        """Do forward pass in evaluation mode.
+
+        With a *generator*, the top hypotheses are also decoded: their BLEU statistics are
+        added to *bleu_scorer* (a :class:`~fairseq.bleu.TensorScorer`) when one is given,
+        else the reference and hypothesis strings are returned with the logging output.
+        """
+        if generator and bleu_scorer is None:
             gold_target, pred_target = [], []
         with torch.no_grad():
             self.model.eval()
@@ -441,7 +484,14 @@ class Trainer(object):
                     sample, self.model, self.criterion
                 )
 
-                if generator:
+                if generator and bleu_scorer is not None:
+                    # BLEU statistics straight from the token ids, on device
+                    hypos, decoder_times = self.task.inference_step(generator, [self.model], sample, None)
+                    if not ignore_results:
+                        bleu_scorer.add(sample['target'], data_utils.collate_tokens(
+                            [hypo[0]['tokens'] for hypo in hypos], self.task.target_dictionary.pad(),
+                        ))
+                elif generator:
                     # for computing BLEU
                     src_dict = self.task.source_dictionary
                     tgt_dict = self.task.target_dictionary
@@ -472,7 +522,7 @@ class Trainer(object):
                             p.grad = None  # free some memory
                     if self.cuda:
                         torch.cuda.empty_cache()
-                    return self.valid_step(sample, raise_oom=True)
+                    return self.valid_step(sample, generator, raise_oom=True, bleu_scorer=bleu_scorer)
                 else:
                     raise e
 
@@ -508,7 +558,7 @@ class Trainer(object):
         if 'nll_loss' in logging_output:
             self.meters['valid_nll_loss'].update(logging_output.get('nll_loss', 0), ntokens)
 
-        if generator:
+        if generator and bleu_scorer is None:
             return logging_output, (gold_target, pred_target)
 
         return logging_output
@@ -584,6 +634,23 @@ class Trainer(object):
 
         return sample
 
+    @contextlib.contextmanager
+    def _profile(self, name):
+        """Time a sub-step of train_step into the meter *name* (with --profile-train-step)."""
+        if name not in self.meters:
+            yield
+            return
+        # CUDA is asynchronous, wait for the previous sub-step so that it is not billed to this one
+        if self.cuda:
+            torch.cuda.synchronize()
+        self.meters[name].start()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                torch.cuda.synchronize()
+            self.meters[name].stop()
+
     def _set_seed(self):
         # Set seed based on args.seed and the update number so that we get
         # reproducible results when resuming from checkpoints
@@ -25,6 +25,7 @@ import torch.nn.functional as F
 
 from fairseq.modules import gelu, gelu_accurate
 from fairseq.meters import AverageMeter
+from fairseq.latency_harness import LatencyHarness
 
 
 def load_ensemble_for_inference(filenames, task, model_arg_overrides=None):
@@ -845,116 +846,34 @@ def get_represent_configs(args):
     else:
         return {'largest_arbitrary1': largest_arbitrary1, 'smallest_arbitrary1': smallest_arbitrary1}
 
-def measure_latency_during_search(args, model, dummy_src_tokens, dummy_prev, config, extra_args):
+def measure_latency_during_search(args, model, dummy_src_tokens, dummy_prev, config, extra_args, harness=None):
     # latency measurement
     assert not (extra_args['latcpu'] and extra_args['latgpu'])
 
-    model_test = copy.copy(model)
-    model_test.set_sample_config(config, arch_embeds=get_config_features(config, None))
+    # set_sample_config only swaps the sampled dims, so the model is measured in place instead of copying it per call
+    model.set_sample_config(config, arch_embeds=get_config_features(config, None))
     src_tokens_test = torch.tensor([dummy_src_tokens], dtype=torch.long)
     src_lengths_test = torch.tensor([30])
     prev_output_tokens_test_with_beam = torch.tensor([dummy_prev] * extra_args['beam'], dtype=torch.long)
 
     if extra_args['latcpu']:
-        model_test.cpu()
-        # print('| Measuring model latency on CPU...')
+        model.cpu()
     elif extra_args['latgpu']:
-        # model_test.cuda()
         src_tokens_test = src_tokens_test.cuda()
         src_lengths_test = src_lengths_test.cuda()
         prev_output_tokens_test_with_beam = prev_output_tokens_test_with_beam.cuda()
-        src_tokens_test.get_device()
-        # print('| Measuring model latency on GPU...')
-        start = torch.cuda.Event(enable_timing=True)
-        end = torch.cuda.Event(enable_timing=True)
 
-    # dry runs
-    for _ in range(5):
-        encoder_out_test = model_test.encoder(src_tokens=src_tokens_test, src_lengths=src_lengths_test)
-
-    encoder_latencies = []
-    #print('| Measuring encoder...')
-    for _ in range(extra_args['latiter']):
-        if extra_args['latgpu']:
-            start.record()
-        elif extra_args['latcpu']:
-            start = time.time()
-
-        model_test.encoder(src_tokens=src_tokens_test, src_lengths=src_lengths_test)
+    if harness is None:
+        harness = LatencyHarness.from_args(args, 'cuda' if extra_args['latgpu'] else 'cpu', max_iters=extra_args['latiter'])
 
-        if extra_args['latgpu']:
-            end.record()
-            torch.cuda.synchronize()
-            encoder_latencies.append(start.elapsed_time(end))
-            #if not args.latsilent:
-            #    print('| Encoder one run on GPU: ', start.elapsed_time(end))
-
-        elif extra_args['latcpu']:
-            end = time.time()
-            encoder_latencies.append((end - start) * 1000)
-            #if not args.latsilent:
-            #    print('| Encoder one run on CPU: ', (end - start) * 1000)
-
-    # only use the 10% to 90% latencies to avoid outliers
-    #print(f'| Encoder latencies: {encoder_latencies}')
-    encoder_latencies.sort()
-    encoder_latencies = encoder_latencies[int(extra_args['latiter'] * 0.1): -int(extra_args['latiter'] * 0.1)]
-    #print(f'| Encoder latency: Mean: {np.mean(encoder_latencies)} ms; \t Std: {np.std(encoder_latencies)} ms')
-
-    # beam to the batch dimension
-    # encoder_out_test_with_beam = encoder_out_test.repeat(1, args.beam)
-    bsz = 1
-    new_order = torch.arange(bsz).view(-1, 1).repeat(1, extra_args['beam']).view(-1).long()
-    if extra_args['latgpu']:
-        new_order = new_order.cuda()
-
-    encoder_out_test_with_beam = model_test.encoder.reorder_encoder_out(encoder_out_test, new_order)
-
-    # dry runs
-    for _ in range(5):
-        model_test.decoder(prev_output_tokens=prev_output_tokens_test_with_beam,
-                           encoder_out=encoder_out_test_with_beam)
-
-    # decoder is more complicated because we need to deal with incremental states and auto regressive things
     decoder_iterations_dict = {'iwslt': 23, 'wmt': 30}
     if 'iwslt' in args.arch:
         decoder_iterations = decoder_iterations_dict['iwslt']
     elif 'wmt' in args.arch:
         decoder_iterations = decoder_iterations_dict['wmt']
 
-    decoder_latencies = []
-    #print('| Measuring decoder...')
-    for _ in range(extra_args['latiter']):
-        if extra_args['latgpu']:
-            start.record()
-        elif extra_args['latcpu']:
-            start = time.time()
-        incre_states = {}
-        for k_regressive in range(decoder_iterations):
-            model_test.decoder(prev_output_tokens=prev_output_tokens_test_with_beam[:, :k_regressive + 1],
-                               encoder_out=encoder_out_test_with_beam, incremental_state=incre_states)
-        if extra_args['latgpu']:
-            end.record()
-            torch.cuda.synchronize()
-            decoder_latencies.append(start.elapsed_time(end))
-            #if not args.latsilent:
-            #    print('| Decoder one run on GPU: ', start.elapsed_time(end))
-
-        elif extra_args['latcpu']:
-            end = time.time()
-            decoder_latencies.append((end - start) * 1000)
-            #if not args.latsilent:
-            #    print('| Decoder one run on CPU: ', (end - start) * 1000)
-
-    # only use the 10% to 90% latencies to avoid outliers
-    decoder_latencies.sort()
-    decoder_latencies = decoder_latencies[int(extra_args['latiter'] * 0.1): -int(extra_args['latiter'] * 0.1)]
-
-    #print(f'| Decoder latencies: {decoder_latencies}')
-    #print(f'| Decoder latency: Mean: {np.mean(decoder_latencies)} ms; \t Std: {np.std(decoder_latencies)} ms\n')
-
-    #print(f"| Overall Latency: {np.mean(encoder_latencies) + np.mean(decoder_latencies)}")
-    return np.mean(encoder_latencies) + np.mean(decoder_latencies)
+    lats = harness.measure(model, src_tokens_test, src_lengths_test, prev_output_tokens_test_with_beam, decoder_iterations)
+    return lats['encoder']['mean'] + lats['decoder']['mean']
 
 
 def measure_latency(args, model, dummy_src_tokens, dummy_prev):
@@ -1103,6 +1022,9 @@ def get_training_stats(trainer):
         stats['loss_scale'] = trainer.get_meter('loss_scale')
     stats['wall'] = round(trainer.get_meter('wall').elapsed_time)
     stats['train_wall'] = trainer.get_meter('train_wall')
+    for name in ['train_prepare', 'train_set_config', 'train_fwd_bwd', 'train_update']:
+        if trainer.get_meter(name) is not None:
+            stats[name] = trainer.get_meter(name)
     return stats
 
 
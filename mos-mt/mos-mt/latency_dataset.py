@@ -5,13 +5,12 @@
 # Project page: https://hanruiwang.me/project_pages/hat/
 
 import torch
-import time
 import pdb
 import json
-
-import numpy as np
+import os
 
 from fairseq import checkpoint_utils, distributed_utils, options, tasks, utils
+from fairseq.latency_harness import LatencyHarness
 from tqdm import tqdm
 
 
@@ -21,20 +20,74 @@ def main(args):
     assert args.max_tokens is not None or args.max_sentences is not None, \
         'Must specify batch size either with --max-tokens or --max-sentences'
 
-    # Initialize CUDA and distributed training
-    if torch.cuda.is_available() and not args.cpu:
-        torch.cuda.set_device(args.device_id)
-    torch.manual_seed(args.seed)
-
     # Print args
     print(args)
 
+    # the configs are sharded round-robin over the workers, each writing its own shard with a manifest
+    if args.lat_workers > 1:
+        torch.multiprocessing.spawn(generate_shard, args=(args,), nprocs=args.lat_workers)
+    else:
+        generate_shard(0, args)
+
+    merge_shards(args)
+
+
+def shard_path(args, shard_id):
+    return f'{args.lat_dataset_path}.shard{shard_id}of{args.lat_workers}'
+
+
+def read_manifest(args, shard_id):
+    manifest_path = shard_path(args, shard_id) + '.manifest.json'
+    if not os.path.exists(manifest_path):
+        return {'shard_id': shard_id, 'num_shards': args.lat_workers, 'seed': args.seed, 'num_done': 0, 'offset': 0, 'complete': False}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    assert manifest['seed'] == args.seed, f'{manifest_path} was generated with --seed {manifest["seed"]}'
+    return manifest
+
+
+def write_manifest(args, shard_id, manifest):
+    manifest_path = shard_path(args, shard_id) + '.manifest.json'
+    # the manifest is replaced atomically, so an interruption never leaves it half written
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def shard_indices(args, shard_id):
+    return range(shard_id, args.lat_dataset_size, args.lat_workers)
+
+
+def pin_worker(args, shard_id):
+    """Give each worker its own device (GPU) or its own set of cores (CPU)."""
+    if args.latgpu and torch.cuda.is_available():
+        torch.cuda.set_device((args.device_id + shard_id) % torch.cuda.device_count())
+    elif args.latcpu and args.lat_workers > 1 and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        cores_per_worker = max(1, len(cores) // args.lat_workers)
+        worker_cores = cores[shard_id * cores_per_worker: (shard_id + 1) * cores_per_worker] or cores[-cores_per_worker:]
+        os.sched_setaffinity(0, worker_cores)
+        torch.set_num_threads(len(worker_cores))
+        print(f'| worker {shard_id} pinned to cores {worker_cores}')
+
+
+def generate_shard(shard_id, args):
+    manifest = read_manifest(args, shard_id)
+    indices = shard_indices(args, shard_id)
+    if manifest['num_done'] >= len(indices):
+        print(f'| shard {shard_id} already complete')
+        return
+
+    pin_worker(args, shard_id)
+    torch.manual_seed(args.seed)
+
     # Setup task
     task = tasks.setup_task(args)
 
     # Build model
     model = task.build_model(args)
-    print(model)
+    if shard_id == 0:
+        print(model)
 
     # specify the length of the dummy input for profile
     # for iwslt, the average length is 23, for wmt, that is 30
@@ -49,145 +102,107 @@ def main(args):
     dummy_src_tokens = [2] + [7] * (dummy_sentence_length - 1)
     dummy_prev = [7] * (dummy_sentence_length - 1) + [2]
 
-    # for latency predictor: latency dataset generation
-    with open(args.lat_dataset_path, 'w') as fid:
-        src_tokens_test = torch.tensor([dummy_src_tokens], dtype=torch.long)
-        src_lengths_test = torch.tensor([dummy_sentence_length])
-        prev_output_tokens_test_with_beam = torch.tensor([dummy_prev] * args.beam, dtype=torch.long)
-        if args.latcpu:
-            model.cpu()
-            print('Measuring model latency on CPU for dataset generation...')
-        elif args.latgpu:
-            model.cuda()
-            src_tokens_test = src_tokens_test.cuda()
-            src_lengths_test = src_lengths_test.cuda()
-            prev_output_tokens_test_with_beam = prev_output_tokens_test_with_beam.cuda()
-            src_tokens_test.get_device()
-            print('Measuring model latency on GPU for dataset generation...')
-            start = torch.cuda.Event(enable_timing=True)
-            end = torch.cuda.Event(enable_timing=True)
-
-        feature_info = utils.get_feature_info(args)
-        if not args.lat_features:
-            fid.write(','.join(feature_info) + ',')
-            latency_info = ['latency_mean_encoder', 'latency_mean_decoder', 'latency_std_encoder', 'latency_std_decoder']
-            fid.write(','.join(latency_info) + '\n')
-
-        pbar = tqdm(total=args.lat_dataset_size)
-        for i in range(args.lat_dataset_size):
-            print(i)
-            pbar.update(1)
-            config_sam = utils.sample_configs(utils.get_all_choices(args), reset_rand_seed=False, super_decoder_num_layer=args.decoder_layers)
+    src_tokens_test = torch.tensor([dummy_src_tokens], dtype=torch.long)
+    src_lengths_test = torch.tensor([dummy_sentence_length])
+    prev_output_tokens_test_with_beam = torch.tensor([dummy_prev] * args.beam, dtype=torch.long)
+    if args.latcpu:
+        model.cpu()
+        print('Measuring model latency on CPU for dataset generation...')
+    elif args.latgpu:
+        model.cuda()
+        src_tokens_test = src_tokens_test.cuda()
+        src_lengths_test = src_lengths_test.cuda()
+        prev_output_tokens_test_with_beam = prev_output_tokens_test_with_beam.cuda()
+        print('Measuring model latency on GPU for dataset generation...')
+    dummy_inputs = (src_tokens_test, src_lengths_test, prev_output_tokens_test_with_beam)
+    # the cores of the worker are already pinned by pin_worker
+    harness = LatencyHarness.from_args(args, 'cuda' if args.latgpu else 'cpu')
+
+    # drop a row that was only partially written when the previous run was interrupted
+    with open(shard_path(args, shard_id), 'a') as fid:
+        fid.truncate(manifest['offset'])
+
+    all_choices = utils.get_all_choices(args)
+    with open(shard_path(args, shard_id), 'a') as fid:
+        pbar = tqdm(total=len(indices), initial=manifest['num_done'], position=shard_id)
+        for i in indices[manifest['num_done']:]:
+            # seeded by the global index, so the dataset does not depend on the number of workers or on restarts
+            config_sam = utils.sample_configs(all_choices, reset_rand_seed=True, rand_seed=f'{args.seed}-{i}', super_decoder_num_layer=args.decoder_layers)
 
             features = utils.get_config_features(config_sam, args)
-            if not args.lat_features:
-                fid.write(','.join(map(str, features)) + ',')
-
             model.set_sample_config(config_sam, arch_embeds=utils.get_config_features(config_sam, args))
+            lats = measure_latency(args, model, dummy_inputs, harness)
 
-            # dry runs
-            for _ in range(5):
-                encoder_out_test = model.encoder(src_tokens=src_tokens_test, src_lengths=src_lengths_test)
-
-            encoder_latencies = []
-            print('Measuring encoder for dataset generation...')
-            for _ in tqdm(range(args.latiter)):
-                if args.latgpu:
-                    start.record()
-                elif args.latcpu:
-                    start = time.time()
-
-                model.encoder(src_tokens=src_tokens_test, src_lengths=src_lengths_test)
-
-                if args.latgpu:
-                    end.record()
-                    torch.cuda.synchronize()
-                    encoder_latencies.append(start.elapsed_time(end))
-                    if not args.latsilent:
-                        print('Encoder one run on GPU (for dataset generation): ', start.elapsed_time(end))
-
-                elif args.latcpu:
-                    end = time.time()
-                    encoder_latencies.append((end - start) * 1000)
-                    if not args.latsilent:
-                        print('Encoder one run on CPU (for dataset generation): ', (end - start) * 1000)
-
-            # only use the 10% to 90% latencies to avoid outliers
-            encoder_latencies.sort()
-            encoder_latencies = encoder_latencies[int(args.latiter * 0.1): -max(1, int(args.latiter * 0.1))]
-            print(f'Encoder latency for dataset generation: Mean: {np.mean(encoder_latencies)} ms; \t Std: {np.std(encoder_latencies)} ms')
-
-            bsz = 1
-            new_order = torch.arange(bsz).view(-1, 1).repeat(1, args.beam).view(-1).long()
-            if args.latgpu:
-                new_order = new_order.cuda()
-
-            encoder_out_test_with_beam = model.encoder.reorder_encoder_out(encoder_out_test, new_order)
-
-            # dry runs
-            for _ in range(5):
-                model.decoder(prev_output_tokens=prev_output_tokens_test_with_beam,
-                                   encoder_out=encoder_out_test_with_beam)
-
-            # decoder is more complicated because we need to deal with incremental states and auto regressive things
-            decoder_iterations_dict = {'iwslt': 23, 'wmt': 30}
-            if 'iwslt' in args.arch:
-                decoder_iterations = decoder_iterations_dict['iwslt']
-            elif 'wmt' in args.arch:
-                decoder_iterations = decoder_iterations_dict['wmt']
-
-            decoder_latencies = []
-            print('Measuring decoder for dataset generation...')
-            for _ in tqdm(range(args.latiter)):
-                if args.latgpu:
-                    start.record()
-                elif args.latcpu:
-                    start = time.time()
-                incre_states = {}
-                for k_regressive in range(decoder_iterations):
-                    model.decoder(prev_output_tokens=prev_output_tokens_test_with_beam[:, :k_regressive + 1],
-                                       encoder_out=encoder_out_test_with_beam, incremental_state=incre_states)
-                if args.latgpu:
-                    end.record()
-                    torch.cuda.synchronize()
-                    decoder_latencies.append(start.elapsed_time(end))
-                    if not args.latsilent:
-                        print('Decoder one run on GPU (for dataset generation): ', start.elapsed_time(end))
-
-                elif args.latcpu:
-                    end = time.time()
-                    decoder_latencies.append((end - start) * 1000)
-                    if not args.latsilent:
-                        print('Decoder one run on CPU (for dataset generation): ', (end - start) * 1000)
-
-            # only use the 10% to 90% latencies to avoid outliers
-            decoder_latencies.sort()
-            decoder_latencies = decoder_latencies[int(args.latiter * 0.1): -max(1, int(args.latiter * 0.1))]
-
-            print(decoder_latencies)
-            print(f'Decoder latency for dataset generation: Mean: {np.mean(decoder_latencies)} ms; \t Std: {np.std(decoder_latencies)} ms')
-
-            lats = [np.mean(encoder_latencies), np.mean(decoder_latencies), np.std(encoder_latencies), np.std(decoder_latencies)]
             if not args.lat_features:
-                fid.write(','.join(map(str, lats)) + '\n')
+                lats = [lats['encoder']['mean'], lats['decoder']['mean'], lats['encoder']['std'], lats['decoder']['std']]
+                fid.write(','.join(map(str, features)) + ',' + ','.join(map(str, lats)) + '\n')
             else:
-                features["encoder_latencies"] = np.mean(encoder_latencies)
-                features["decoder_latencies"] = np.mean(decoder_latencies)
+                features["encoder_latencies"] = lats['encoder']['mean']
+                features["decoder_latencies"] = lats['decoder']['mean']
                 fid.write(json.dumps(features)+"\n")
+            fid.flush()
+            os.fsync(fid.fileno())
+
+            manifest['num_done'] += 1
+            manifest['offset'] = fid.tell()
+            manifest['complete'] = manifest['num_done'] == len(indices)
+            write_manifest(args, shard_id, manifest)
+            pbar.update(1)
         pbar.close()
 
 
+def merge_shards(args):
+    """Interleave the shards back into the global config order, in the format LatencyPredictor.read_dataset expects."""
+    shards = []
+    for shard_id in range(args.lat_workers):
+        manifest = read_manifest(args, shard_id)
+        num_rows = len(shard_indices(args, shard_id))
+        if manifest['num_done'] < num_rows:
+            print(f'| shard {shard_id} is incomplete ({manifest["num_done"]}/{num_rows}), rerun to resume it')
+            return
+        with open(shard_path(args, shard_id), 'r') as f:
+            shards.append(f.readlines()[:num_rows])
+
+    with open(args.lat_dataset_path, 'w') as fid:
+        if not args.lat_features:
+            fid.write(','.join(utils.get_feature_info(args)) + ',')
+            latency_info = ['latency_mean_encoder', 'latency_mean_decoder', 'latency_std_encoder', 'latency_std_decoder']
+            fid.write(','.join(latency_info) + '\n')
+        for i in range(args.lat_dataset_size):
+            fid.write(shards[i % args.lat_workers][i // args.lat_workers])
+    print(f'| merged {args.lat_workers} shards into {args.lat_dataset_path}')
+
+
+def measure_latency(args, model, dummy_inputs, harness):
+    src_tokens_test, src_lengths_test, prev_output_tokens_test_with_beam = dummy_inputs
+
+    # decoder is more complicated because we need to deal with incremental states and auto regressive things
+    decoder_iterations_dict = {'iwslt': 23, 'wmt': 30}
+    if 'iwslt' in args.arch:
+        decoder_iterations = decoder_iterations_dict['iwslt']
+    elif 'wmt' in args.arch:
+        decoder_iterations = decoder_iterations_dict['wmt']
+
+    lats = harness.measure(model, src_tokens_test, src_lengths_test, prev_output_tokens_test_with_beam, decoder_iterations)
+    if not args.latsilent:
+        for part in ['encoder', 'decoder']:
+            print(f'{part.capitalize()} latency for dataset generation: Mean: {lats[part]["mean"]} ms; \t Std: {lats[part]["std"]} ms; '
+                  f'P50: {lats[part]["p50"]} ms; P90: {lats[part]["p90"]} ms ({lats[part]["iters"]} runs after {lats[part]["warmup"]} warmup runs)')
+    return lats
+
 
 def cli_main():
     parser = options.get_training_parser()
 
     parser.add_argument('--latgpu', action='store_true', help='measure SubTransformer latency on GPU')
     parser.add_argument('--latcpu', action='store_true', help='measure SubTransformer latency on CPU')
-    parser.add_argument('--latiter', type=int, default=300, help='how many iterations to run when measure the latency')
+    parser.add_argument('--latiter', type=int, default=300, help='maximum number of iterations to run when measure the latency')
+    LatencyHarness.add_args(parser)
     parser.add_argument('--latsilent', action='store_true', help='keep silent when measure latency')
 
     parser.add_argument('--lat-dataset-path', type=str, default='./latency_dataset/lat.tmp', help='the path to write latency dataset')
     parser.add_argument('--lat-dataset-size', type=int, default=200, help='number of data points for the dataset')
+    parser.add_argument('--lat-workers', type=int, default=1, help='number of worker processes, each pinned to its own GPU or set of CPU cores and writing its own resumable shard')
     parser.add_argument('--encoder-load-balancing-loss-coeff', type=float, default=0.0)
     parser.add_argument('--decoder-load-balancing-loss-coeff', type=float, default=0.0)
     parser.add_argument('--thor-consistency-alpha', type=float, default=0.0)
@@ -116,16 +116,26 @@ class LatencyPredictor(object):
         self.model.load_state_dict(torch.load(self.ckpt_path))
 
     def predict_lat(self, config):
+        return self.predict_lat_batch([config])[0]
+
+    def predict_lat_batch(self, configs):
+        """Predict the latencies of a list of configs with a single forward of the predictor."""
+        if len(configs) == 0:
+            return []
+        # TODO: proper fix needed. features are cut to the predictor dims since adding number of experts to route to dimension
+        features = np.array([utils.get_config_features(config, None)[0:len(self.feature_norm)] for config in configs], dtype=np.float32)
+        return self.predict_lat_features(features)
+
+    def predict_lat_features(self, features):
+        """Predict the latencies of a (num_configs, feature_dim) array of get_config_features rows."""
+        if len(features) == 0:
+            return []
         with torch.no_grad():
-            print(config)
-            features = utils.get_config_features(config, None)
-            features = features[0:len(self.feature_norm)] # TODO: proper fix needed. introduced when adding number of experts to route to dimension
-            features_norm = np.array(features) / self.feature_norm
-            features_norm = np.array(features) / self.feature_norm
+            features_norm = np.asarray(features, dtype=np.float32)[:, 0:len(self.feature_norm)] / self.feature_norm
 
-            prediction = self.model(torch.Tensor(features_norm)).item() * self.lat_norm
+            prediction = self.model(torch.from_numpy(features_norm.astype(np.float32))).view(-1) * self.lat_norm
 
-        return prediction
+        return prediction.tolist()
 
     def split(self, train_size=None, fixed_val_test_size=None):
         sample_num = len(self.dataset['x'])
@@ -268,12 +268,18 @@ def train(args, trainer, task, epoch_itr, generator=None):
         if args.train_subtransformer:
             # training one SubTransformer only
             configs = [utils.get_subtransformer_config(args)]
+            sampled_config = configs[0]
         else:
             # training SuperTransformer by randomly sampling SubTransformers
             configs = [utils.sample_configs(utils.get_all_choices(args), reset_rand_seed=True, rand_seed=trainer.get_num_updates(),
                                             super_decoder_num_layer=args.decoder_layers)]
+            sampled_config = configs[0]
             if args.sandwich_rule == 1:
-                configs += [represent_configs["largest_arbitrary1"], represent_configs["smallest_arbitrary1"]]
+                if args.sandwich_distill_alpha > 0:
+                    # the largest SubTransformer goes first, it is the teacher of the others on the same batch
+                    configs = [represent_configs["largest_arbitrary1"]] + configs + [represent_configs["smallest_arbitrary1"]]
+                else:
+                    configs += [represent_configs["largest_arbitrary1"], represent_configs["smallest_arbitrary1"]]
 
         log_output = trainer.train_step(samples, configs=configs, args=args)
         if log_output is None:
@@ -290,7 +296,7 @@ def train(args, trainer, task, epoch_itr, generator=None):
                 extra_meters[k].update(v)
             stats[k] = extra_meters[k].avg
 
-        utils.log_arch_info(stats, configs[0])
+        utils.log_arch_info(stats, sampled_config)
 
         progress.log(stats, tag='train', step=stats['num_updates'])
 